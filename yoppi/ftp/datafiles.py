@@ -0,0 +1,94 @@
+"""Precomputed data files shared between the indexer and the web process.
+
+The indexer writes these files in YOPPI_DATA_DIR once it is done with a cycle;
+the web process keeps the parsed content in memory and reloads it when the
+file changes on disk.
+"""
+import collections
+import os
+import threading
+
+from django.conf import settings
+
+
+def data_path(filename):
+    """Returns the full path of a data file, or None if it is disabled."""
+    directory = getattr(settings, 'YOPPI_DATA_DIR', None)
+    if not directory:
+        return None
+    return os.path.join(directory, filename)
+
+
+def atomic_write(filename, data):
+    """Replaces a data file with the given content.
+
+    The content is written to a temporary file which is then renamed, so that
+    readers never see a partially-written file.
+    """
+    path = data_path(filename)
+    if path is None:
+        return False
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp, 'wb') as fp:
+        fp.write(data)
+    os.rename(tmp, path)
+    return True
+
+
+def remove_data_file(filename):
+    path = data_path(filename)
+    if path is not None and os.path.exists(path):
+        os.remove(path)
+
+
+class DataFileCache(object):
+    """Keeps parsed data files in memory, reloading them when they change.
+
+    'loader' is called with the raw content of the file and returns the
+    object that get() will hand out. If 'max_size' is given, the least
+    recently used files are dropped once the files kept are larger than
+    that many bytes.
+    """
+    def __init__(self, loader, max_size=None):
+        self.loader = loader
+        self.max_size = max_size
+        # path -> (stamp, object, size), the most recently used last
+        self._entries = collections.OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, filename, default=None):
+        path = data_path(filename)
+        if path is None:
+            return default
+        try:
+            st = os.stat(path)
+        except OSError:
+            with self._lock:
+                self._discard(path)
+            return default
+        # A new file is put in place by rename(), so the inode changes
+        stamp = (st.st_ino, st.st_mtime, st.st_size)
+        with self._lock:
+            entry = self._discard(path)
+            if entry is None or entry[0] != stamp:
+                with open(path, 'rb') as fp:
+                    entry = stamp, self.loader(fp.read()), st.st_size
+            self._entries[path] = entry
+            self._size += entry[2]
+            if self.max_size is not None:
+                while self._size > self.max_size and len(self._entries) > 1:
+                    self._discard(next(iter(self._entries)))
+        return entry[1]
+
+    def _discard(self, path):
+        entry = self._entries.pop(path, None)
+        if entry is not None:
+            self._size -= entry[2]
+        return entry
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,154 @@
+"""Static copy of the browsing pages.
+
+The pages of the index and server views are rendered to files laid out like
+their URLs, /server/<address>/<path> becoming
+server/<address>/<path>/index.html, so that a web server can answer them
+without running Django. Only the servers indexed since the last export are
+rendered again.
+
+Each server/<address> is a symbolic link to a directory of versions/, which
+is replaced by renaming a new link over it, so that the web server always
+finds either the previous pages or the new ones.
+"""
+import json
+import os
+import shutil
+import tempfile
+
+from django.conf import settings
+from django.test.client import RequestFactory
+from django.utils import translation
+
+from yoppi.ftp import views
+from yoppi.ftp.models import FtpServer
+from yoppi.ftp.shards import ShardQuery, is_sharded
+
+
+STATE_FILE = 'exported.json'
+
+
+def _directories(server):
+    """Paths of the directories of a server, including the root"""
+    if is_sharded():
+        rows = (ShardQuery().filter(is_directory=True)
+                .values_list(server.address, 'path', 'name'))
+    else:
+        rows = (server.files.visible()
+                .filter(is_directory=True).values_list('path', 'name'))
+    yield u''
+    for path, name in rows:
+        yield path + u'/' + name
+
+
+def _file_path(root, *components):
+    """The page of a directory, or None if it can't have one: its path can't
+    be written, or its URL is the page of its parent"""
+    parts = []
+    for component in components:
+        for part in component.split(u'/'):
+            if part in (u'.', u'..', u'index.html'):
+                return None
+            if part:
+                parts.append(part.encode('utf-8'))
+    return os.path.join(root, *parts + ['index.html'])
+
+
+def _write(filename, content):
+    directory = os.path.dirname(filename)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    tmp = '%s.%d.tmp' % (filename, os.getpid())
+    with open(tmp, 'wb') as fp:
+        fp.write(content)
+    os.rename(tmp, filename)
+
+
+def _render(view, *args):
+    request = RequestFactory().get('/')
+    return view(request, *args).content
+
+
+def _target(link):
+    """The directory a link of server/ points to, or None"""
+    if not os.path.islink(link):
+        return None
+    return os.path.join(os.path.dirname(link), os.readlink(link))
+
+
+def export_server(server, output_dir):
+    """Renders all the directories of a server.
+
+    They are written to a new directory of versions/, then the link of the
+    server is switched to it and the previous directory deleted.
+    """
+    servers_dir = os.path.join(output_dir, 'server')
+    versions_dir = os.path.join(output_dir, 'versions')
+    for directory in (servers_dir, versions_dir):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+    version = tempfile.mkdtemp(prefix='%s.' % server.address,
+                               dir=versions_dir)
+    os.chmod(version, 0755)
+    for path in _directories(server):
+        filename = _file_path(version, path)
+        if filename is None:
+            continue
+        _write(filename, _render(views.server, server.address, path))
+
+    link = os.path.join(servers_dir, server.address)
+    tmp = '%s.%d.tmp' % (link, os.getpid())
+    if os.path.lexists(tmp):
+        os.remove(tmp)
+    os.symlink(os.path.relpath(version, servers_dir), tmp)
+    old = _target(link)
+    if old is None and os.path.isdir(link):
+        # Written before the links were used: a rename can't replace it
+        shutil.rmtree(link)
+    os.rename(tmp, link)
+    if old is not None and os.path.isdir(old):
+        shutil.rmtree(old)
+
+
+def remove_server(address, output_dir):
+    link = os.path.join(output_dir, 'server', address)
+    target = _target(link)
+    if target is not None:
+        os.remove(link)
+        if os.path.isdir(target):
+            shutil.rmtree(target)
+    elif os.path.isdir(link):
+        shutil.rmtree(link)
+
+
+def _load_state(output_dir):
+    try:
+        with open(os.path.join(output_dir, STATE_FILE)) as fp:
+            return json.load(fp)
+    except (IOError, ValueError):
+        return {}
+
+
+def export_site(output_dir, force=False):
+    """Updates the static copy of the site in 'output_dir'.
+
+    Returns the addresses of the servers that were rendered again.
+    """
+    translation.activate(settings.LANGUAGE_CODE)
+    state = _load_state(output_dir)
+    new_state = {}
+    exported = []
+    for server in FtpServer.objects.all():
+        stamp = u'%s/%d' % (server.last_indexed, server.generation)
+        if force or state.get(server.address) != stamp:
+            export_server(server, output_dir)
+            exported.append(server.address)
+        new_state[server.address] = stamp
+    for address in set(state) - set(new_state):
+        remove_server(address, output_dir)
+
+    _write(os.path.join(output_dir, 'index.html'), _render(views.index))
+    tmp = os.path.join(output_dir, '%s.%d.tmp' % (STATE_FILE, os.getpid()))
+    with open(tmp, 'w') as fp:
+        json.dump(new_state, fp)
+    os.rename(tmp, os.path.join(output_dir, STATE_FILE))
+    return exported
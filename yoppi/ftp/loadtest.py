@@ -0,0 +1,272 @@
+"""Generated datasets and a load test of the web views.
+
+generate_dataset() fills the database with made-up servers and files whose
+names follow a skewed distribution, like real ones do: a few words are in
+many names, most words in few. run_load_test() then requests the main pages
+and measures their latency and number of queries.
+"""
+import json
+import random
+import re
+import time
+import urllib
+import urllib2
+
+from django.db import connection, transaction
+from django.db.models import Max, Min
+from django.test.client import Client
+from django.utils import timezone
+
+from yoppi.ftp.models import FtpServer, File, content_key, file_extension, \
+        guess_file_category
+from yoppi.ftp.shards import ShardQuery, is_sharded, write_shard
+
+
+_syllables = ('ba', 'ko', 'ri', 'tan', 'mu', 'sel', 'do', 'vi', 'nor', 'pa',
+              'le', 'gu', 'zo', 'fen', 'ti', 'ma', 'rek', 'su', 'o', 'ly')
+_extensions = ('avi', 'mkv', 'mp3', 'flac', 'iso', 'zip', 'pdf', 'txt',
+               'jpg', 'srt')
+
+# Generated servers are given addresses from there
+FIRST_ADDRESS = (10, 200, 0, 1)
+
+INSERT_BATCH = 5000
+
+
+def _skewed_index(rand, n, skew=3):
+    """An index in [0, n) where the small ones are much more frequent"""
+    return int(n * rand.random() ** skew)
+
+
+def _address(i):
+    a, b, c, d = FIRST_ADDRESS
+    n = (((a * 256 + b) * 256 + c) * 256 + d) + i
+    return '%d.%d.%d.%d' % (n >> 24, (n >> 16) & 255, (n >> 8) & 255,
+                            n & 255)
+
+
+class Dataset(object):
+    def __init__(self, seed=0, vocabulary_size=20000):
+        self.rand = random.Random(seed)
+        words = set()
+        while len(words) < vocabulary_size:
+            words.add(''.join(self.rand.choice(_syllables)
+                              for i in xrange(self.rand.randint(2, 4))))
+        self.vocabulary = sorted(words)
+        self.rand.shuffle(self.vocabulary)
+
+    def word(self):
+        return self.vocabulary[_skewed_index(self.rand, len(self.vocabulary))]
+
+    def name(self, directory=False):
+        words = [self.word() for i in xrange(self.rand.randint(1, 4))]
+        if self.rand.random() < 0.3:
+            words.append(str(self.rand.randint(1, 30)))
+        name = self.rand.choice((u' ', u'.', u'_')).join(words)
+        if not directory:
+            name += u'.' + self.rand.choice(_extensions)
+        return name
+
+    def files(self, server, nb_files):
+        """Yields the File objects of a server: a tree of directories with
+        about 20 entries each"""
+        directories = [u'']
+        produced = 0
+        self.total_size = 0
+        while produced < nb_files:
+            path = self.rand.choice(directories)
+            is_directory = (self.rand.random() < 0.05 and
+                            path.count(u'/') < 6)
+            name = self.name(is_directory)
+            if is_directory:
+                size = 0
+                directories.append(path + u'/' + name)
+            else:
+                size = int(self.rand.lognormvariate(15, 3)) % 2 ** 31
+            produced += 1
+            self.total_size += size
+            yield File(server=server, path=path, name=name,
+                       is_directory=is_directory, size=size,
+                       category=guess_file_category(name),
+                       extension=file_extension(name),
+                       content_key=content_key(name, size, is_directory),
+                       server_online=server.online)
+
+
+def generate_dataset(nb_servers, nb_files, seed=0, progress=None):
+    """Creates servers and files. The files are spread unevenly: some
+    servers are much bigger than others.
+
+    'progress' is called with the number of files written so far.
+    """
+    dataset = Dataset(seed)
+    weights = [dataset.rand.paretovariate(1.2) for i in xrange(nb_servers)]
+    total_weight = sum(weights)
+    written = 0
+    for i, weight in enumerate(weights):
+        if i == nb_servers - 1:
+            count = nb_files - written
+        else:
+            count = min(int(nb_files * weight / total_weight),
+                        nb_files - written)
+        server = FtpServer(address=_address(i), name=u'Generated %d' % i,
+                           online=dataset.rand.random() < 0.8,
+                           last_indexed=timezone.now())
+        server.save()
+        files = dataset.files(server, count)
+        if is_sharded():
+            write_shard(server, files)
+        else:
+            batch = []
+            content_keys = set()
+            for f in files:
+                batch.append(f)
+                content_keys.add(f.content_key)
+                if len(batch) == INSERT_BATCH:
+                    with transaction.commit_on_success():
+                        File.objects.bulk_create(batch)
+                    batch = []
+            with transaction.commit_on_success():
+                File.objects.bulk_create(batch)
+            File.objects.update_first_copies(content_keys)
+        written += count
+        server.size = dataset.total_size
+        server.save()
+        if progress is not None:
+            progress(written)
+    return dataset
+
+
+def generated_servers():
+    prefix = '%d.%d.' % FIRST_ADDRESS[:2]
+    return list(FtpServer.objects.filter(address__startswith=prefix)
+                .values_list('address', flat=True))
+
+
+def sample_urls(dataset, count):
+    """URLs of each endpoint to request, picked among the generated data"""
+    urls = dict(index=['/'] * count, server=[], search=[], download=[])
+    servers = generated_servers()
+    if not servers:
+        return urls
+    for i in xrange(count):
+        address = dataset.rand.choice(servers)
+        urls['server'].append(u'/server/%s' % address)
+        urls['search'].append(
+                u'/search/?' + urllib.urlencode({'query': dataset.word()}))
+    if not is_sharded():
+        bounds = (File.objects.filter(server__in=servers)
+                  .aggregate(first=Min('id'), last=Max('id')))
+        if bounds['first'] is None:
+            return urls
+    for i in xrange(count):
+        address = dataset.rand.choice(servers)
+        if is_sharded():
+            files = (ShardQuery().filter(is_directory=False)
+                     .values_list(address, 'path', 'name', limit=100))
+            if not files:
+                continue
+            path, name = dataset.rand.choice(files)
+        else:
+            # ORDER BY RANDOM() would scan the whole table
+            first_id = dataset.rand.randint(bounds['first'], bounds['last'])
+            f = (File.objects.filter(id__gte=first_id, is_directory=False)
+                 .order_by('id').select_related('server')[:1])
+            if not f:
+                continue
+            address, path, name = f[0].server.address, f[0].path, f[0].name
+        urls['download'].append(u'/go/%s%s/%s' % (address, path, name))
+    return urls
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+_timing_queries = re.compile(r'desc="([0-9]+) queries"')
+
+
+class _TestClientDriver(object):
+    """Requests the views in this process, counting the queries"""
+    def __init__(self):
+        self.client = Client()
+
+    def get(self, url):
+        debug_cursor = connection.use_debug_cursor
+        connection.use_debug_cursor = True
+        try:
+            response = self.client.get(url)
+            # The list of queries is emptied when a request starts
+            return response.status_code, len(connection.queries)
+        finally:
+            connection.use_debug_cursor = debug_cursor
+
+
+class _HttpDriver(object):
+    """Requests a running server; the queries are only known if it sends
+    the Server-Timing header (see yoppi.ftp.profiling)"""
+    class _NoRedirect(urllib2.HTTPRedirectHandler):
+        def redirect_request(self, *args, **kwargs):
+            return None
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+        self.opener = urllib2.build_opener(self._NoRedirect)
+
+    def get(self, url):
+        try:
+            response = self.opener.open(
+                    self.base_url + urllib.quote(url.encode('utf-8'), '/?=&%'))
+            status = response.getcode()
+        except urllib2.HTTPError, e:
+            response = e
+            status = e.code
+        m = _timing_queries.search(response.info().get('Server-Timing', ''))
+        response.read()
+        return status, int(m.group(1)) if m else None
+
+
+def run_load_test(urls, base_url=None):
+    """Requests the URLs of each endpoint and returns the statistics"""
+    if base_url:
+        driver = _HttpDriver(base_url)
+    else:
+        driver = _TestClientDriver()
+    results = {}
+    for endpoint, endpoint_urls in sorted(urls.iteritems()):
+        latencies = []
+        queries = []
+        errors = 0
+        start = time.time()
+        for url in endpoint_urls:
+            request_start = time.time()
+            status, nb_queries = driver.get(url)
+            latencies.append(time.time() - request_start)
+            if status >= 400:
+                errors += 1
+            if nb_queries is not None:
+                queries.append(nb_queries)
+        duration = time.time() - start
+        if not latencies:
+            continue
+        results[endpoint] = dict(
+                requests=len(latencies), errors=errors,
+                throughput=len(latencies) / duration if duration else None,
+                p50_ms=percentile(latencies, 0.5) * 1000,
+                p99_ms=percentile(latencies, 0.99) * 1000,
+                queries=(float(sum(queries)) / len(queries)
+                         if queries else None))
+    return results
+
+
+def save_results(results, filename):
+    with open(filename, 'w') as fp:
+        json.dump(results, fp, indent=2, sort_keys=True)
+
+
+def load_results(filename):
+    with open(filename) as fp:
+        return json.load(fp)
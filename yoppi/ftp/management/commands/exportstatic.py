@@ -0,0 +1,31 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.translation import pgettext_lazy, ugettext
+
+from yoppi.ftp.export import export_site
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--force',
+            action='store_true',
+            dest='force',
+            default=False,
+            help=pgettext_lazy(u"'exportstatic' command",
+                               u"Render all the servers, even those that "
+                               "haven't changed")),
+        )
+    args = pgettext_lazy(u"args for 'exportstatic' command",
+                         u"<output_dir>")
+    help = pgettext_lazy(u"help for 'exportstatic' command",
+                         u"write the browsing pages as static HTML files, to "
+                         "be served by the web server")
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError(ugettext(u"Expected the output directory"))
+        exported = export_site(args[0], options['force'])
+        if int(options['verbosity']) > 0:
+            self.stdout.write(ugettext(u"%d servers exported\n") %
+                              len(exported))
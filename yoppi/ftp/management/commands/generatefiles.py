@@ -0,0 +1,46 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.utils.translation import pgettext_lazy, ugettext
+
+from yoppi.ftp.loadtest import generate_dataset
+
+
+class Command(NoArgsCommand):
+    option_list = NoArgsCommand.option_list + (
+        make_option('--servers',
+            action='store',
+            type='int',
+            dest='servers',
+            default=1000,
+            help=pgettext_lazy(u"'generatefiles' command",
+                               u"Number of servers to create")),
+        make_option('--files',
+            action='store',
+            type='int',
+            dest='files',
+            default=10000000,
+            help=pgettext_lazy(u"'generatefiles' command",
+                               u"Total number of files to create")),
+        make_option('--seed',
+            action='store',
+            type='int',
+            dest='seed',
+            default=0,
+            help=pgettext_lazy(u"'generatefiles' command",
+                               u"Seed of the random generator, use the same "
+                               "one with 'loadtest'")),
+        )
+    help = pgettext_lazy(u"help for 'generatefiles' command",
+                         u"fill the database with generated servers and "
+                         "files, to test the website at scale")
+
+    def handle_noargs(self, **options):
+        verbose = int(options['verbosity']) > 0
+
+        def progress(written):
+            if verbose:
+                self.stdout.write(ugettext(u"%d files written\n") % written)
+
+        generate_dataset(options['servers'], options['files'],
+                         options['seed'], progress)
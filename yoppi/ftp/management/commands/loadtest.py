@@ -0,0 +1,86 @@
+from optparse import make_option
+
+from django.core.management.base import CommandError, NoArgsCommand
+from django.utils.translation import pgettext_lazy, ugettext
+
+from yoppi.ftp.loadtest import Dataset, generated_servers, load_results, \
+        run_load_test, sample_urls, save_results
+
+
+class Command(NoArgsCommand):
+    option_list = NoArgsCommand.option_list + (
+        make_option('--requests',
+            action='store',
+            type='int',
+            dest='requests',
+            default=100,
+            help=pgettext_lazy(u"'loadtest' command",
+                               u"Number of requests for each page")),
+        make_option('--seed',
+            action='store',
+            type='int',
+            dest='seed',
+            default=0,
+            help=pgettext_lazy(u"'loadtest' command",
+                               u"Seed given to 'generatefiles'")),
+        make_option('--url',
+            action='store',
+            dest='url',
+            default=None,
+            help=pgettext_lazy(u"'loadtest' command",
+                               u"Address of a running website to test, "
+                               "instead of calling the views directly")),
+        make_option('--output',
+            action='store',
+            dest='output',
+            default=None,
+            help=pgettext_lazy(u"'loadtest' command",
+                               u"Save the results in this JSON file")),
+        make_option('--compare',
+            action='store',
+            dest='compare',
+            default=None,
+            help=pgettext_lazy(u"'loadtest' command",
+                               u"Compare with the results saved in this "
+                               "file")),
+        )
+    help = pgettext_lazy(u"help for 'loadtest' command",
+                         u"measure the response times of the website on the "
+                         "data created by 'generatefiles'")
+
+    def handle_noargs(self, **options):
+        if not generated_servers():
+            raise CommandError(ugettext(u"Run 'generatefiles' first"))
+        previous = None
+        if options['compare']:
+            previous = load_results(options['compare'])
+
+        dataset = Dataset(options['seed'])
+        urls = sample_urls(dataset, options['requests'])
+        results = run_load_test(urls, options['url'])
+
+        self.stdout.write(u"%-10s %8s %8s %10s %10s %8s\n" % (
+                ugettext(u"page"), ugettext(u"req/s"), ugettext(u"errors"),
+                ugettext(u"p50 (ms)"), ugettext(u"p99 (ms)"),
+                ugettext(u"queries")))
+        for endpoint, result in sorted(results.iteritems()):
+            self.stdout.write(u"%-10s %8.1f %8d %10.1f %10.1f %8s\n" % (
+                    endpoint, result['throughput'] or 0, result['errors'],
+                    result['p50_ms'], result['p99_ms'],
+                    u'-' if result['queries'] is None
+                    else u'%.1f' % result['queries']))
+            old = previous and previous.get(endpoint)
+            if old:
+                self.stdout.write(u"%-10s %8s %8s %+9.0f%% %+9.0f%%\n" % (
+                        u'', u'', u'',
+                        _change(old['p50_ms'], result['p50_ms']),
+                        _change(old['p99_ms'], result['p99_ms'])))
+
+        if options['output']:
+            save_results(results, options['output'])
+
+
+def _change(old, new):
+    if not old:
+        return 0
+    return (new - old) * 100.0 / old
@@ -0,0 +1,101 @@
+"""Per-server filters of the indexed paths, used to answer /go/ redirects
+without querying the database.
+"""
+import hashlib
+import math
+import struct
+
+from yoppi.ftp.datafiles import DataFileCache, atomic_write, data_path, \
+        remove_data_file
+from yoppi.ftp.shards import ShardQuery, is_sharded
+
+
+class BloomFilter(object):
+    """Set membership with false positives but no false negatives"""
+    _header = struct.Struct('<QI')
+
+    def __init__(self, nbits, nhashes, bits=None):
+        self.nbits = nbits
+        self.nhashes = nhashes
+        if bits is None:
+            bits = bytearray((nbits + 7) // 8)
+        self.bits = bits
+
+    @classmethod
+    def for_capacity(cls, capacity, fp_rate):
+        """Sizes a filter for 'capacity' keys and the wanted false positive
+        rate"""
+        capacity = max(capacity, 1)
+        nbits = int(math.ceil(-capacity * math.log(fp_rate) /
+                              math.log(2) ** 2))
+        nhashes = max(1, int(round(nbits / float(capacity) * math.log(2))))
+        return cls(nbits, nhashes)
+
+    def _positions(self, key):
+        # Double hashing: the k positions are h1 + i * h2
+        h1, h2 = struct.unpack('<QQ',
+                               hashlib.md5(key.encode('utf-8')).digest())
+        for i in xrange(self.nhashes):
+            yield (h1 + i * h2) % self.nbits
+
+    def add(self, key):
+        for pos in self._positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, key):
+        for pos in self._positions(key):
+            if not self.bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+    def dumps(self):
+        return self._header.pack(self.nbits, self.nhashes) + str(self.bits)
+
+    @classmethod
+    def loads(cls, data):
+        nbits, nhashes = cls._header.unpack_from(data)
+        return cls(nbits, nhashes, bytearray(data[cls._header.size:]))
+
+
+def _filter_file(address):
+    return 'paths-%s.bloom' % address
+
+
+# Bytes of filters kept in memory; at 0.1% false positives, a filter takes
+# about 1.8 bytes per path
+PATH_FILTERS_CACHE_SIZE = 64 * 1024 * 1024
+
+_path_filters = DataFileCache(BloomFilter.loads, PATH_FILTERS_CACHE_SIZE)
+
+
+def get_path_filter(address):
+    """Returns the filter of the paths of a server, or None"""
+    return _path_filters.get(_filter_file(address))
+
+
+def build_path_filter(server, fp_rate=0.001):
+    """Writes the filter of the indexed paths of a server
+
+    Returns the number of paths, or None if YOPPI_DATA_DIR is not set.
+    """
+    if data_path(_filter_file(server.address)) is None:
+        return None
+    if is_sharded():
+        paths = ShardQuery().values_list(server.address, 'path', 'name')
+        count = len(paths)
+    else:
+        paths = (server.files.visible()
+                 .values_list('path', 'name'))
+        count = paths.count()
+        paths = paths.iterator()
+    bloom = BloomFilter.for_capacity(count, fp_rate)
+    nb_paths = 0
+    for path, name in paths:
+        bloom.add(path + u'/' + name)
+        nb_paths += 1
+    atomic_write(_filter_file(server.address), bloom.dumps())
+    return nb_paths
+
+
+def remove_path_filter(address):
+    remove_data_file(_filter_file(address))
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        # Adding field 'File.category'
+        db.add_column('ftp_file', 'category',
+                      self.gf('django.db.models.fields.PositiveSmallIntegerField')(default=0, db_index=True),
+                      keep_default=False)
+
+        # Adding field 'File.extension'
+        db.add_column('ftp_file', 'extension',
+                      self.gf('django.db.models.fields.CharField')(default='', max_length=10, db_index=True, blank=True),
+                      keep_default=False)
+
+
+    def backwards(self, orm):
+        # Deleting field 'File.category'
+        db.delete_column('ftp_file', 'category')
+
+        # Deleting field 'File.extension'
+        db.delete_column('ftp_file', 'extension')
+
+
+    models = {
+        'ftp.file': {
+            'Meta': {'object_name': 'File'},
+            'category': ('django.db.models.fields.PositiveSmallIntegerField', [], {'default': '0', 'db_index': 'True'}),
+            'extension': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '10', 'db_index': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'is_directory': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '200'}),
+            'path': ('django.db.models.fields.CharField', [], {'db_index': 'True', 'max_length': '300', 'blank': 'True'}),
+            'server': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'files'", 'to': "orm['ftp.FtpServer']"}),
+            'size': ('django.db.models.fields.IntegerField', [], {})
+        },
+        'ftp.ftpserver': {
+            'Meta': {'object_name': 'FtpServer'},
+            'address': ('django.db.models.fields.CharField', [], {'max_length': '15', 'primary_key': 'True'}),
+            'indexing': ('django.db.models.fields.DateTimeField', [], {'default': 'None', 'null': 'True'}),
+            'last_indexed': ('django.db.models.fields.DateTimeField', [], {'default': 'None', 'null': 'True'}),
+            'last_online': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime(2026, 10, 19, 0, 0)'}),
+            'name': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '200', 'blank': 'True'}),
+            'online': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'size': ('django.db.models.fields.IntegerField', [], {'default': '0'})
+        }
+    }
+
+    complete_apps = ['ftp']
\ No newline at end of file
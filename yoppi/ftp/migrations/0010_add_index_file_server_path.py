@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        # Adding index on 'File', fields ['server', 'path'], for the searches
+        # in a directory and its subdirectories
+        db.create_index('ftp_file', ['server_id', 'path'])
+
+
+    def backwards(self, orm):
+        # Removing index on 'File', fields ['server', 'path']
+        db.delete_index('ftp_file', ['server_id', 'path'])
+
+
+    models = {
+        'ftp.file': {
+            'Meta': {'object_name': 'File'},
+            'added_in': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'category': ('django.db.models.fields.PositiveSmallIntegerField', [], {'default': '0', 'db_index': 'True'}),
+            'content_key': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '40', 'db_index': 'True', 'blank': 'True'}),
+            'extension': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '10', 'db_index': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'is_directory': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '200'}),
+            'path': ('django.db.models.fields.CharField', [], {'db_index': 'True', 'max_length': '300', 'blank': 'True'}),
+            'removed_in': ('django.db.models.fields.PositiveIntegerField', [], {'default': 'None', 'null': 'True'}),
+            'server': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'files'", 'to': "orm['ftp.FtpServer']"}),
+            'size': ('django.db.models.fields.IntegerField', [], {})
+        },
+        'ftp.filechange': {
+            'Meta': {'object_name': 'FileChange'},
+            'category': ('django.db.models.fields.PositiveSmallIntegerField', [], {'default': '0'}),
+            'date': ('django.db.models.fields.DateTimeField', [], {'db_index': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'is_directory': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'kind': ('django.db.models.fields.PositiveSmallIntegerField', [], {'db_index': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '200'}),
+            'path': ('django.db.models.fields.CharField', [], {'max_length': '300', 'blank': 'True'}),
+            'server': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'changes'", 'to': "orm['ftp.FtpServer']"}),
+            'size': ('django.db.models.fields.IntegerField', [], {})
+        },
+        'ftp.ftpserver': {
+            'Meta': {'object_name': 'FtpServer'},
+            'address': ('django.db.models.fields.CharField', [], {'max_length': '15', 'primary_key': 'True'}),
+            'generation': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'indexing': ('django.db.models.fields.DateTimeField', [], {'default': 'None', 'null': 'True'}),
+            'last_indexed': ('django.db.models.fields.DateTimeField', [], {'default': 'None', 'null': 'True'}),
+            'last_online': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime(2026, 10, 19, 0, 0)'}),
+            'name': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '200', 'blank': 'True'}),
+            'online': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'size': ('django.db.models.fields.IntegerField', [], {'default': '0'})
+        }
+    }
+
+    complete_apps = ['ftp']
\ No newline at end of file
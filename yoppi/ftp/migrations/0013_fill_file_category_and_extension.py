@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+import datetime
+import mimetypes
+import os
+from south.db import db
+from south.v2 import DataMigration
+from django.db import models
+from django.db.models import Count, F, Q, Sum
+
+
+# Number of files updated by each query
+CHUNK_SIZE = 500
+
+# How yoppi.ftp.models guessed the category and extension of a file when
+# this migration was written
+CATEGORY_OTHER = 0
+CATEGORY_VIDEO = 1
+CATEGORY_AUDIO = 2
+MIMETYPE_CATEGORIES = {
+    'video': CATEGORY_VIDEO,
+    'audio': CATEGORY_AUDIO,
+    'application/x-flac': CATEGORY_AUDIO,
+}
+MAX_EXTENSION_LENGTH = 10
+
+_mimetypes = mimetypes.MimeTypes()
+_mimetypes.add_type('video/x-matroska', '.mkv')
+
+
+def guess_file_category(filename):
+    type, encoding = _mimetypes.guess_type(filename)
+    if not type:
+        return CATEGORY_OTHER
+    try:
+        return MIMETYPE_CATEGORIES[type]
+    except KeyError:
+        general, specific = type.split('/')
+        return MIMETYPE_CATEGORIES.get(general, CATEGORY_OTHER)
+
+
+def file_extension(filename):
+    ext = os.path.splitext(filename)[1][1:].lower()
+    if len(ext) > MAX_EXTENSION_LENGTH:
+        return u''
+    return ext
+
+
+class Migration(DataMigration):
+
+    def forwards(self, orm):
+        # The columns added by 0006 were left to their defaults until the
+        # next indexing of each server; compute them from the names like the
+        # indexer does
+        files = (orm['ftp.File'].objects.filter(is_directory=False)
+                 .values_list('id', 'name').order_by('id'))
+        pending = {}
+        for id, name in files.iterator():
+            key = guess_file_category(name), file_extension(name)
+            if key == (CATEGORY_OTHER, u''):
+                continue
+            ids = pending.setdefault(key, [])
+            ids.append(id)
+            if len(ids) >= CHUNK_SIZE:
+                self._update(orm, key, pending.pop(key))
+        for key, ids in pending.iteritems():
+            self._update(orm, key, ids)
+
+        # The statistics are built from these columns: count the files of
+        # the current generation of each server again
+        generation = F('server__generation')
+        rows = (orm['ftp.File'].objects
+                .filter(Q(removed_in=None) | Q(removed_in__gt=generation),
+                        added_in__lte=generation, is_directory=False)
+                .values('server', 'category', 'extension')
+                .annotate(nb_files=Count('id'), size=Sum('size'))
+                .order_by())
+        FileStatistics = orm['ftp.FileStatistics']
+        FileStatistics.objects.all().delete()
+        FileStatistics.objects.bulk_create([
+                FileStatistics(server_id=row['server'],
+                               category=row['category'],
+                               extension=row['extension'],
+                               nb_files=row['nb_files'],
+                               size=row['size'] or 0)
+                for row in rows])
+
+    @staticmethod
+    def _update(orm, key, ids):
+        category, extension = key
+        orm['ftp.File'].objects.filter(id__in=ids).update(
+                category=category, extension=extension)
+
+    def backwards(self, orm):
+        # The columns are deleted by 0006
+        pass
+
+    models = {
+        'ftp.file': {
+            'Meta': {'object_name': 'File'},
+            'added_in': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'category': ('django.db.models.fields.PositiveSmallIntegerField', [], {'default': '0', 'db_index': 'True'}),
+            'content_key': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '40', 'db_index': 'True', 'blank': 'True'}),
+            'extension': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '10', 'db_index': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'is_directory': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '200'}),
+            'path': ('django.db.models.fields.CharField', [], {'db_index': 'True', 'max_length': '300', 'blank': 'True'}),
+            'removed_in': ('django.db.models.fields.PositiveIntegerField', [], {'default': 'None', 'null': 'True'}),
+            'server': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'files'", 'to': "orm['ftp.FtpServer']"}),
+            'server_online': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'size': ('django.db.models.fields.IntegerField', [], {})
+        },
+        'ftp.filechange': {
+            'Meta': {'object_name': 'FileChange'},
+            'category': ('django.db.models.fields.PositiveSmallIntegerField', [], {'default': '0'}),
+            'date': ('django.db.models.fields.DateTimeField', [], {'db_index': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'is_directory': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'kind': ('django.db.models.fields.PositiveSmallIntegerField', [], {'db_index': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '200'}),
+            'path': ('django.db.models.fields.CharField', [], {'max_length': '300', 'blank': 'True'}),
+            'server': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'changes'", 'to': "orm['ftp.FtpServer']"}),
+            'size': ('django.db.models.fields.IntegerField', [], {})
+        },
+        'ftp.filestatistics': {
+            'Meta': {'unique_together': "(('server', 'category', 'extension'),)", 'object_name': 'FileStatistics'},
+            'category': ('django.db.models.fields.PositiveSmallIntegerField', [], {'default': '0'}),
+            'extension': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '10', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'nb_files': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'server': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'statistics'", 'to': "orm['ftp.FtpServer']"}),
+            'size': ('django.db.models.fields.BigIntegerField', [], {'default': '0'})
+        },
+        'ftp.ftpserver': {
+            'Meta': {'object_name': 'FtpServer'},
+            'address': ('django.db.models.fields.CharField', [], {'max_length': '15', 'primary_key': 'True'}),
+            'generation': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'indexing': ('django.db.models.fields.DateTimeField', [], {'default': 'None', 'null': 'True'}),
+            'last_indexed': ('django.db.models.fields.DateTimeField', [], {'default': 'None', 'null': 'True'}),
+            'last_online': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime(2026, 10, 19, 0, 0)'}),
+            'name': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '200', 'blank': 'True'}),
+            'online': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'size': ('django.db.models.fields.IntegerField', [], {'default': '0'})
+        }
+    }
+
+    complete_apps = ['ftp']
+    symmetrical = True
@@ -1,9 +1,31 @@
+import hashlib
 import mimetypes
-from django.db import models
+import os
+from django.core.urlresolvers import get_script_prefix, reverse
+from django.db import models, transaction
+from django.db.models import Min, Q
 from django.utils import timezone
+from django.utils.encoding import iri_to_uri
 from django.utils.translation import ugettext, ugettext_lazy
 
 
+_url_prefixes = {}
+
+
+def url_prefix(view, address):
+    """The URL of the root of a server in the 'server' or 'download' view.
+
+    The URL of a path is this prefix followed by the path, so long listings
+    don't have to call reverse() for each row.
+    """
+    key = get_script_prefix(), view, address
+    try:
+        return _url_prefixes[key]
+    except KeyError:
+        prefix = _url_prefixes[key] = reverse(view, args=(address, ''))
+        return prefix
+
+
 class FtpServer(models.Model):
     address = models.CharField(
             "server's IP address",
@@ -20,6 +42,11 @@ class FtpServer(models.Model):
             "indexing start date or null", null=True, default=None)
     last_indexed = models.DateTimeField(
             "last indexing date", null=True, default=None)
+    # The files shown to users. The indexer adds the files of the next
+    # generation and marks those that disappeared, then switches to it by
+    # updating this field and File.current in one transaction, so readers
+    # never see a half-updated listing
+    generation = models.PositiveIntegerField(default=0)
 
     _times = (
         (1, ugettext_lazy(u'seconds')),
@@ -49,9 +76,8 @@ class FtpServer(models.Model):
     def __unicode__(self):
         return self.address
 
-    @models.permalink
     def get_absolute_url(self):
-        return ('yoppi.ftp.views.server', (self.address, ''))
+        return url_prefix('yoppi.ftp.views.server', self.address)
 
     def _seconds_since_lastonline(self):
         td = timezone.now() - self.last_online
@@ -63,48 +89,230 @@ class FtpServer(models.Model):
     def icon(self):
         return 'folder-open' if self.online else 'ban-circle'
 
+    def update_files_online(self):
+        """Copies 'online' to the files of the server, after it changed"""
+        updated = (self.files.exclude(server_online=self.online)
+                   .update(server_online=self.online))
+        if updated:
+            # Its copies now count, or no longer do
+            File.objects.update_first_copies(
+                    self.files.visible().values_list('content_key',
+                                                     flat=True))
+        return updated
+
 
 mimetypes.add_type('video/x-matroska', '.mkv')
 
-ICONS = {
-    'video': 'film',
-    'audio': 'music',
-    'application/x-flac': 'music',
+CATEGORY_OTHER = 0
+CATEGORY_VIDEO = 1
+CATEGORY_AUDIO = 2
+
+# Name used in URLs, readable name and icon of each category
+CATEGORIES = (
+    (CATEGORY_OTHER, 'other', ugettext_lazy(u'Other files'), 'file'),
+    (CATEGORY_VIDEO, 'video', ugettext_lazy(u'Videos'), 'film'),
+    (CATEGORY_AUDIO, 'audio', ugettext_lazy(u'Audio'), 'music'),
+)
+CATEGORY_KEYS = dict((key, cat) for cat, key, label, icon in CATEGORIES)
+CATEGORY_ICONS = dict((cat, icon) for cat, key, label, icon in CATEGORIES)
+
+# Maps mimetypes, or their general part, to a category
+MIMETYPE_CATEGORIES = {
+    'video': CATEGORY_VIDEO,
+    'audio': CATEGORY_AUDIO,
+    'application/x-flac': CATEGORY_AUDIO,
 }
 
-def guess_file_icon(filename):
+MAX_EXTENSION_LENGTH = 10
+
+
+def guess_file_category(filename):
     type, encoding = mimetypes.guess_type(filename)
     if not type:
-        return 'file'
+        return CATEGORY_OTHER
     try:
-        return ICONS[type]
+        return MIMETYPE_CATEGORIES[type]
     except KeyError:
         general, specific = type.split('/')
-        return ICONS.get(general, 'file')
+        return MIMETYPE_CATEGORIES.get(general, CATEGORY_OTHER)
+
+
+def guess_file_icon(filename):
+    return CATEGORY_ICONS[guess_file_category(filename)]
 
 
-class File(models.Model):
+def file_extension(filename):
+    """Returns the lowercase extension of a file name, without the dot.
+
+    Overly long extensions are most likely not extensions at all, and are
+    ignored.
+    """
+    ext = os.path.splitext(filename)[1][1:].lower()
+    if len(ext) > MAX_EXTENSION_LENGTH:
+        return u''
+    return ext
+
+
+def content_key(name, size, is_directory):
+    """Identifies a file by its normalized name and size.
+
+    Copies of the same file on different servers share the same key, which is
+    used to collapse them in the search results.
+    """
+    normalized = u' '.join(name.lower().split())
+    key = u'%d/%d/%s' % (is_directory, size, normalized)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def under_path(path):
+    """Condition on File.path for the files in a directory and its
+    subdirectories.
+
+    The subdirectories are found with a range, which the index on
+    (server, path) answers directly: '0' comes right after '/'. This relies
+    on the database comparing strings character by character, as SQLite
+    does, or PostgreSQL with the C collation.
+    """
+    return Q(path=path) | Q(path__gte=path + u'/', path__lt=path + u'0')
+
+
+class FileEntryMixin(object):
+    """Links and icon of a file or directory of a server, for the models
+    with 'server', 'path', 'name', 'is_directory' and 'category' fields"""
+    def fullpath(self):
+        return self.path + u"/" + self.name
+
+    def get_absolute_url(self):
+        # server_id is the address, no need to fetch the server
+        if self.is_directory:
+            prefix = url_prefix('yoppi.ftp.views.server', self.server_id)
+        else:
+            prefix = url_prefix('yoppi.ftp.views.download', self.server_id)
+        return iri_to_uri(prefix + self.fullpath())
+
+    def icon(self):
+        if self.is_directory:
+            return 'folder-open'
+        else:
+            return CATEGORY_ICONS.get(self.category, 'file')
+
+
+class FileManager(models.Manager):
+    # Number of content keys updated by each query of update_first_copies()
+    FIRST_COPIES_CHUNK = 500
+
+    def visible(self):
+        """The files in the current generation of their server"""
+        return self.filter(current=True)
+
+    def update_first_copies(self, content_keys):
+        """Marks one visible copy on an online server of each content key as
+        its first copy, which the collapsed searches show.
+
+        Call it with the keys of the files added or removed, or whose
+        server went online or offline. The oldest copy is kept first while
+        it stays available.
+        """
+        content_keys = sorted(set(content_keys) - set([u'']))
+        chunk_size = self.FIRST_COPIES_CHUNK
+        for i in xrange(0, len(content_keys), chunk_size):
+            chunk = content_keys[i:i + chunk_size]
+            with transaction.commit_on_success():
+                first_ids = [
+                        row['first_id'] for row in
+                        self.visible()
+                        .filter(content_key__in=chunk, server_online=True)
+                        .values('content_key')
+                        .annotate(first_id=Min('id'))
+                        .order_by()]
+                (self.filter(content_key__in=chunk, first_copy=True)
+                 .exclude(id__in=first_ids).update(first_copy=False))
+                (self.filter(id__in=first_ids, first_copy=False)
+                 .update(first_copy=True))
+
+
+class File(FileEntryMixin, models.Model):
     server = models.ForeignKey(FtpServer, related_name='files')
     name = models.CharField(max_length=200)
+    # Also indexed with the server, see migration 0010 and under_path()
     path = models.CharField(max_length=300, blank=True, db_index=True) # Never ends with '/'
     is_directory = models.BooleanField()
     size = models.IntegerField()
+    # Computed from the name by the indexer, so that they can be searched on
+    category = models.PositiveSmallIntegerField(
+            default=CATEGORY_OTHER, db_index=True)
+    extension = models.CharField(
+            max_length=MAX_EXTENSION_LENGTH, blank=True, default='',
+            db_index=True)
+    content_key = models.CharField(
+            max_length=40, blank=True, default='', db_index=True)
+    # The file exists in the generations added_in <= g < removed_in of its
+    # server (see FtpServer.generation)
+    added_in = models.PositiveIntegerField(default=0)
+    removed_in = models.PositiveIntegerField(null=True, default=None)
+    # Whether the server's generation is in that range, so that readers
+    # don't have to join FtpServer; updated when the indexer switches to a
+    # new generation
+    current = models.BooleanField(default=True)
+    # One of the copies with the same content key, which stands for all of
+    # them in the collapsed searches (see FileManager.update_first_copies())
+    first_copy = models.BooleanField(default=False)
+    # Copy of server.online, so that searches can be sorted and filtered on
+    # it without a join (see migration 0011 for the index); kept up to date
+    # by FtpServer.update_files_online()
+    server_online = models.BooleanField(default=True)
+
+    objects = FileManager()
 
     def __unicode__(self):
         return u"%s:%s/%s" % (unicode(self.server), self.path, self.name)
 
-    @models.permalink
-    def get_absolute_url(self):
-        if self.is_directory:
-            return ('yoppi.ftp.views.server', (self.server.address, self.fullpath()))
-        else:
-            return ('yoppi.ftp.views.download', (self.server.address, self.fullpath()))
 
-    def fullpath(self):
-        return self.path + u"/" + self.name
+class FileChange(FileEntryMixin, models.Model):
+    """An entry of the log of what each indexing changed.
 
-    def icon(self):
-        if self.is_directory:
-            return 'folder-open'
-        else:
-            return guess_file_icon(self.name)
+    Entries are only ever appended, so their ids follow the order of the
+    changes: clients can follow the log by asking for the entries after the
+    last id they saw.
+    """
+    ADDED = 1
+    REMOVED = 2
+    CHANGED = 3
+    KINDS = (
+        (ADDED, 'added'),
+        (REMOVED, 'removed'),
+        (CHANGED, 'changed'),
+    )
+
+    server = models.ForeignKey(FtpServer, related_name='changes')
+    date = models.DateTimeField(db_index=True)
+    kind = models.PositiveSmallIntegerField(choices=KINDS, db_index=True)
+    name = models.CharField(max_length=200)
+    path = models.CharField(max_length=300, blank=True)
+    is_directory = models.BooleanField()
+    size = models.IntegerField()
+    category = models.PositiveSmallIntegerField(default=CATEGORY_OTHER)
+
+    @classmethod
+    def from_file(cls, kind, f, date):
+        return cls(server_id=f.server_id, date=date, kind=kind, name=f.name,
+                   path=f.path, is_directory=f.is_directory, size=f.size,
+                   category=f.category)
+
+
+class FileStatistics(models.Model):
+    """Number and size of the files of a server with a category and
+    extension, kept up to date by the indexer (see yoppi.ftp.statistics) so
+    that the statistics page doesn't go through the File table.
+
+    Directories are not counted.
+    """
+    server = models.ForeignKey(FtpServer, related_name='statistics')
+    category = models.PositiveSmallIntegerField(default=CATEGORY_OTHER)
+    extension = models.CharField(
+            max_length=MAX_EXTENSION_LENGTH, blank=True, default='')
+    nb_files = models.IntegerField(default=0)
+    size = models.BigIntegerField(default=0)
+
+    class Meta:
+        unique_together = ('server', 'category', 'extension')
@@ -0,0 +1,258 @@
+import array
+import bisect
+import collections
+import datetime
+from itertools import chain
+import re
+import time
+
+from django.db.models import Count
+from django.utils import timezone
+
+from yoppi.ftp.datafiles import DataFileCache, atomic_write, data_path
+from yoppi.ftp.models import FtpServer, File
+from yoppi.ftp.shards import ShardQuery, is_sharded
+
+
+NAME_INDEX_FILE = 'names.idx'
+
+_token_regex = re.compile(r'[^\W_]+', re.UNICODE)
+
+
+def tokenize(name):
+    """Splits a file name into lowercase words."""
+    return _token_regex.findall(name.lower())
+
+
+def _bigrams(word):
+    """The pairs of letters of a word, with its start and end as '^' and '$'
+    """
+    padded = u'^%s$' % word
+    return set(padded[i:i + 2] for i in xrange(len(padded) - 1))
+
+
+def edit_distance(a, b, limit=None):
+    """The number of insertions, deletions, substitutions and swaps of two
+    adjacent letters turning 'a' into 'b', or None if it is over 'limit'"""
+    before = None
+    previous = range(len(b) + 1)
+    for i in xrange(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in xrange(1, len(b) + 1):
+            current[j] = min(previous[j] + 1, current[j - 1] + 1,
+                             previous[j - 1] + (a[i - 1] != b[j - 1]))
+            if (i > 1 and j > 1 and
+                    a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]):
+                current[j] = min(current[j], before[j - 2] + 1)
+        if limit is not None and min(current) > limit:
+            return None
+        before, previous = previous, current
+    distance = previous[-1]
+    if limit is not None and distance > limit:
+        return None
+    return distance
+
+
+class NameIndex(object):
+    """Sorted array of the distinct words found in the file names, with the
+    number of files whose name has each one.
+
+    Completing a prefix is a binary search followed by a short scan. The
+    words are also joined in a single string, so that finding whether any
+    name contains a word is one substring search, and indexed by their pairs
+    of letters to suggest corrections of misspelled words.
+
+    'built' is the time the words were read from the database, as a UNIX
+    timestamp, or None if unknown.
+    """
+    def __init__(self, tokens, frequencies=None, built=None):
+        self.tokens = tokens
+        if frequencies is None:
+            frequencies = [0] * len(tokens)
+        self.frequencies = frequencies
+        self.built = built
+        self._text = u'\n'.join(tokens)
+        self._bigrams = None
+
+    @classmethod
+    def build(cls, names, built=None):
+        """'names' are file names, or (name, number of files) pairs"""
+        counts = collections.defaultdict(int)
+        for name in names:
+            if isinstance(name, tuple):
+                name, nb_files = name
+            else:
+                nb_files = 1
+            for token in set(tokenize(name)):
+                counts[token] += nb_files
+        tokens = sorted(counts)
+        return cls(tokens, [counts[token] for token in tokens], built)
+
+    def dumps(self):
+        lines = []
+        if self.built is not None:
+            lines.append(u'#%d' % self.built)
+        lines.extend(u'%s\t%d' % entry
+                     for entry in zip(self.tokens, self.frequencies))
+        return u'\n'.join(lines).encode('utf-8')
+
+    @classmethod
+    def loads(cls, data):
+        if not data:
+            return cls([])
+        lines = data.decode('utf-8').split(u'\n')
+        built = None
+        if lines[0].startswith(u'#'):
+            built = int(lines.pop(0)[1:])
+        tokens = []
+        frequencies = []
+        for line in lines:
+            # Files written before the frequencies were kept have none
+            token, sep, frequency = line.partition(u'\t')
+            tokens.append(token)
+            frequencies.append(int(frequency) if sep else 0)
+        return cls(tokens, frequencies, built)
+
+    def complete(self, prefix, limit=10):
+        prefix = prefix.lower()
+        if not prefix:
+            return []
+        i = bisect.bisect_left(self.tokens, prefix)
+        results = []
+        for token in self.tokens[i:i + limit]:
+            if not token.startswith(prefix):
+                break
+            results.append(token)
+        return results
+
+    def frequency(self, token):
+        """The number of files whose name has this word"""
+        i = bisect.bisect_left(self.tokens, token)
+        if i < len(self.tokens) and self.tokens[i] == token:
+            return self.frequencies[i]
+        return 0
+
+    def can_match(self, word):
+        """Whether a search for this word can find a name.
+
+        A word made of letters and digits only can only be found within one
+        word of a name; a word with separators can span several, so it is
+        always assumed to match.
+        """
+        word = word.lower()
+        if tokenize(word) != [word]:
+            return True
+        return word in self._text
+
+    def _index_bigrams(self):
+        index = collections.defaultdict(lambda: array.array('I'))
+        for i, token in enumerate(self.tokens):
+            for bigram in _bigrams(token):
+                index[bigram, len(token)].append(i)
+        return dict(index)
+
+    def suggest(self, word):
+        """The known word closest to a misspelled one, or None.
+
+        The candidates are the words of about the same length sharing enough
+        pairs of letters with it; the nearest one by edit distance wins, then
+        the one in most names.
+        """
+        word = word.lower()
+        if len(word) < 3:
+            return None
+        max_distance = 1 if len(word) <= 4 else 2
+        if self._bigrams is None:
+            self._bigrams = self._index_bigrams()
+        bigrams = _bigrams(word)
+        shared = collections.defaultdict(int)
+        for length in xrange(len(word) - max_distance,
+                             len(word) + max_distance + 1):
+            for bigram in bigrams:
+                for i in self._bigrams.get((bigram, length), ()):
+                    shared[i] += 1
+        # Each edit changes at most two pairs of letters
+        needed = max(1, len(bigrams) - 2 * max_distance)
+        best = None
+        for i, nb_shared in shared.iteritems():
+            if nb_shared < needed:
+                continue
+            token = self.tokens[i]
+            distance = edit_distance(word, token, max_distance)
+            if distance is None or distance == 0:
+                continue
+            key = distance, -self.frequencies[i], token
+            if best is None or key < best:
+                best = key
+        return best[2] if best is not None else None
+
+    def __len__(self):
+        return len(self.tokens)
+
+
+_name_indexes = DataFileCache(NameIndex.loads)
+
+
+def get_name_index():
+    """Returns the name index last written by the indexer."""
+    return _name_indexes.get(NAME_INDEX_FILE, NameIndex([]))
+
+
+def unknown_words(words):
+    """The words that no file name contains, according to the name index.
+
+    A search for any of them can only return nothing. The index only knows
+    the files indexed before it was built, so no word is reported while a
+    server has been indexed since.
+    """
+    index = get_name_index()
+    if index.built is None:
+        return []
+    unknown = [word for word in words if not index.can_match(word)]
+    if unknown:
+        built = datetime.datetime.fromtimestamp(index.built, timezone.utc)
+        if FtpServer.objects.filter(last_indexed__gt=built).exists():
+            return []
+    return unknown
+
+
+def suggest_query(query):
+    """The query with its unknown words replaced by the closest known ones,
+    or None if there is nothing to correct"""
+    index = get_name_index()
+    words = query.split()
+    changed = False
+    for i, word in enumerate(words):
+        if not index.can_match(word):
+            suggestion = index.suggest(word)
+            if suggestion is not None:
+                words[i] = suggestion
+                changed = True
+    if not changed:
+        return None
+    return u' '.join(words)
+
+
+def build_name_index():
+    """Rebuilds the name index from the database.
+
+    The frequencies are the number of visible files having each word.
+
+    Returns the number of distinct words, or None if YOPPI_DATA_DIR is not
+    set.
+    """
+    if data_path(NAME_INDEX_FILE) is None:
+        return None
+    built = int(time.time())
+    if is_sharded():
+        names = chain.from_iterable(
+                ShardQuery().values_list(address, 'name')
+                for address in FtpServer.objects.values_list('address',
+                                                             flat=True))
+        names = (name for name, in names)
+    else:
+        names = (File.objects.visible().values_list('name')
+                 .annotate(nb_files=Count('id')).order_by().iterator())
+    index = NameIndex.build(names, built)
+    atomic_write(NAME_INDEX_FILE, index.dumps())
+    return len(index)
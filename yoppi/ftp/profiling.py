@@ -0,0 +1,111 @@
+"""Measures where the time of each request goes.
+
+Enabled by the YOPPI_PROFILING setting. The database and template rendering
+times are sent in a Server-Timing header, and a sample of the requests is
+logged as JSON to the 'yoppi.ftp.profiling' logger. Requests that run the
+same query many times with different parameters, which usually means a
+related object is fetched for each row (a missing select_related()), are
+always logged.
+"""
+import json
+import logging
+import random
+import re
+import threading
+import time
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection
+from django.template.base import Template
+
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+
+_original_render = Template._render
+
+
+def _timed_render(self, context):
+    # Includes and parent templates are rendered from within the outer one
+    depth = getattr(_local, 'depth', 0)
+    _local.depth = depth + 1
+    start = time.time()
+    try:
+        return _original_render(self, context)
+    finally:
+        _local.depth = depth
+        if depth == 0 and hasattr(_local, 'render_time'):
+            _local.render_time += time.time() - start
+
+
+_literals = re.compile(r"'(?:[^']|'')*'|\b[0-9]+(?:\.[0-9]+)?\b")
+
+
+def normalize_query(sql):
+    """Replaces the literals in a query so that its executions with different
+    parameters look the same."""
+    return _literals.sub('?', sql)
+
+
+def repeated_queries(queries, threshold):
+    """The queries run at least 'threshold' times, with their count."""
+    counts = {}
+    for query in queries:
+        sql = normalize_query(query['sql'])
+        counts[sql] = counts.get(sql, 0) + 1
+    return sorted(((sql, count) for sql, count in counts.iteritems()
+                   if count >= threshold),
+                  key=lambda r: -r[1])
+
+
+class ProfilingMiddleware(object):
+    """See the module documentation. YOPPI_PROFILING is a dictionary:
+      SAMPLE_RATE       fraction of the requests that get logged
+      REPEATED_QUERIES  number of executions of a query that gets the request
+                        flagged
+    """
+    def __init__(self):
+        options = getattr(settings, 'YOPPI_PROFILING', None)
+        if options is None:
+            raise MiddlewareNotUsed
+        self.sample_rate = options.get('SAMPLE_RATE', 0.01)
+        self.repeated_queries = options.get('REPEATED_QUERIES', 10)
+        Template._render = _timed_render
+
+    def process_request(self, request):
+        request._profiling = dict(
+                start=time.time(), first_query=len(connection.queries),
+                debug_cursor=connection.use_debug_cursor)
+        connection.use_debug_cursor = True
+        _local.render_time = 0.0
+
+    def process_response(self, request, response):
+        state = getattr(request, '_profiling', None)
+        if state is None:
+            return response
+        total_time = time.time() - state['start']
+        render_time = _local.__dict__.pop('render_time', 0.0)
+        queries = connection.queries[state['first_query']:]
+        connection.use_debug_cursor = state['debug_cursor']
+        db_time = sum(float(q['time']) for q in queries)
+
+        response['Server-Timing'] = (
+                'db;dur=%.1f;desc="%d queries", tpl;dur=%.1f, '
+                'total;dur=%.1f' % (db_time * 1000, len(queries),
+                                    render_time * 1000, total_time * 1000))
+
+        repeated = repeated_queries(queries, self.repeated_queries)
+        if repeated or random.random() < self.sample_rate:
+            record = dict(
+                    method=request.method, path=request.path,
+                    status=response.status_code, queries=len(queries),
+                    db_ms=round(db_time * 1000, 1),
+                    render_ms=round(render_time * 1000, 1),
+                    total_ms=round(total_time * 1000, 1),
+                    repeated=[dict(sql=sql, count=count)
+                              for sql, count in repeated])
+            logger.log(logging.WARNING if repeated else logging.INFO,
+                       json.dumps(record))
+        return response
@@ -0,0 +1,294 @@
+"""Optional storage of the files in one SQLite database per server.
+
+When YOPPI_SHARD_DIR is set, the files are not kept in the File table: the
+indexer writes each server's files to a database of its own, which replaces
+the previous one in a single rename(). Browsing a server only opens its
+database, searches query all of them in parallel, and forgetting a server
+deletes a file.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import heapq
+import itertools
+import os
+import sqlite3
+
+from django.conf import settings
+
+from yoppi.ftp.models import File
+
+
+# Columns of the shard databases, and File fields they are read into
+COLUMNS = ('name', 'path', 'is_directory', 'size', 'category', 'extension',
+           'content_key')
+
+_schema = '''
+CREATE TABLE file (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    path TEXT NOT NULL,
+    is_directory INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    category INTEGER NOT NULL,
+    extension TEXT NOT NULL,
+    content_key TEXT NOT NULL
+);
+CREATE INDEX file_path ON file (path, name);
+'''
+
+# Number of shards searched at the same time
+SEARCH_WORKERS = 8
+# Most rows read from a shard at once while merging the results
+BATCH_SIZE = 500
+# Most matching files collapsed by a search, see group_files()
+MAX_GROUPED_FILES = 10000
+
+
+def shard_dir():
+    return getattr(settings, 'YOPPI_SHARD_DIR', None)
+
+
+def is_sharded():
+    return bool(shard_dir())
+
+
+def shard_path(address):
+    return os.path.join(shard_dir(), '%s.sqlite' % address)
+
+
+def write_shard(server, files):
+    """Replaces the database of a server with the given File objects."""
+    path = shard_path(server.address)
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    db = sqlite3.connect(tmp)
+    try:
+        db.executescript(_schema)
+        db.executemany(
+                'INSERT INTO file (%s) VALUES (%s)' % (
+                        ', '.join(COLUMNS), ', '.join('?' * len(COLUMNS))),
+                ([getattr(f, column) for column in COLUMNS] for f in files))
+        db.commit()
+    finally:
+        db.close()
+    os.rename(tmp, path)
+
+
+def remove_shard(address):
+    if not is_sharded():
+        return
+    path = shard_path(address)
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def _escape_like(value):
+    return (value.replace('\\', '\\\\').replace('%', '\\%')
+            .replace('_', '\\_'))
+
+
+class ShardQuery(object):
+    """Files of a shard matching some conditions.
+
+    filter() takes the lookups the views use on File querysets (exact, gte,
+    lte, lt, icontains and in) so that the same code can build both.
+    """
+    _operators = {
+        'exact': '= ?',
+        'gte': '>= ?',
+        'lte': '<= ?',
+        'lt': '< ?',
+        'icontains': "LIKE ? ESCAPE '\\'",
+        'in': 'IN (%s)',
+    }
+
+    def __init__(self, conditions=()):
+        self.conditions = tuple(conditions)
+
+    def filter(self, **lookups):
+        conditions = list(self.conditions)
+        for lookup, value in sorted(lookups.iteritems()):
+            column, sep, operator = lookup.partition('__')
+            operator = operator or 'exact'
+            if column not in COLUMNS or operator not in self._operators:
+                raise ValueError("unsupported lookup %s" % lookup)
+            if operator == 'icontains':
+                value = u'%%%s%%' % _escape_like(value)
+            if operator == 'in':
+                values = tuple(value) or (None,)
+                sql = self._operators[operator] % ', '.join('?' * len(values))
+            else:
+                values = (value,)
+                sql = self._operators[operator]
+            conditions.append(('%s %s' % (column, sql), values))
+        return ShardQuery(conditions)
+
+    def under_path(self, path):
+        """The files in a directory and its subdirectories, see
+        yoppi.ftp.models.under_path()"""
+        return ShardQuery(self.conditions + (
+                ('(path = ? OR (path >= ? AND path < ?))',
+                 (path, path + u'/', path + u'0')),))
+
+    def _execute(self, address, sql, default, suffix=''):
+        path = shard_path(address)
+        if not os.path.exists(path):
+            return default
+        if self.conditions:
+            sql += ' WHERE ' + ' AND '.join(c for c, v in self.conditions)
+        sql += suffix
+        db = sqlite3.connect(path)
+        try:
+            params = [p for c, values in self.conditions for p in values]
+            return db.execute(sql, params).fetchall()
+        finally:
+            db.close()
+
+    def values_list(self, address, *columns, **options):
+        """Returns the matching rows of a server, ordered like the views
+        expect (directories first, then by name)"""
+        order = ' ORDER BY is_directory DESC, name'
+        limit = options.get('limit')
+        if limit is not None:
+            order += ' LIMIT %d' % limit
+        return self._execute(
+                address, 'SELECT %s FROM file' % ', '.join(columns), [],
+                order)
+
+    def count(self, address):
+        """Returns the number of matching rows of a server"""
+        return self._execute(address, 'SELECT COUNT(*) FROM file',
+                             [(0,)])[0][0]
+
+    def fetch(self, server, limit=None):
+        """Returns the matching files of a server as File objects"""
+        return [File(server=server, **dict(zip(COLUMNS, row)))
+                for row in self.values_list(server.address, *COLUMNS,
+                                            limit=limit)]
+
+    def batches(self, server, batch_size=BATCH_SIZE):
+        """Yields the matching files of a server as lists of up to
+        'batch_size' File objects, in the order of values_list(). Each batch
+        is a query starting after the last row of the previous one."""
+        query = self
+        while True:
+            rows = query._execute(
+                    server.address,
+                    'SELECT is_directory, name, id, %s FROM file' %
+                    ', '.join(COLUMNS), [],
+                    ' ORDER BY is_directory DESC, name, id LIMIT %d' %
+                    batch_size)
+            if rows:
+                yield [File(server=server, **dict(zip(COLUMNS, row[3:])))
+                       for row in rows]
+            if len(rows) < batch_size:
+                return
+            is_directory, name, id = rows[-1][:3]
+            query = ShardQuery(self.conditions + (
+                    ('(is_directory < ? OR (is_directory = ? AND '
+                     '(name > ? OR (name = ? AND id > ?))))',
+                     (is_directory, is_directory, name, name, id)),))
+
+
+class ShardSearch(object):
+    """The files of several servers matching a query, ordered like the
+    search view does with the File table: online servers first, then
+    directories, then by name.
+
+    Nothing is read until the files are needed, and the databases are
+    queried in parallel. Like a queryset, count() only counts the rows. The
+    rows of each database are read by batches as the merge needs them, so
+    that a slice holds at most a batch per database besides its own rows.
+    """
+    def __init__(self, servers, query):
+        self.servers = list(servers)
+        self.query = query
+        self._count = None
+
+    def _map(self, function):
+        if not self.servers:
+            return []
+        workers = min(SEARCH_WORKERS, len(self.servers))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(function, self.servers))
+
+    def count(self):
+        if self._count is None:
+            self._count = sum(self._map(
+                    lambda server: self.query.count(server.address)))
+        return self._count
+
+    def _fetch(self, batch_size=BATCH_SIZE):
+        def start(server):
+            batches = self.query.batches(server, batch_size)
+            return itertools.chain([next(batches, [])], batches)
+        # The first batches are read in parallel, the next ones when needed
+        results = self._map(start)
+
+        def keyed(i, batches):
+            # Each database returns its rows in order
+            files = itertools.chain.from_iterable(batches)
+            for j, f in enumerate(files):
+                yield (not f.server.online, not f.is_directory, f.name,
+                       i, j), f
+        merged = heapq.merge(*[keyed(i, batches)
+                               for i, batches in enumerate(results)])
+        return (f for key, f in merged)
+
+    def __iter__(self):
+        return self._fetch()
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            if index.step is not None:
+                raise ValueError("slices with a step aren't supported")
+            start = index.start or 0
+            if index.stop <= start:
+                return []
+            return list(itertools.islice(
+                    self._fetch(min(index.stop, BATCH_SIZE)), start,
+                    index.stop))
+        files = self[index:index + 1]
+        if not files:
+            raise IndexError(index)
+        return files[0]
+
+
+def group_files(files, limit=MAX_GROUPED_FILES):
+    """Collapses the copies of a file, like group_duplicates() does for the
+    File table, among the first 'limit' files of a ShardSearch.
+
+    The files on online servers come in the order of the groups, so each
+    group is where its first copy is. Call fetch_copies() to get the copies
+    once the page is known.
+    """
+    groups = []
+    seen = set()
+    for f in itertools.islice(files, limit):
+        if not f.server.online:
+            break
+        if f.content_key not in seen:
+            seen.add(f.content_key)
+            groups.append(dict(content_key=f.content_key,
+                               is_directory=f.is_directory,
+                               first_name=f.name))
+    return groups
+
+
+def fetch_copies(groups, servers):
+    """Adds the list of the copies on the online 'servers' to each group of
+    a page of results, the copies on the largest servers first"""
+    copies = {}
+    query = ShardQuery().filter(
+            content_key__in=[g['content_key'] for g in groups])
+    for f in ShardSearch([s for s in servers if s.online], query):
+        copies.setdefault(f.content_key, []).append(f)
+    for group in groups:
+        group['files'] = sorted(copies.get(group['content_key'], []),
+                                key=lambda f: -f.server.size)
+        group['file'] = group['files'][0] if group['files'] else None
+        group['copies'] = len(group['files'])
+    return groups
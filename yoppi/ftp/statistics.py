@@ -0,0 +1,118 @@
+"""Statistics of the network, precomputed by the indexer.
+
+Totals by category or extension would need to go through the whole File
+table. Instead, the indexer keeps a FileStatistics row for each server,
+category and extension, and updates it with what each indexing found to be
+added, changed or removed. The statistics page and its JSON version only
+read these rows.
+"""
+from django.db import transaction
+from django.db.models import Count, F, Sum
+
+from yoppi.ftp.models import CATEGORIES, FileStatistics, FtpServer
+
+
+def count_changes(deltas, previous, to_insert, removed):
+    """Adds the changes of an indexing to 'deltas', which maps
+    (category, extension) to [nb_files, size].
+
+    The arguments are the same as for Indexer._log_changes(): 'previous'
+    maps the paths to the files before the indexing, 'to_insert' holds the
+    new and changed files (it may hold the unchanged ones too) and 'removed'
+    the files that disappeared.
+    """
+    def add(f, sign):
+        if f.is_directory:
+            return
+        delta = deltas.setdefault((f.category, f.extension), [0, 0])
+        delta[0] += sign
+        delta[1] += sign * f.size
+
+    for f in to_insert:
+        old = previous.get(f.fullpath())
+        if old is not None:
+            add(old, -1)
+        add(f, 1)
+    for f in removed:
+        add(f, -1)
+    return deltas
+
+
+def apply_changes(server, deltas):
+    """Updates the statistics of a server with the result of
+    count_changes()"""
+    with transaction.commit_on_success():
+        for (category, extension), (nb_files, size) in deltas.iteritems():
+            if not nb_files and not size:
+                continue
+            rows = FileStatistics.objects.filter(
+                    server=server, category=category, extension=extension)
+            if not rows.update(nb_files=F('nb_files') + nb_files,
+                               size=F('size') + size):
+                FileStatistics(server=server, category=category,
+                               extension=extension, nb_files=nb_files,
+                               size=size).save()
+        FileStatistics.objects.filter(server=server, nb_files__lte=0).delete()
+
+
+def rebuild(server, files=None):
+    """Computes the statistics of a server again, from the given File
+    objects or from its visible files in the database"""
+    if files is not None:
+        deltas = count_changes({}, {}, files, ())
+    else:
+        deltas = dict(
+                ((row['category'], row['extension']),
+                 [row['nb_files'], row['size'] or 0])
+                for row in (server.files.visible()
+                            .filter(is_directory=False)
+                            .values('category', 'extension')
+                            .annotate(nb_files=Count('id'), size=Sum('size'))
+                            .order_by()))
+    with transaction.commit_on_success():
+        FileStatistics.objects.filter(server=server).delete()
+        FileStatistics.objects.bulk_create([
+                FileStatistics(server=server, category=category,
+                               extension=extension, nb_files=nb_files,
+                               size=size)
+                for (category, extension), (nb_files, size)
+                in deltas.iteritems() if nb_files > 0])
+
+
+def has_statistics(server):
+    return FileStatistics.objects.filter(server=server).exists()
+
+
+def network_statistics(nb_servers=10, nb_extensions=20):
+    """The totals of the network, by category, by extension and by server"""
+    rows = FileStatistics.objects.all()
+    totals = rows.aggregate(nb_files=Sum('nb_files'), size=Sum('size'))
+    by_category = dict(
+            (row['category'], row)
+            for row in rows.values('category')
+                           .annotate(nb_files=Sum('nb_files'),
+                                     size=Sum('size'))
+                           .order_by())
+    categories = []
+    for category, key, label, icon in CATEGORIES:
+        row = by_category.get(category, {})
+        categories.append(dict(key=key, label=unicode(label), icon=icon,
+                               nb_files=row.get('nb_files') or 0,
+                               size=row.get('size') or 0))
+    extensions = list(rows.exclude(extension='')
+                      .values('extension')
+                      .annotate(nb_files=Sum('nb_files'), size=Sum('size'))
+                      .order_by('-nb_files', 'extension')[:nb_extensions])
+    servers = list(rows.values('server')
+                   .annotate(nb_files=Sum('nb_files'), size=Sum('size'))
+                   .order_by('-size', 'server')[:nb_servers])
+    names = dict((s.address, s) for s in FtpServer.objects.filter(
+            address__in=[row['server'] for row in servers]))
+    for row in servers:
+        server = names.get(row['server'])
+        row['name'] = server.display_name() if server else row['server']
+        row['online'] = server.online if server else False
+    return dict(nb_files=totals['nb_files'] or 0, size=totals['size'] or 0,
+                nb_servers=FtpServer.objects.count(),
+                categories=categories, extensions=extensions,
+                servers=servers)
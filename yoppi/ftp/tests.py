@@ -1,7 +1,35 @@
+import datetime
+import json
+import os
+import shutil
+import tempfile
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.db.models import Count, Sum
 from django.test import TestCase
-from django.utils import translation
+from django.test.utils import override_settings
+from django.utils import timezone, translation
+from django.utils.importlib import import_module
+import mock
 
-from yoppi.ftp.models import FtpServer, guess_file_icon
+from yoppi.ftp.models import CATEGORY_AUDIO, CATEGORY_OTHER, CATEGORY_VIDEO, \
+        File, FileStatistics, FtpServer, content_key, file_extension, \
+        guess_file_category, guess_file_icon
+from yoppi.ftp.datafiles import DataFileCache, atomic_write, \
+        remove_data_file
+from yoppi.ftp.export import export_site
+from yoppi.ftp.loadtest import Dataset, generate_dataset, \
+        run_load_test, sample_urls
+from yoppi.ftp.membership import BloomFilter, build_path_filter
+from yoppi.ftp.names import NameIndex, build_name_index, edit_distance
+from yoppi.ftp.profiling import normalize_query, repeated_queries
+from yoppi.ftp.shards import ShardQuery, ShardSearch, fetch_copies, \
+        group_files, write_shard
+from yoppi.ftp.statistics import apply_changes, count_changes, rebuild
+from yoppi.ftp.views import parse_size
 
 
 class BasicTest(TestCase):
@@ -9,6 +37,7 @@ class BasicTest(TestCase):
 
     def setUp(self):
         translation.activate('en-US')
+        cache.clear()
 
     def test_servers_list(self):
         # Query the index
@@ -48,6 +77,27 @@ class BasicTest(TestCase):
             names = [e.name for e in files]
             self.assertEqual(names, exp)
 
+    def test_listing_cache(self):
+        uri = '/server/192.168.0.12/mirror/debian-amd64'
+        response = self.client.get(uri)
+        # The server and the sidebar, but not the files
+        with self.assertNumQueries(2):
+            cached = self.client.get(uri)
+        self.assertEqual(cached.content, response.content)
+
+        # A new generation of the files isn't hidden by the cache
+        server = FtpServer.objects.get(address='192.168.0.12')
+        File(server=server, path='/mirror/debian-amd64', name='new.iso',
+             is_directory=False, size=1, added_in=1).save()
+        server.generation = 1
+        server.save()
+        response = self.client.get(uri)
+        self.assertContains(response, 'new.iso')
+
+        self.assertEqual(
+                File.objects.get(name='new.iso').get_absolute_url(),
+                '/go/192.168.0.12/mirror/debian-amd64/new.iso')
+
     def test_search(self):
         response = self.client.get('/search/?query=paris')
         self.assertEqual(len(response.context['files']), 1)
@@ -58,10 +108,138 @@ class BasicTest(TestCase):
         response = self.client.get('/search/?query=FINAL%20100')
         self.assertEqual(len(response.context['files']), 1)
 
+    def test_search_filters(self):
+        response = self.client.get('/search/?query=a&type=video')
+        self.assertEqual([f.name for f in response.context['files']],
+                         [u'holiday_in_paris.avi'])
+
+        response = self.client.get('/search/?query=i&ext=.ISO')
+        self.assertEqual(len(response.context['files']), 5)
+
+        response = self.client.get('/search/?query=FINAL&min_size=1100&max_size=1109')
+        self.assertEqual(len(response.context['files']), 10)
+
+        response = self.client.get('/search/?query=FINAL&max_size=1k')
+        self.assertEqual([f.name for f in response.context['files']],
+                         [u'FINAL.doc', u'FINAL_rev.0.doc'])
+
+        # Invalid filters are ignored
+        response = self.client.get('/search/?query=paris&type=nope&min_size=big')
+        self.assertEqual(len(response.context['files']), 1)
+
+    def test_search_collapse(self):
+        # Mirror the debian images on another server
+        mirror = FtpServer.objects.get(address='192.168.0.42')
+        for f in File.objects.filter(path='/mirror/debian-amd64'):
+            f.id = None
+            f.server = mirror
+            f.save()
+        # Like the indexer does
+        File.objects.update_first_copies(
+                File.objects.values_list('content_key', flat=True))
+
+        response = self.client.get('/search/?query=testing')
+        self.assertEqual(len(response.context['files']), 10)
+
+        response = self.client.get('/search/?query=testing&collapse=1')
+        groups = response.context['files']
+        self.assertEqual(len(groups), 5)
+        self.assertEqual(groups[0]['copies'], 2)
+        self.assertEqual(groups[0]['file'].name,
+                         u'debian-testing-amd64-CD-1.iso')
+        self.assertEqual([f.server.address for f in groups[0]['files']],
+                         [u'192.168.0.12', u'192.168.0.42'])
+
+        # Within a server whose copies aren't the first ones
+        response = self.client.get(
+                '/search/?query=testing&collapse=1&server=192.168.0.42')
+        groups = response.context['files']
+        self.assertEqual(len(groups), 5)
+        self.assertEqual(groups[0]['copies'], 2)
+
+        # Only the copies on online servers are listed
+        response = self.client.get('/search/?query=paris&collapse=1')
+        self.assertEqual(len(response.context['files']), 0)
+
+    def test_content_key(self):
+        self.assertEqual(content_key(u'Some  File.avi ', 12, False),
+                         content_key(u'some file.AVI', 12, False))
+        self.assertNotEqual(content_key(u'some file.avi', 12, False),
+                            content_key(u'some file.avi', 13, False))
+        self.assertNotEqual(content_key(u'some file.avi', 0, False),
+                            content_key(u'some file.avi', 0, True))
+
+    def test_parse_size(self):
+        self.assertEqual(parse_size('12'), 12)
+        self.assertEqual(parse_size('700M'), 700 * 1024 * 1024)
+        self.assertEqual(parse_size(' 2 GiB'), 2 * 1024 ** 3)
+        self.assertEqual(parse_size('1kb'), 1024)
+        self.assertEqual(parse_size(''), None)
+        self.assertEqual(parse_size('-3'), None)
+
     def test_search_empty(self):
         response = self.client.get('/search/', follow=False)
         self.assertRedirects(response, '/', status_code=302)
 
+    def test_search_online(self):
+        response = self.client.get('/search/?query=.txt')
+        # The files of the offline server come last
+        self.assertEqual([(f.server.address, f.name)
+                          for f in response.context['files']][-1],
+                         (u'192.168.0.37', u'todo.txt'))
+
+        connection.use_debug_cursor = True
+        try:
+            del connection.queries[:]
+            response = self.client.get('/search/?query=.txt&online=1')
+            self.assertEqual([f.server.address
+                              for f in response.context['files']],
+                             [u'192.168.0.42', u'192.168.0.42'])
+            # Only the list of servers is read from their table
+            self.assertEqual([q['sql'] for q in connection.queries
+                              if 'ftp_ftpserver' in q['sql'] and
+                              'ftp_file' in q['sql']], [])
+            self.assertNotEqual(connection.queries, [])
+        finally:
+            connection.use_debug_cursor = None
+
+        server = FtpServer.objects.get(address='192.168.0.37')
+        server.online = True
+        server.save()
+        self.assertEqual(server.update_files_online(), 2)
+        response = self.client.get('/search/?query=paris&online=1')
+        self.assertEqual(len(response.context['files']), 1)
+
+    def test_search_scope(self):
+        server = FtpServer.objects.get(address='192.168.0.12')
+        # Next to /mirror, but not under it
+        File(server=server, path='/mirror.old', name='debian-testing.iso',
+             is_directory=False, size=1).save()
+
+        response = self.client.get('/search/?query=testing')
+        self.assertEqual(len(response.context['files']), 6)
+
+        response = self.client.get(
+                '/search/?query=testing&server=192.168.0.12&path=/mirror/')
+        self.assertEqual(len(response.context['files']), 5)
+        self.assertEqual(response.context['scope'], server)
+        self.assertEqual(response.context['scope_path'], '/mirror')
+
+        response = self.client.get(
+                '/search/?query=testing&server=192.168.0.42')
+        self.assertEqual(len(response.context['files']), 0)
+
+        # All the files of a subtree, without a query
+        response = self.client.get(
+                '/search/?server=192.168.0.12&path=/mirror&ext=iso')
+        self.assertEqual(len(response.context['files']), 5)
+        response = self.client.get('/search/?server=192.168.0.12')
+        self.assertEqual(len(response.context['files']),
+                         server.files.count())
+
+        response = self.client.get('/search/?query=a&server=nope')
+        self.assertEqual(response.status_code, 404)
+
     def test_go_dir(self):
         response = self.client.get('/go/192.168.0.12/mirror', follow=False)
         self.assertEqual(response.status_code, 302)
@@ -93,6 +271,31 @@ class BasicTest(TestCase):
                 u"146 weeks")
 
 
+class MigrationTest(TestCase):
+    fixtures = ['basic.json']
+
+    def test_fill_category_and_extension(self):
+        migration = import_module('yoppi.ftp.migrations.'
+                                  '0013_fill_file_category_and_extension')
+        File.objects.update(category=CATEGORY_OTHER, extension=u'')
+        for server in FtpServer.objects.all():
+            rebuild(server)
+        migration.Migration().forwards({'ftp.File': File,
+                                        'ftp.FileStatistics': FileStatistics})
+
+        f = File.objects.get(name=u'holiday_in_paris.avi')
+        self.assertEqual((f.category, f.extension, f.icon()),
+                         (CATEGORY_VIDEO, u'avi', 'film'))
+        self.assertEqual(File.objects.get(name=u'todo.txt').extension, u'txt')
+        self.assertEqual(File.objects.get(name=u'mirror').extension, u'')
+        # The statistics are counted again from them
+        self.assertEqual(
+                FileStatistics.objects.get(server=f.server, extension=u'avi')
+                .category, CATEGORY_VIDEO)
+        self.assertEqual(FileStatistics.objects.filter(
+                server=f.server, extension=u'').count(), 0)
+
+
 class FileIconsTest(TestCase):
     def test_common_extensions(self):
         self.assertEqual(guess_file_icon('tagada.avi'), 'film')
@@ -103,4 +306,440 @@ class FileIconsTest(TestCase):
         self.assertEqual(guess_file_icon('tagada.MP3'), 'music')
 
     def test_application_x(self):
-        self.assertEqual(guess_file_icon('tagada.flac'), 'music')
\ No newline at end of file
+        self.assertEqual(guess_file_icon('tagada.flac'), 'music')
+
+    def test_category(self):
+        self.assertEqual(guess_file_category('tagada.flac'), CATEGORY_AUDIO)
+        self.assertEqual(guess_file_category('tagada'), CATEGORY_OTHER)
+
+    def test_extension(self):
+        self.assertEqual(file_extension(u'tagada.MP3'), u'mp3')
+        self.assertEqual(file_extension(u'tagada.tar.gz'), u'gz')
+        self.assertEqual(file_extension(u'.bashrc'), u'')
+        self.assertEqual(file_extension(u'README'), u'')
+        self.assertEqual(file_extension(u'Dr. Strangelove and more'), u'')
+
+
+class TempDirTestCase(TestCase):
+    """Gives each test an empty directory, self.directory, which the
+    setting named by 'directory_setting' (if any) points to"""
+    directory_setting = None
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.settings = None
+        if self.directory_setting is not None:
+            self.settings = override_settings(
+                    **{self.directory_setting: self.directory})
+            self.settings.enable()
+
+    def tearDown(self):
+        if self.settings is not None:
+            self.settings.disable()
+        shutil.rmtree(self.directory)
+
+
+class AutocompleteTest(TempDirTestCase):
+    fixtures = ['basic.json']
+    directory_setting = 'YOPPI_DATA_DIR'
+
+    def test_name_index(self):
+        index = NameIndex.build([u'debian-testing-amd64-CD-1.iso',
+                                 u'Holiday_in_Paris.avi', u'todo.txt'])
+        self.assertEqual(index.complete(u'd'), [u'debian'])
+        self.assertEqual(index.complete(u'T'), [u'testing', u'todo', u'txt'])
+        self.assertEqual(index.complete(u't', limit=2), [u'testing', u'todo'])
+        self.assertEqual(index.complete(u'par'), [u'paris'])
+        self.assertEqual(index.complete(u'x'), [])
+        self.assertEqual(NameIndex.loads(index.dumps()).tokens, index.tokens)
+
+    def test_suggestions(self):
+        self.assertEqual(edit_distance(u'debian', u'debain'), 1)
+        self.assertEqual(edit_distance(u'paris', u'pairs'), 1)
+        self.assertEqual(edit_distance(u'todo', u'txt'), 3)
+        self.assertEqual(edit_distance(u'todo', u'txt', 2), None)
+
+        index = NameIndex.build([u'debian-testing-amd64-CD-1.iso',
+                                 u'debian-stable.iso', u'Holiday_in_Paris.avi',
+                                 u'tests.txt'], built=1234)
+        index = NameIndex.loads(index.dumps())
+        self.assertEqual(index.built, 1234)
+        self.assertEqual(index.frequency(u'debian'), 2)
+        self.assertEqual(index.frequency(u'nope'), 0)
+        self.assertTrue(index.can_match(u'Debian'))
+        self.assertTrue(index.can_match(u'esti'))
+        self.assertTrue(index.can_match(u'in-par'))
+        self.assertFalse(index.can_match(u'debain'))
+        self.assertEqual(index.suggest(u'Debain'), u'debian')
+        self.assertEqual(index.suggest(u'paaris'), u'paris')
+        # Nearest first, then the most frequent
+        self.assertEqual(index.suggest(u'testo'), u'tests')
+        self.assertEqual(index.suggest(u'tesing'), u'testing')
+        self.assertEqual(index.suggest(u'xyzzy'), None)
+
+    def test_search_suggestions(self):
+        translation.activate('en-US')
+        # Without the name index, searches always go to the database
+        response = self.client.get('/search/?query=debain')
+        self.assertEqual(len(response.context['files']), 0)
+        self.assertEqual(response.context['suggestion'], None)
+
+        build_name_index()
+        with self.assertNumQueries(2):
+            # The list of servers, and whether one was indexed since
+            response = self.client.get('/search/?query=holiday%20pariss')
+        self.assertEqual(len(response.context['files']), 0)
+        self.assertEqual(response.context['suggestion'], u'holiday paris')
+        self.assertEqual(response.context['suggestion_string'],
+                         'query=holiday+paris')
+        response = self.client.get('/search/?' +
+                                   response.context['suggestion_string'])
+        self.assertEqual(len(response.context['files']), 1)
+
+        # Servers indexed since may have the word
+        server = FtpServer.objects.get(address='192.168.0.12')
+        server.last_indexed = timezone.now() + datetime.timedelta(seconds=1)
+        server.save()
+        File(server=server, path='', name='pariss', is_directory=False,
+             size=1).save()
+        response = self.client.get('/search/?query=pariss')
+        self.assertEqual(len(response.context['files']), 1)
+
+    def test_autocomplete(self):
+        response = self.client.get('/autocomplete/?query=deb')
+        self.assertEqual(json.loads(response.content), [])
+
+        self.assertTrue(build_name_index() > 0)
+        response = self.client.get('/autocomplete/?query=deb')
+        self.assertEqual(json.loads(response.content), [u'debian'])
+        response = self.client.get('/autocomplete/?query=debian%20am')
+        self.assertEqual(json.loads(response.content), [u'debian amd64'])
+        response = self.client.get('/autocomplete/?query=debian%20')
+        self.assertEqual(json.loads(response.content), [])
+
+
+class PathFilterTest(TempDirTestCase):
+    fixtures = ['basic.json']
+    directory_setting = 'YOPPI_DATA_DIR'
+
+    def test_bloom_filter(self):
+        bloom = BloomFilter.for_capacity(1000, 0.01)
+        for i in xrange(1000):
+            bloom.add(u'/file%d' % i)
+        bloom = BloomFilter.loads(bloom.dumps())
+        for i in xrange(1000):
+            self.assertTrue(u'/file%d' % i in bloom)
+        false_positives = sum(1 for i in xrange(10000)
+                              if u'/other%d' % i in bloom)
+        self.assertTrue(false_positives < 200)
+
+    def test_cache_size(self):
+        loads = []
+
+        def loader(data):
+            loads.append(data)
+            return data
+        cache = DataFileCache(loader, max_size=10)
+        atomic_write('one', 'aaaaaa')
+        atomic_write('two', 'bbbbbb')
+        self.assertEqual(cache.get('one'), 'aaaaaa')
+        self.assertEqual(cache.get('two'), 'bbbbbb')
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.get('two'), 'bbbbbb')
+        self.assertEqual(loads, ['aaaaaa', 'bbbbbb'])
+
+        remove_data_file('two')
+        self.assertEqual(cache.get('two', 'gone'), 'gone')
+        self.assertEqual(len(cache), 0)
+
+    def test_download_without_queries(self):
+        server = FtpServer.objects.get(address='192.168.0.42')
+        self.assertEqual(build_path_filter(server), 4)
+
+        with self.assertNumQueries(0):
+            response = self.client.get('/go/192.168.0.42/dir/icon.png',
+                                       follow=False)
+            self.assertEqual(response.status_code, 302)
+            self.assertEqual(response['Location'],
+                             'ftp://192.168.0.42/dir/icon.png')
+
+            response = self.client.get('/go/192.168.0.42/dir', follow=False)
+            self.assertEqual(response.status_code, 302)
+
+            response = self.client.get('/go/192.168.0.42/dir/nope.png',
+                                       follow=False)
+            self.assertEqual(response.status_code, 404)
+
+        # Servers without a filter still work
+        response = self.client.get('/go/192.168.0.37/todo.txt', follow=False)
+        self.assertEqual(response.status_code, 302)
+
+
+class StatisticsTest(TestCase):
+    fixtures = ['basic.json']
+
+    def setUp(self):
+        translation.activate('en-US')
+        for server in FtpServer.objects.all():
+            rebuild(server)
+
+    def test_totals(self):
+        files = File.objects.filter(is_directory=False)
+        expected = files.aggregate(nb_files=Count('id'), size=Sum('size'))
+
+        response = self.client.get('/stats/')
+        self.assertEqual(response.status_code, 200)
+        stats = response.context['stats']
+        self.assertEqual(stats['nb_files'], expected['nb_files'])
+        self.assertEqual(stats['size'], expected['size'])
+        self.assertEqual(sum(c['nb_files'] for c in stats['categories']),
+                         expected['nb_files'])
+        self.assertEqual(stats['servers'][0]['server'], '192.168.0.12')
+
+        stats = json.loads(self.client.get('/api/stats/').content)
+        self.assertEqual(stats['nb_files'], expected['nb_files'])
+        self.assertEqual(dict((e['extension'], e['nb_files'])
+                              for e in stats['extensions'])['iso'],
+                         files.filter(extension='iso').count())
+
+    def test_apply_changes(self):
+        server = FtpServer.objects.get(address='192.168.0.37')
+        todo = server.files.get(name='todo.txt')
+        changed = File(server=server, path=todo.path, name=todo.name,
+                       is_directory=False, size=todo.size + 10,
+                       category=todo.category, extension=todo.extension)
+        added = File(server=server, path=u'', name=u'song.mp3',
+                     is_directory=False, size=100,
+                     category=CATEGORY_AUDIO, extension=u'mp3')
+        deltas = count_changes({}, {todo.fullpath(): todo},
+                               [changed, added], [])
+        apply_changes(server, deltas)
+
+        rows = dict(((row.category, row.extension), row)
+                    for row in server.statistics.all())
+        txt = rows[(todo.category, u'txt')]
+        self.assertEqual(txt.size,
+                         server.files.filter(extension='txt')
+                         .aggregate(size=Sum('size'))['size'] + 10)
+        self.assertEqual(rows[(CATEGORY_AUDIO, u'mp3')].nb_files, 1)
+
+        # Rows without any file left are removed
+        apply_changes(server, count_changes({}, {}, [], [added]))
+        self.assertFalse(server.statistics.filter(extension='mp3').exists())
+
+
+class ShardTest(TempDirTestCase):
+    fixtures = ['basic.json']
+    directory_setting = 'YOPPI_SHARD_DIR'
+
+    queries = [
+        '/search/?query=testing',
+        '/search/?query=a',
+        '/search/?query=a&type=video',
+        '/search/?query=FINAL&min_size=1100&max_size=1109',
+        '/search/?query=100%25',
+        '/search/?query=testing&server=192.168.0.12&path=/mirror',
+        '/search/?server=192.168.0.12&path=/mirror/debian-amd64&ext=iso',
+        '/search/?server=192.168.0.42',
+    ]
+
+    def setUp(self):
+        translation.activate('en-US')
+        cache.clear()
+        super(ShardTest, self).setUp()
+
+    def _shard(self):
+        """Moves the files of the fixture to the shards"""
+        for server in FtpServer.objects.all():
+            write_shard(server, server.files.all())
+        File.objects.all().delete()
+
+    def _results(self):
+        results = []
+        for uri in self.queries:
+            response = self.client.get(uri)
+            results.append([(f.server.address, f.path, f.name, f.size)
+                            for f in response.context['files']])
+        return results
+
+    def test_search_like_the_database(self):
+        with override_settings(YOPPI_SHARD_DIR=None):
+            expected = self._results()
+        self._shard()
+        self.assertEqual(self._results(), expected)
+
+    def test_browse(self):
+        self._shard()
+        response = self.client.get(
+                '/server/192.168.0.12/mirror/debian-amd64')
+        self.assertEqual([f.name for f in response.context['files']], [
+                'debian-testing-amd64-CD-1.iso',
+                'debian-testing-amd64-CD-2.iso',
+                'debian-testing-amd64-CD-3.iso',
+                'debian-testing-amd64-CD-4.iso',
+                'debian-testing-amd64-CD-5.iso'])
+
+        response = self.client.get('/go/192.168.0.42/dir/icon.png',
+                                   follow=False)
+        self.assertEqual(response.status_code, 302)
+        response = self.client.get('/go/192.168.0.42/dir/nope.png',
+                                   follow=False)
+        self.assertEqual(response.status_code, 404)
+
+    def test_pages(self):
+        servers = FtpServer.objects.order_by('address')
+        for i, server in enumerate(servers):
+            write_shard(server, [
+                    File(server=server, path=u'', name=u'many%04d' % j,
+                         is_directory=False, size=j)
+                    for j in xrange(i, 1200, len(servers))])
+        # The offline server comes last
+        expected = sorted((not server.online, f.name)
+                          for server in servers
+                          for f in ShardQuery().fetch(server))
+        # Read from each shard by batches, as far as the page needs
+        with mock.patch('yoppi.ftp.shards.BATCH_SIZE', 64):
+            response = self.client.get('/search/?query=many&page=7')
+        files = response.context['files']
+        self.assertEqual(files.paginator.count, 1200)
+        self.assertEqual([(not f.server.online, f.name) for f in files],
+                         expected[600:700])
+        response = self.client.get('/search/?query=many&page=12')
+        self.assertEqual([f.server.address for f in response.context['files']],
+                         [u'192.168.0.37'] * 100)
+
+    def test_listing_cache(self):
+        self._shard()
+        uri = '/server/192.168.0.12/mirror/debian-amd64'
+        response = self.client.get(uri)
+        with mock.patch('yoppi.ftp.shards.sqlite3') as sqlite3:
+            cached = self.client.get(uri)
+        self.assertEqual(cached.content, response.content)
+        self.assertFalse(sqlite3.connect.called)
+
+    def test_collapse(self):
+        self._shard()
+        response = self.client.get('/search/?query=testing&collapse=1')
+        groups = response.context['files']
+        self.assertEqual(len(groups), 5)
+        self.assertEqual(groups[0]['copies'], 1)
+        self.assertEqual(groups[0]['file'].name,
+                         u'debian-testing-amd64-CD-1.iso')
+
+        # Only the first matches are grouped
+        servers = FtpServer.objects.all()
+        search = ShardSearch(servers,
+                             ShardQuery().filter(name__icontains=u'testing'))
+        first = group_files(search, limit=2)
+        self.assertEqual([g['first_name'] for g in first],
+                         [g['first_name'] for g in groups[:2]])
+        self.assertEqual(fetch_copies(first, servers)[0]['copies'], 1)
+
+
+class ProfilingTest(TestCase):
+    fixtures = ['basic.json']
+
+    def setUp(self):
+        self.settings = override_settings(
+                YOPPI_PROFILING={'SAMPLE_RATE': 0, 'REPEATED_QUERIES': 3},
+                MIDDLEWARE_CLASSES=settings.MIDDLEWARE_CLASSES + (
+                        'yoppi.ftp.profiling.ProfilingMiddleware',))
+        self.settings.enable()
+
+    def tearDown(self):
+        self.settings.disable()
+
+    def test_server_timing(self):
+        response = self.client.get('/server/192.168.0.12/mirror/debian-amd64')
+        timing = response['Server-Timing'].split(', ')
+        self.assertEqual([t.split(';')[0] for t in timing],
+                         ['db', 'tpl', 'total'])
+        self.assertTrue(timing[0].endswith('queries"'))
+
+    def test_repeated_queries(self):
+        self.assertEqual(
+                normalize_query("SELECT * FROM f WHERE id = 12 AND n = 'a''b'"),
+                "SELECT * FROM f WHERE id = ? AND n = ?")
+        queries = [{'sql': 'SELECT * FROM s WHERE id = %d' % i}
+                   for i in xrange(4)]
+        queries.append({'sql': 'SELECT COUNT(*) FROM f'})
+        self.assertEqual(repeated_queries(queries, 3),
+                         [('SELECT * FROM s WHERE id = ?', 4)])
+        self.assertEqual(repeated_queries(queries, 5), [])
+
+
+class LoadTestTest(TestCase):
+    def test_generate(self):
+        generate_dataset(5, 500, seed=1)
+        self.assertEqual(FtpServer.objects.count(), 5)
+        self.assertEqual(File.objects.count(), 500)
+        sizes = list(FtpServer.objects.values_list('size', flat=True))
+        self.assertEqual(
+                sum(sizes),
+                sum(File.objects.values_list('size', flat=True)))
+
+    def test_load_test(self):
+        generate_dataset(3, 200, seed=1)
+        results = run_load_test(sample_urls(Dataset(1), 4))
+        self.assertEqual(sorted(results),
+                         ['download', 'index', 'search', 'server'])
+        for result in results.itervalues():
+            self.assertEqual(result['errors'], 0)
+            self.assertTrue(result['p50_ms'] <= result['p99_ms'])
+            self.assertTrue(result['queries'] >= 0)
+        self.assertEqual(results['index']['requests'], 4)
+
+    def test_command(self):
+        generate_dataset(3, 200, seed=1)
+        fd, output = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            call_command('loadtest', requests=2, seed=1, output=output,
+                         stdout=open(os.devnull, 'w'))
+            with open(output) as fp:
+                self.assertEqual(len(json.load(fp)), 4)
+        finally:
+            os.remove(output)
+
+
+class ExportTest(TempDirTestCase):
+    fixtures = ['basic.json']
+
+    def setUp(self):
+        cache.clear()
+        super(ExportTest, self).setUp()
+
+    def test_export(self):
+        self.assertEqual(len(export_site(self.directory)), 4)
+        page = os.path.join(self.directory, 'server', '192.168.0.12',
+                            'mirror', 'debian-amd64', 'index.html')
+        with open(page) as fp:
+            self.assertTrue('debian-testing-amd64-CD-5.iso' in fp.read())
+        self.assertTrue(os.path.exists(
+                os.path.join(self.directory, 'index.html')))
+
+        # Only the servers indexed again are rendered
+        self.assertEqual(export_site(self.directory), [])
+        FtpServer.objects.filter(address='192.168.0.42').update(generation=1)
+        FtpServer.objects.filter(address='192.168.0.37').delete()
+        self.assertEqual(export_site(self.directory), [u'192.168.0.42'])
+        self.assertEqual(
+                sorted(os.listdir(os.path.join(self.directory, 'server'))),
+                ['192.168.0.12', '192.168.0.42', '192.168.0.43'])
+        # The previous pages of the servers rendered again are deleted
+        self.assertEqual(
+                len(os.listdir(os.path.join(self.directory, 'versions'))),
+                3)
+        self.assertTrue(os.path.islink(
+                os.path.join(self.directory, 'server', '192.168.0.42')))
+
+    def test_export_page_names(self):
+        # A directory whose page would be its parent's page is left out
+        server = FtpServer.objects.get(address='192.168.0.12')
+        for path in (u'/mirror', u'/mirror/index.html'):
+            File(server=server, path=path, name=u'index.html',
+                 is_directory=True, size=0).save()
+        export_site(self.directory)
+        page = os.path.join(self.directory, 'server', '192.168.0.12',
+                            'mirror', 'index.html')
+        self.assertTrue(os.path.isfile(page))
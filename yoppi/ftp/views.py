@@ -1,13 +1,38 @@
+import hashlib
+import json
+import re
+
 from django.core.paginator import Paginator, PageNotAnInteger, EmptyPage
 from django.shortcuts import render, get_object_or_404, redirect
 from django.core.urlresolvers import reverse
+from django.db.models import Min
 from django.http import HttpResponse, Http404
 from django.utils.encoding import smart_str
-from yoppi.ftp.models import FtpServer, File
+from yoppi.ftp.models import CATEGORIES, CATEGORY_KEYS, FtpServer, File, \
+        FileChange, under_path
+from yoppi.ftp.membership import get_path_filter
+from yoppi.ftp.names import get_name_index, suggest_query, unknown_words
+from yoppi.ftp.shards import ShardQuery, ShardSearch, fetch_copies, \
+        group_files, is_sharded
+from yoppi.ftp.statistics import network_statistics
+
+
+class ServerList(list):
+    """The servers shown in the sidebar.
 
+    'cache_key' changes whenever something displayed about them does, and
+    identifies the cached rendering of the sidebar. 'active' is the address
+    of the server being browsed, which is highlighted.
+    """
+    def __init__(self, servers, active=None):
+        list.__init__(self, servers)
+        state = repr((active, [(s.address, s.name, s.online, s.size)
+                               for s in self]))
+        self.cache_key = hashlib.md5(state).hexdigest()
 
-def all_servers():
-    return list(FtpServer.objects.order_by('-online', '-size'))
+
+def all_servers(active=None):
+    return ServerList(FtpServer.objects.order_by('-online', '-size'), active)
 
 
 def decompose_path(server, path):
@@ -28,6 +53,101 @@ def decompose_path(server, path):
     return hierarchy
 
 
+_size_units = {'': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+_size_regex = re.compile(r'^\s*([0-9]+)\s*([kmg]?)i?b?\s*$', re.IGNORECASE)
+
+
+def parse_size(value):
+    """Parses a size such as '700M' into a number of bytes.
+
+    Returns None if the value is empty or invalid.
+    """
+    m = _size_regex.match(value or '')
+    if not m:
+        return None
+    return int(m.group(1)) * _size_units[m.group(2).lower()]
+
+
+def filter_files(files, params):
+    """Applies the type, extension and size filters of a search.
+
+    These only use indexed columns, so they are cheap compared to the name
+    lookup.
+    """
+    filters = {}
+    category = CATEGORY_KEYS.get(params.get('type'))
+    if category is not None:
+        files = files.filter(category=category, is_directory=False)
+        filters['type'] = params['type']
+    ext = params.get('ext', '').strip().lstrip('.').lower()
+    if ext:
+        files = files.filter(extension=ext)
+        filters['ext'] = ext
+    min_size = parse_size(params.get('min_size'))
+    if min_size is not None:
+        files = files.filter(size__gte=min_size)
+        filters['min_size'] = params['min_size']
+    max_size = parse_size(params.get('max_size'))
+    if max_size is not None:
+        files = files.filter(size__lte=max_size)
+        filters['max_size'] = params['max_size']
+    return files, filters
+
+
+def group_duplicates(files, scoped=False):
+    """Collapses the copies of a file into one row per content key.
+
+    Only the copies on online servers are kept. Each group is its first
+    copy, which the indexer keeps marked (see
+    FileManager.update_first_copies()), so this is the same indexed scan as
+    a search. The first copy may be outside of a server or directory the
+    search is restricted to: 'scoped' searches are grouped by the query
+    instead, on the few files of the scope. Call attach_copies() to fetch
+    the copies once the page is known.
+    """
+    if not scoped:
+        return files.filter(first_copy=True, server_online=True)
+    return (files.filter(server_online=True)
+            .values('content_key', 'is_directory')
+            .annotate(first_name=Min('name'))
+            .order_by('-is_directory', 'first_name'))
+
+
+def attach_servers(files, servers):
+    """Sets the server of each file from the given servers, which the page
+    fetched anyway, instead of joining FtpServer"""
+    servers = dict((s.address, s) for s in servers)
+    cache_name = File._meta.get_field('server').get_cache_name()
+    for f in files:
+        # A server purged since is fetched like select_related() would
+        if f.server_id in servers:
+            setattr(f, cache_name, servers[f.server_id])
+    return files
+
+
+def attach_copies(groups, servers):
+    """Adds the list of online copies to each group of a page of results,
+    the copies on the largest servers first. Returns the groups as
+    dictionaries."""
+    groups = [group if isinstance(group, dict) else
+              dict(content_key=group.content_key,
+                   is_directory=group.is_directory, first_name=group.name)
+              for group in groups]
+    copies = {}
+    files = attach_servers(
+            File.objects.visible()
+            .filter(content_key__in=[g['content_key'] for g in groups],
+                    server_online=True),
+            servers)
+    for f in sorted(files, key=lambda f: -f.server.size):
+        copies.setdefault(f.content_key, []).append(f)
+    for group in groups:
+        group['files'] = copies.get(group['content_key'], [])
+        group['file'] = group['files'][0] if group['files'] else None
+        group['copies'] = len(group['files'])
+    return groups
+
+
 def index(request):
     return render(
         request,
@@ -43,44 +163,109 @@ def server(request, address, path=''):
 
     hierarchy = decompose_path(server, path)
 
-    files = (server.files.filter(path=path)
-             .order_by('-is_directory', 'name').select_related('server'))
+    if is_sharded():
+        files = ShardSearch([server], ShardQuery().filter(path=path))
+    else:
+        files = (server.files.visible().filter(path=path)
+                 .order_by('-is_directory', 'name').select_related('server'))
 
     return render(
         request,
         'ftp/server.html',
-        {'servers': all_servers(), 'active_server': server, 'files': list(files), 'path': path, 'hierarchy': hierarchy}
+        # The files are only fetched if the listing isn't in the cache
+        {'servers': all_servers(address), 'active_server': server, 'files': files, 'path': path, 'hierarchy': hierarchy}
     )
 
 
 def download(request, address, path):
-    server = get_object_or_404(FtpServer, address=address)
+    path_filter = get_path_filter(address)
+    if path_filter is not None:
+        # The indexer wrote the list of paths for this server, no need to
+        # ask the database
+        if path not in path_filter:
+            raise Http404
+    else:
+        server = get_object_or_404(FtpServer, address=address)
 
-    sep = path.rfind('/')
-    if sep == -1:
-        raise Http404
-    filename = path
-    path, name = filename[:sep], filename[sep+1:]
-    file = get_object_or_404(File, server=server, path=path, name=name)
+        sep = path.rfind('/')
+        if sep == -1:
+            raise Http404
+        dirname, name = path[:sep], path[sep+1:]
+        if is_sharded():
+            if not ShardQuery().filter(path=dirname, name=name).fetch(
+                    server, limit=1):
+                raise Http404
+        else:
+            file = get_object_or_404(server.files.visible(),
+                                     path=dirname, name=name)
 
     # TODO : download statistics?
 
     response = HttpResponse(status=302)
     response['Cache-control'] = 'no-cache'
-    response['Location'] = smart_str('ftp://%s%s' % (server.address, filename))
+    response['Location'] = smart_str('ftp://%s%s' % (address, path))
     return response
 
 
+def search_scope(params):
+    """The server and directory a search is restricted to, from the 'server'
+    and 'path' parameters. Returns (server, path); server is None for a
+    search of all the servers."""
+    address = params.get('server')
+    if not address:
+        return None, u''
+    server = get_object_or_404(FtpServer, address=address)
+    path = params.get('path', u'').rstrip(u'/')
+    if path and not path.startswith(u'/'):
+        path = u'/' + path
+    return server, path
+
+
 def search(request):
-    query = request.GET.get('query')
-    if not query:
-        # not query or empty query
+    query = request.GET.get('query', u'')
+    scope, path = search_scope(request.GET)
+    if not query.strip() and scope is None:
+        # not query or empty query: listing everything is only allowed
+        # within a server
         return redirect('yoppi.ftp.views.index')
 
-    all_files = (File.objects.order_by('-server__online','-is_directory', 'name')
-                 .select_related('server'))
-    for word in query.split():
-        all_files = all_files.filter(name__icontains=word)
+    servers = all_servers()
+    collapse = bool(request.GET.get('collapse'))
+    online_only = bool(request.GET.get('online'))
+    # Misspelled words find nothing, no need to scan the files for them
+    unknown = unknown_words(query.split())
+    if is_sharded():
+        all_files = ShardQuery()
+        if scope is not None:
+            all_files = all_files.under_path(path)
+        for word in query.split():
+            all_files = all_files.filter(name__icontains=word)
+        all_files, filters = filter_files(all_files, request.GET)
+        searched = [scope] if scope is not None else servers
+        if online_only:
+            searched = [s for s in searched if s.online]
+        if unknown:
+            searched = []
+        all_files = ShardSearch(searched, all_files)
+        if collapse:
+            all_files = group_files(all_files)
+    else:
+        # Sorted and filtered on the copy of the server's state, which an
+        # index covers, instead of joining the servers (see migration 0015)
+        all_files = (File.objects.visible()
+                     .order_by('-server_online', '-is_directory', 'name'))
+        if online_only:
+            all_files = all_files.filter(server_online=True)
+        if scope is not None:
+            # A range on the (server, path) index, not a LIKE on the path
+            all_files = all_files.filter(under_path(path), server=scope)
+        for word in query.split():
+            all_files = all_files.filter(name__icontains=word)
+        all_files, filters = filter_files(all_files, request.GET)
+        if collapse:
+            all_files = group_duplicates(all_files, scope is not None)
+        if unknown:
+            all_files = []
     paginator = Paginator(all_files, 100)
     page = request.GET.get('page')
     try:
@@ -89,14 +274,111 @@ def search(request):
         files = paginator.page(1)
     except EmptyPage:
         files = paginator.page(paginator.num_pages)
+    if collapse and is_sharded():
+        files.object_list = fetch_copies(files.object_list, searched)
+    elif collapse:
+        files.object_list = attach_copies(files.object_list, servers)
+    elif not is_sharded():
+        files.object_list = attach_servers(list(files.object_list), servers)
+    suggestion = suggestion_string = None
+    if not paginator.count and query:
+        suggestion = suggest_query(query)
+
+    # Used by the pager to keep the same search
+    params = request.GET.copy()
+    params.pop('page', None)
+    query_string = params.urlencode()
+    if suggestion is not None:
+        params['query'] = suggestion
+        suggestion_string = params.urlencode()
 
     return render(
         request,
         'ftp/search.html',
-        {'servers': all_servers(), 'files': files, 'query': query}
+        {'servers': servers, 'files': files, 'query': query,
+         'filters': filters, 'categories': CATEGORIES,
+         'collapse': collapse, 'online_only': online_only,
+         'query_string': query_string,
+         'scope': scope, 'scope_path': path,
+         'suggestion': suggestion, 'suggestion_string': suggestion_string}
+    )
+
+
+def autocomplete(request):
+    query = request.GET.get('query', '')
+    words = query.split()
+    completions = []
+    # Only the last word is being typed
+    if words and not query[-1].isspace():
+        start = query[:query.rfind(words[-1])]
+        completions = [start + token
+                       for token in get_name_index().complete(words[-1])]
+    return HttpResponse(json.dumps(completions),
+                        content_type='application/json')
+
+
+def _int_param(params, name, default=None):
+    try:
+        return int(params[name])
+    except (KeyError, ValueError):
+        return default
+
+
+def recent(request):
+    """The files added lately, newest first.
+
+    Pages are delimited by the id of the last change shown ('before'), so
+    each page is a range scan of the change log.
+    """
+    changes = (FileChange.objects.filter(kind=FileChange.ADDED)
+               .order_by('-id').select_related('server'))
+    before = _int_param(request.GET, 'before')
+    if before is not None:
+        changes = changes.filter(id__lt=before)
+    changes = list(changes[:100])
+    return render(
+        request,
+        'ftp/recent.html',
+        {'servers': all_servers(), 'files': changes,
+         'next': changes[-1].id if len(changes) == 100 else None}
+    )
+
+
+def changes(request):
+    """The change log as JSON, in the order of the changes.
+
+    Clients follow it by passing the 'next' value of the previous response as
+    'since'.
+    """
+    since = _int_param(request.GET, 'since', 0)
+    limit = max(0, min(_int_param(request.GET, 'limit', 1000), 10000))
+    kinds = dict(FileChange.KINDS)
+    entries = list(FileChange.objects.filter(id__gt=since).order_by('id')
+                   .values('id', 'server', 'date', 'kind', 'path', 'name',
+                           'is_directory', 'size')[:limit])
+    for entry in entries:
+        entry['date'] = entry['date'].isoformat()
+        entry['kind'] = kinds[entry['kind']]
+    return HttpResponse(
+            json.dumps({'changes': entries,
+                        'next': entries[-1]['id'] if entries else since}),
+            content_type='application/json')
+
+
+def statistics(request):
+    """Totals of the network, read from the statistics kept by the indexer"""
+    return render(
+        request,
+        'ftp/statistics.html',
+        {'servers': all_servers(), 'stats': network_statistics()}
     )
 
 
+def statistics_json(request):
+    return HttpResponse(json.dumps(network_statistics()),
+                        content_type='application/json')
+
+
 def error_404(request):
     return render(
         request,
@@ -1,22 +1,33 @@
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import contextlib
 import datetime
 import ftplib
 from itertools import izip
+import json
 import logging
 import socket
 import time
 
-from django.db import IntegrityError
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Q
 from django.utils import timezone
 from django.utils.translation import ugettext
 from django.conf import settings as django_settings
 
-from yoppi.ftp.models import FtpServer, File
+from yoppi.ftp import statistics
+from yoppi.ftp.models import FtpServer, File, FileChange
+from yoppi.ftp.membership import build_path_filter, remove_path_filter
+from yoppi.ftp.names import build_name_index
+from yoppi.ftp.shards import ShardQuery, is_sharded, remove_shard, \
+        write_shard
+from yoppi.indexer.budget import NetworkBudget
+from yoppi.indexer.discovery import discover, make_source
 from yoppi.indexer.iptools import IP, IPRange, parse_ip_ranges
 from yoppi.indexer.walk_ftp import walk_ftp
 from yoppi import settings
-from yoppi.indexer.models import IndexerParameter
+from yoppi.indexer.models import IndexCheckpoint, IndexerParameter, \
+        ServerProfile
+from yoppi.indexer.timeouts import TimeoutPolicy
 
 
 logger = logging.getLogger(__name__)
@@ -43,10 +54,13 @@ def ServerIndexingLock(address):
             raise ServerAlreadyIndexing(address)
         else:
             server = FtpServer.objects.get(address=address)
+            was_online = server.online
             server.online = True
             server.last_online = timezone.now()
             server.indexing = timezone.now()
             server.save()
+            if not was_online:
+                server.update_files_online()
 
     try:
         yield server
@@ -64,7 +78,7 @@ def ftp_online(address, timeout):
     except ftplib.all_errors:
         return False
 
-def safe_bulk_create(to_insert):
+def safe_bulk_create(to_insert, model=File):
     try:
         BULK_SIZE = settings.DATABASES['default']['BULK_SIZE']
     except KeyError:
@@ -75,9 +89,118 @@ def safe_bulk_create(to_insert):
 
     if BULK_SIZE is not None and BULK_SIZE > 0:
         for i in range(0, len(to_insert), BULK_SIZE):
-            File.objects.bulk_create(to_insert[i:i + BULK_SIZE])
+            model.objects.bulk_create(to_insert[i:i + BULK_SIZE])
     else:
-        File.objects.bulk_create(to_insert)
+        model.objects.bulk_create(to_insert)
+
+
+def purge_server(address, chunk_size=10000):
+    """Deletes a server and all of its files.
+
+    Unlike QuerySet.delete(), this doesn't load the files in memory: they are
+    deleted by chunks of 'chunk_size' rows, each in its own transaction, and
+    the server goes last.
+
+    Returns the number of deleted files, or None if the server is being
+    indexed (it is left alone then).
+    """
+    # Take the indexing lock so that nobody starts indexing it meanwhile
+    if (FtpServer.objects.filter(indexing=None, address=address)
+            .update(indexing=timezone.now()) == 0):
+        return None
+
+    try:
+        qn = connection.ops.quote_name
+        table = qn(File._meta.db_table)
+        server_column = qn(File._meta.get_field('server').column)
+        id_column = qn(File._meta.pk.column)
+        files = File.objects.filter(server=address).order_by('id')
+        # Other copies will stand for the groups it showed
+        first_copies = list(files.filter(first_copy=True)
+                            .values_list('content_key', flat=True))
+        deleted = 0
+        while True:
+            # Find the upper bound of the next chunk
+            bound = list(files.values_list('id', flat=True)
+                         [chunk_size:chunk_size + 1])
+            with transaction.commit_on_success():
+                cursor = connection.cursor()
+                if bound:
+                    cursor.execute(
+                            'DELETE FROM %s WHERE %s = %%s AND %s < %%s' % (
+                                    table, server_column, id_column),
+                            [address, bound[0]])
+                else:
+                    cursor.execute(
+                            'DELETE FROM %s WHERE %s = %%s' % (
+                                    table, server_column),
+                            [address])
+                deleted += cursor.rowcount
+            if not bound:
+                break
+
+        with transaction.commit_on_success():
+            cursor = connection.cursor()
+            cursor.execute(
+                    'DELETE FROM %s WHERE %s = %%s' % (
+                            qn(FileChange._meta.db_table),
+                            qn(FileChange._meta.get_field('server').column)),
+                    [address])
+
+        File.objects.update_first_copies(first_copies)
+        FtpServer.objects.filter(address=address).delete()
+    finally:
+        # Nothing left to unlock if it went through
+        FtpServer.objects.filter(address=address).update(indexing=None)
+    remove_path_filter(address)
+    remove_shard(address)
+    return deleted
+
+
+def collect_garbage(server, keep_pending=False):
+    """Deletes the files a server no longer shows.
+
+    These are the files removed in its current generation or before, and,
+    unless 'keep_pending' is True, the changes made by an indexing that
+    didn't complete. The server must be locked. Returns the number of
+    deleted files.
+    """
+    qn = connection.ops.quote_name
+    table = qn(File._meta.db_table)
+    server_column = qn(File._meta.get_field('server').column)
+    with transaction.commit_on_success():
+        cursor = connection.cursor()
+        if keep_pending:
+            cursor.execute(
+                    'DELETE FROM %s WHERE %s = %%s AND removed_in <= %%s' % (
+                            table, server_column),
+                    [server.address, server.generation])
+            return cursor.rowcount
+        # Undo the removals of an indexing that didn't complete
+        cursor.execute(
+                'UPDATE %s SET removed_in = NULL '
+                'WHERE %s = %%s AND removed_in > %%s' % (
+                        table, server_column),
+                [server.address, server.generation])
+        cursor.execute(
+                'DELETE FROM %s '
+                'WHERE %s = %%s AND (removed_in <= %%s OR added_in > %%s)' % (
+                        table, server_column),
+                [server.address, server.generation, server.generation])
+        return cursor.rowcount
+
+
+def prune_changes(before):
+    """Deletes the entries of the change log older than 'before'"""
+    qn = connection.ops.quote_name
+    with transaction.commit_on_success():
+        cursor = connection.cursor()
+        cursor.execute(
+                'DELETE FROM %s WHERE %s < %%s' % (
+                        qn(FileChange._meta.db_table),
+                        qn(FileChange._meta.get_field('date').column)),
+                [connection.ops.value_to_db_datetime(before)])
+        return cursor.rowcount
 
 
 class Indexer:
@@ -88,8 +211,20 @@ class Indexer:
             SCAN_COUNT=200, INDEX_COUNT=10,
             PRUNE_FTP_TIME=7*24*3600,
             SEARCH_ON_USER=True, USER_IN_RANGE_ONLY=True,
-            TIMEOUT=2, HOSTNAME_STRIP_SUFFIX=()):
+            TIMEOUT=2, HOSTNAME_STRIP_SUFFIX=(),
+            INDEX_WORKERS=4, CYCLE_DEADLINE=None,
+            PURGE_CHUNK_SIZE=10000, PROFILE_DELAY=7*24*3600,
+            DNS_CACHE_TIME=60*60,
+            UNKNOWN_TIMEOUT=None, MIN_TIMEOUT=0.2, MAX_TIMEOUT=30,
+            WALK_RETRIES=3, WALK_RETRY_DELAY=1,
+            PATH_FILTER_FP_RATE=0.001, CHANGES_RETENTION=30*24*3600,
+            CHECKPOINT_EVERY=10000, CHECKPOINT_MAX_AGE=24*3600,
+            DISCOVERY_SOURCES=(),
+            MAX_CONNECTION_RATE=None, MAX_CONNECTIONS_PER_HOST=None,
+            MAX_CONNECTIONS_PER_SUBNET=None, MAX_LISTING_RATE=None):
         self.ip_ranges = parse_ip_ranges(IP_RANGES)
+        self.discovery_sources = [make_source(spec)
+                                  for spec in DISCOVERY_SOURCES]
         self.scan_delay = SCAN_DELAY
         self.index_delay = INDEX_DELAY
         self.scan_count = SCAN_COUNT
@@ -99,8 +234,39 @@ class Indexer:
         self.user_in_range_only = USER_IN_RANGE_ONLY
         self.timeout = TIMEOUT
         self.hostname_strip_suffix = HOSTNAME_STRIP_SUFFIX
+        self.index_workers = INDEX_WORKERS
+        self.cycle_deadline = CYCLE_DEADLINE
+        self.purge_chunk_size = PURGE_CHUNK_SIZE
+        self.profile_delay = PROFILE_DELAY
+        self.dns_cache_time = DNS_CACHE_TIME
+        self._server_names = {}
+        self.timeouts = TimeoutPolicy(TIMEOUT, UNKNOWN_TIMEOUT,
+                                      MIN_TIMEOUT, MAX_TIMEOUT)
+        self._timeouts_loaded = False
+        self.walk_retries = WALK_RETRIES
+        self.walk_retry_delay = WALK_RETRY_DELAY
+        self.path_filter_fp_rate = PATH_FILTER_FP_RATE
+        self.changes_retention = CHANGES_RETENTION
+        self.checkpoint_every = CHECKPOINT_EVERY
+        self.checkpoint_max_age = CHECKPOINT_MAX_AGE
+        self.budget = NetworkBudget(MAX_CONNECTION_RATE,
+                                    MAX_CONNECTIONS_PER_HOST,
+                                    MAX_CONNECTIONS_PER_SUBNET,
+                                    MAX_LISTING_RATE)
 
     def _defaultServerName(self, address):
+        # Cached, as the daemon asks for the same servers over and over
+        try:
+            name, expires = self._server_names[address]
+            if expires > time.time():
+                return name
+        except KeyError:
+            pass
+        name = self._lookupServerName(address)
+        self._server_names[address] = name, time.time() + self.dns_cache_time
+        return name
+
+    def _lookupServerName(self, address):
         try:
             names = socket.gethostbyaddr(address)
             name = names[0]
@@ -112,13 +278,51 @@ class Indexer:
         except socket.herror:
             return ''
 
+    def _load_timeouts(self):
+        """Gets the response times measured by previous runs"""
+        if self._timeouts_loaded:
+            return
+        self._timeouts_loaded = True
+        for address, rtt, variance in (ServerProfile.objects
+                .exclude(rtt=None)
+                .values_list('server', 'rtt', 'rtt_variance')):
+            self.timeouts.load(address, rtt, variance)
+
+    def _probe(self, address):
+        """Checks if an FTP answers, with a timeout adapted to the address
+
+        Returns None without waiting if the connections allowed to the host
+        or its network are all in use, by an indexing for instance.
+        """
+        timeout = self.timeouts.connect_timeout(address)
+        with self.budget.connection(address, blocking=False) as acquired:
+            if not acquired:
+                return None
+            start = time.time()
+            online = ftp_online(address, timeout)
+            if (not online and timeout < self.timeout and
+                    self.timeouts.is_known(address)):
+                # Don't declare a known server offline because of a short
+                # timeout
+                self.budget.new_connection()
+                start = time.time()
+                online = ftp_online(address, self.timeout)
+        if online:
+            self.timeouts.observe(address, time.time() - start)
+        return online
+
     def _scan_address(self, address, ftp_object=None):
         if isinstance(address, IP):
             address = str(address)
         elif not isinstance(address, str):
             raise TypeError("_scan_address expected IP or str, got %s" %
                     type(address))
-        if ftp_online(address, self.timeout):
+        online = self._probe(address)
+        if online is None:
+            # Busy: check it next time rather than hold a scanning thread
+            logger.debug(ugettext(u"%s is busy, not probed"), address)
+            return None
+        if online:
             try:
                 if not ftp_object:
                     ftp_object = FtpServer.objects.get(address=address)
@@ -128,9 +332,12 @@ class Indexer:
                         logger.info(ugettext(u"%s is still online"), name)
                     else:
                         logger.warn(ugettext(u"%s is now online"), name)
+                was_online = ftp_object.online
                 ftp_object.online = True
                 ftp_object.last_online = timezone.now()
                 ftp_object.save()
+                if not was_online:
+                    ftp_object.update_files_online()
             except FtpServer.DoesNotExist:
                 logger.warn(ugettext(u"discovered new server at %s\n"),
                             address)
@@ -149,8 +356,11 @@ class Indexer:
                         logger.info(ugettext(u"%s is still offline"), name)
                     else:
                         logger.warn(ugettext(u"%s is now offline"), name)
+                was_online = ftp_object.online
                 ftp_object.online = False
                 ftp_object.save()
+                if was_online:
+                    ftp_object.update_files_online()
             except FtpServer.DoesNotExist:
                 logger.debug(ugettext(u"%s didn't respond"), address)
             return False
@@ -163,10 +373,8 @@ class Indexer:
     # Check all the already-discovered FTPs
     def check_all_statuses(self):
         """Check if the known FTPs are online"""
-        all_servers = list((IP(ftp.address), ftp)
-                           for ftp in FtpServer.objects.all())
-        with ThreadPoolExecutor(max_workers=64) as executor:
-            executor.map(self._scan_address, all_servers)
+        self._scan_all((IP(ftp.address), ftp)
+                       for ftp in FtpServer.objects.all())
 
     # Check a specific list of FTPs
     def check_statuses(self, servers):
@@ -192,9 +400,19 @@ class Indexer:
             address = IP(address)
         address = str(address)
 
+        # All the connections of an indexing count as one towards the
+        # limits of the server
+        with self.budget.connection(address):
+            return self._index(address)
+
+    def _index(self, address):
+        self._load_timeouts()
+        timeout = self.timeouts.session_timeout(address)
         try:
-            ftp = ftplib.FTP(timeout=self.timeout)
+            ftp = ftplib.FTP(timeout=timeout)
+            connect_start = time.time()
             ftp.connect(address)
+            self.timeouts.observe(address, time.time() - connect_start)
         # Server offline
         except ftplib.all_errors:
             try:
@@ -202,6 +420,7 @@ class Indexer:
                 if server.online:
                     server.online = False
                     server.save()
+                    server.update_files_online()
             except FtpServer.DoesNotExist:
                 pass
             raise
@@ -212,32 +431,113 @@ class Indexer:
         with ServerIndexingLock(address) as server:
             try:
                 ftp.login()
-                try:
-                    ftp.sendcmd('OPTS UTF8 ON')
-                except ftplib.error_perm:
-                    logger.warn(ugettext(u"server %s doesn't seem to handle "
-                                         "unicode. Brace yourselves."),
-                                address)
-
-                # Fetch all the files currently known
-                files = dict((f.fullpath(), f) for f in File.objects.filter(server=server))
+                profile = self._get_profile(server, ftp)
+                estimator = self.timeouts.get(address)
+                profile.rtt = estimator.rtt
+                profile.rtt_variance = estimator.variance
+                self._setup_session(ftp, profile, address)
+
+                connections = [ftp]
+
+                def reconnect():
+                    self.budget.new_connection()
+                    new_ftp = ftplib.FTP(timeout=timeout)
+                    connections.append(new_ftp)
+                    new_ftp.connect(address)
+                    new_ftp.login()
+                    self._setup_session(new_ftp, profile, address)
+                    return new_ftp
+
+                # The first indexing of a server isn't logged as changes
+                log_changes = server.last_indexed is not None
+                completed = None
+                save_progress = None
+                # Changes to the statistics, see yoppi.ftp.statistics
+                deltas = {}
+                if is_sharded():
+                    # The server's database is written from scratch
+                    files = {}
+                    previous = dict((f.fullpath(), f)
+                                    for f in ShardQuery().fetch(server))
+                else:
+                    checkpoint = self._get_checkpoint(server)
+                    completed = checkpoint.get_completed()
+                    if completed:
+                        logger.warn(ugettext(u"resuming the indexing of "
+                                             "%(address)s, %(nb_dirs)d "
+                                             "directories already done"),
+                                    dict(address=address,
+                                         nb_dirs=len(completed)))
+                    # Forget the files of the previous generations
+                    collect_garbage(server, keep_pending=bool(completed))
+                    # Fetch all the files currently known
+                    files = dict(
+                            (f.fullpath(), f)
+                            for f in server.files.visible())
+                    previous = files.copy()
+
+                    def save_progress(completed, to_insert, to_delete,
+                                      removed):
+                        # Written in the next generation, still hidden; the
+                        # changes are logged when it is shown
+                        self._write_generation(server, to_insert, to_delete)
+                        statistics.count_changes(deltas, previous, to_insert,
+                                                 removed)
+                        checkpoint.set_completed(completed)
+                        checkpoint.updated = timezone.now()
+                        checkpoint.save()
 
                 # Recursively walk the FTP
                 to_insert, to_delete, nb_files, total_size = \
-                        walk_ftp(server, ftp, files)
+                        walk_ftp(server, ftp, files, profile,
+                                 reconnect=reconnect,
+                                 retries=self.walk_retries,
+                                 retry_delay=self.walk_retry_delay,
+                                 budget=self.budget,
+                                 completed=completed,
+                                 checkpoint=save_progress,
+                                 checkpoint_every=self.checkpoint_every)
+                profile.save()
                 # The file that were not found need to be deleted as well
                 to_delete.extend(f.id for f in files.itervalues())
 
-                # Update the files in the database
-                File.objects.filter(id__in=to_delete).delete()
-
-                safe_bulk_create(to_insert)
+                if is_sharded():
+                    # All the files were walked again
+                    found = set(f.fullpath() for f in to_insert)
+                    removed = [f for path, f in previous.iteritems()
+                               if path not in found]
+                    if log_changes:
+                        self._log_changes(previous, to_insert, removed)
+                else:
+                    removed = files.values()
+
+                # Update the files
+                if is_sharded():
+                    write_shard(server, to_insert)
+                    # Still counted, the cached listings depend on it
+                    FtpServer.objects.filter(address=address).update(
+                            generation=server.generation + 1)
+                    server.generation += 1
+                    # All the files are at hand
+                    statistics.rebuild(server, to_insert)
+                else:
+                    self._write_generation(server, to_insert, to_delete)
+                    self._switch_generation(server, log_changes)
+                    checkpoint.delete()
+                    if completed or not statistics.has_statistics(server):
+                        # What an interrupted indexing found wasn't counted
+                        statistics.rebuild(server)
+                    else:
+                        statistics.count_changes(deltas, previous, to_insert,
+                                                 removed)
+                        statistics.apply_changes(server, deltas)
 
                 # Update the server
                 server.size = total_size
                 # It will get save()'d when we exit the 'with' block
 
-                ftp.close()
+                for connection in connections:
+                    connection.close()
                 logger.warn(ugettext(u"%(nb_files)d files found on "
                                      "%(address)s, %(total_size)d b"),
                             dict(nb_files=nb_files, address=address,
@@ -248,12 +548,123 @@ class Indexer:
                 server.last_indexed = timezone.now()
                 server.name = name
                 #server.save() # done by ServerIndexingLock
+                build_path_filter(server, self.path_filter_fp_rate)
                 return nb_files, total_size, to_insert, to_delete
             except ftplib.all_errors, e:
                 logger.error(
                         ugettext(u"got error indexing %(server)s: %(error)s"),
                         dict(server=address, error=e.__class__.__name__))
 
+    @staticmethod
+    def _log_changes(previous, to_insert, removed):
+        """Appends what an indexing changed to the change log
+
+        'previous' maps the paths to the files before the indexing,
+        'to_insert' holds the new and changed files (it may hold the
+        unchanged ones too) and 'removed' the files that disappeared.
+        """
+        now = timezone.now()
+        changes = []
+        for f in to_insert:
+            old = previous.get(f.fullpath())
+            if old is None:
+                changes.append(FileChange.from_file(FileChange.ADDED, f, now))
+            elif old.content_key != f.content_key:
+                changes.append(
+                        FileChange.from_file(FileChange.CHANGED, f, now))
+        for f in removed:
+            changes.append(FileChange.from_file(FileChange.REMOVED, f, now))
+        safe_bulk_create(changes, FileChange)
+
+    def _get_checkpoint(self, server):
+        """The progress of the previous indexing of a server, if it can be
+        resumed, or a new checkpoint"""
+        now = timezone.now()
+        try:
+            checkpoint = server.checkpoint
+        except IndexCheckpoint.DoesNotExist:
+            pass
+        else:
+            max_age = datetime.timedelta(seconds=self.checkpoint_max_age)
+            if (checkpoint.generation == server.generation + 1 and
+                    checkpoint.created > now - max_age):
+                return checkpoint
+            checkpoint.delete()
+        return IndexCheckpoint(server=server,
+                               generation=server.generation + 1,
+                               created=now, updated=now)
+
+    @staticmethod
+    def _write_generation(server, to_insert, to_delete):
+        """Writes changes to the next generation of the files of a server,
+        which nobody sees yet"""
+        generation = server.generation + 1
+        File.objects.filter(id__in=to_delete).update(removed_in=generation)
+        for f in to_insert:
+            f.added_in = generation
+            f.current = False
+        safe_bulk_create(to_insert)
+
+    @classmethod
+    def _switch_generation(cls, server, log_changes=False):
+        """Shows the next generation of the files of a server, logging its
+        changes if 'log_changes' is True"""
+        # The old files are deleted later, see collect_garbage()
+        generation = server.generation + 1
+        with transaction.commit_on_success():
+            if log_changes:
+                # Including what the checkpoints wrote, which only shows now
+                files = File.objects.filter(server=server)
+                added = list(files.filter(added_in=generation))
+                previous = dict((f.fullpath(), f) for f in
+                                files.filter(removed_in=generation))
+                found = set(f.fullpath() for f in added)
+                cls._log_changes(previous, added,
+                                 [f for path, f in previous.iteritems()
+                                  if path not in found])
+            File.objects.filter(server=server, added_in=generation).update(
+                    current=True)
+            File.objects.filter(server=server,
+                                removed_in__lte=generation).update(
+                    current=False)
+            FtpServer.objects.filter(address=server.address).update(
+                    generation=generation)
+        server.generation = generation
+        File.objects.update_first_copies(
+                File.objects.filter(Q(added_in=generation) |
+                                    Q(removed_in=generation), server=server)
+                .values_list('content_key', flat=True))
+
+    @staticmethod
+    def _setup_session(ftp, profile, address):
+        # Servers that don't support FEAT might still handle this
+        if profile.utf8 or not profile.features:
+            try:
+                ftp.sendcmd('OPTS UTF8 ON')
+            except ftplib.error_perm:
+                logger.warn(ugettext(u"server %s doesn't seem to handle "
+                                     "unicode. Brace yourselves."),
+                            address)
+
+    def _get_profile(self, server, ftp):
+        """Gets the capabilities of a server, asking it again if needed"""
+        try:
+            profile = server.profile
+        except ServerProfile.DoesNotExist:
+            profile = ServerProfile(server=server)
+        refresh_if_older = timezone.now() - datetime.timedelta(
+                seconds=self.profile_delay)
+        if profile.updated is None or profile.updated <= refresh_if_older:
+            try:
+                profile.set_features(ftp.sendcmd('FEAT'))
+            except ftplib.error_perm:
+                profile.set_features('')
+            profile.updated = timezone.now()
+            logger.info(ugettext(u"features of %(server)s: %(features)s"),
+                        dict(server=server.address,
+                             features=profile.features.replace('\n', ', ')))
+        return profile
+
     def getConfig(self, name, default=None):
         try:
             p = IndexerParameter.objects.get(name=name)
@@ -266,67 +677,299 @@ class Indexer:
         p.save() # Overwrites any existing value
 
     def run(self, args):
+        self.scan_next()
+
+        # Check the known FTPs
+        self.check_all_statuses()
+
+        self.prune()
+
+        self.index_due()
+
+        self.update_name_index()
+
+        self.log_budget()
+
+    def scan_next(self):
+        """Scans the addresses given by the discovery sources, then the next
+        addresses of the configured ranges"""
+        probed = set(self.scan_discovered())
         # Scan the configured number of addresses (or all the addresses in the
         # configured range) from the last scanned address
         # Only the time of last scan of the first address of the ranges is
         # stored to save space; it will be checked against SCAN_DELAY
         # Uses: SCAN_DELAY, SCAN_COUNT
-        last_scanned_ip = self.getConfig('last_scanned_ip')
+        addresses = self._addresses_to_scan()
+        try:
+            self._scan_all((ip, None) for ip in addresses
+                           if str(ip) not in probed)
+        finally:
+            addresses.close()
+
+    def _discovered_addresses(self):
+        """Addresses given by the discovery sources that may be new servers:
+        the ones in IP_RANGES (if set) that aren't known yet"""
+        if not self.discovery_sources:
+            return []
+        known = set(FtpServer.objects.values_list('address', flat=True))
+        addresses = [address for address in discover(self.discovery_sources)
+                     if address not in known]
+        if len(self.ip_ranges):
+            addresses = [address for address in addresses
+                         if self.ip_ranges.contains(address)]
+        return addresses
+
+    def scan_discovered(self):
+        """Probes the addresses given by the discovery sources.
+
+        Returns the addresses that were probed.
+        """
+        # Uses: DISCOVERY_SOURCES
+        addresses = self._discovered_addresses()
+        if addresses:
+            self._scan_all((IP(address), None) for address in addresses)
+            logger.info(ugettext(u"probed %d addresses from the discovery "
+                                 "sources"), len(addresses))
+        return addresses
+
+    def _scan_all(self, servers):
+        """Probes (address, FtpServer or None) pairs in parallel"""
+        self._load_timeouts()
+        with ThreadPoolExecutor(max_workers=64) as executor:
+            futures = dict((executor.submit(self._scan_address, ip, ftp), ip)
+                           for ip, ftp in servers)
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception:
+                    logger.exception("error scanning %s", futures[future])
+
+    def _servers_due(self):
+        """Addresses of the servers to index, least recently indexed first"""
+        # Uses: INDEX_DELAY, INDEX_COUNT
+        index_if_older = timezone.now() - datetime.timedelta(seconds=self.index_delay)
+        return (FtpServer.objects
+                .filter(Q(last_indexed=None) |
+                        Q(last_indexed__lte=index_if_older),
+                        online=True)
+                .order_by('last_indexed')
+                .values_list('address', flat=True)[:self.index_count])
+
+    def index_due(self):
+        """Indexes the FTPs that have been indexed last"""
+        for address in self._servers_due():
+            self._index_logged(address)
+
+    def prune(self):
+        """Removes the old FTPs (that haven't been online in a long time)"""
+        # Uses: PRUNE_FTP_TIME
+        delete_if_older = timezone.now() - datetime.timedelta(seconds=self.prune_ftp_time)
+        for address in (FtpServer.objects.filter(last_online__lte=delete_if_older)
+                        .values_list('address', flat=True)):
+            self.purge(address)
+        self.collect_all_garbage()
+        if self.changes_retention is not None:
+            prune_changes(timezone.now() - datetime.timedelta(
+                    seconds=self.changes_retention))
+
+    def collect_all_garbage(self):
+        """Deletes the files of the previous generations of the servers"""
+        for address in FtpServer.objects.filter(indexing=None).values_list(
+                'address', flat=True):
+            # Lock it like purge_server() does
+            if (FtpServer.objects.filter(indexing=None, address=address)
+                    .update(indexing=timezone.now()) == 0):
+                continue
+            try:
+                server = FtpServer.objects.get(address=address)
+                # Keep what interrupted indexings have done, see
+                # IndexCheckpoint
+                deleted = collect_garbage(server, keep_pending=True)
+            finally:
+                FtpServer.objects.filter(address=address).update(indexing=None)
+            if deleted:
+                logger.info(ugettext(u"deleted %(nb_files)d old files of "
+                                     "%(address)s"),
+                            dict(address=address, nb_files=deleted))
+
+    def purge(self, address):
+        """Forgets a server and its files"""
+        deleted = purge_server(address, self.purge_chunk_size)
+        if deleted is None:
+            logger.warn(ugettext(u"%s is being indexed, not purging"),
+                        address)
+        else:
+            logger.warn(ugettext(u"purged %(address)s, %(nb_files)d files"),
+                        dict(address=address, nb_files=deleted))
+        return deleted
+
+    def _index_logged(self, address):
+        """Indexes a server, logging the errors instead of raising them"""
+        try:
+            self.index(address)
+        except socket.error:
+            logger.info(ugettext(u"%s is offline, not indexing."), address)
+        except ServerAlreadyIndexing:
+            logger.info(ugettext(u"%s is already being indexed"), address)
+        except UnicodeDecodeError, e:
+            logger.error('got %s indexing %s', e.__class__.__name__, address)
+
+    def _addresses_to_scan(self):
+        """Yields the next SCAN_COUNT addresses of the configured ranges.
+
+        The position is saved as the 'last_scanned_ip' parameter when the
+        generator is closed. Stops early when wrapping around to the first
+        address before SCAN_DELAY has passed.
+        """
         first_ip = self.ip_ranges.first()
+        last_scanned_ip = self.getConfig('last_scanned_ip')
         if (last_scanned_ip is None or
                 not self.ip_ranges.contains(last_scanned_ip)):
             last_scanned_ip = first_ip
-
+        scan_count = min(self.scan_count, len(self.ip_ranges))
         try:
-            def ip_generator():
-                scan_count = min(self.scan_count, len(self.ip_ranges))
-                for i, ip in izip(xrange(1, scan_count),
-                                  self.ip_ranges.loop_iter_from(
-                                        ip_generator.last_scanned_ip)):
-                    # Rate limiting: check last time indexed for first address
-                    # last_scan_first_ip is UTC
-                    if ip == first_ip:
-                        try:
-                            last_scan_first_ip = int(self.getConfig(
-                                    'last_scan_first_ip',
-                                    0))
-                            if time.time() - last_scan_first_ip < self.scan_delay:
-                                logger.info("Stopping due to SCAN_DELAY")
-                        except ValueError:
-                            pass
-                        self.setConfig('last_scan_first_ip', time.time())
-                    ip_generator.last_scanned_ip = ip
-                    yield ip
-            ip_generator.last_scanned_ip = last_scanned_ip
-
-            with ThreadPoolExecutor(max_workers=64) as executor:
-                results = executor.map(self._scan_address, ip_generator())
-                next(results) # workaround bug 11777
+            for i, ip in izip(xrange(scan_count),
+                              self.ip_ranges.loop_iter_from(last_scanned_ip)):
+                if ip == first_ip:
+                    try:
+                        last_scan_first_ip = float(self.getConfig(
+                                'last_scan_first_ip', 0))
+                    except ValueError:
+                        last_scan_first_ip = 0
+                    if time.time() - last_scan_first_ip < self.scan_delay:
+                        logger.info("Stopping due to SCAN_DELAY")
+                        return
+                    self.setConfig('last_scan_first_ip', time.time())
+                last_scanned_ip = ip
+                yield ip
         finally:
-            self.setConfig('last_scanned_ip',
-                           str(ip_generator.last_scanned_ip))
-
-        # Check the known FTPs
-        self.check_all_statuses()
+            self.setConfig('last_scanned_ip', str(last_scanned_ip))
+
+    def run_pipelined(self, args):
+        """Runs a cron cycle with scanning and indexing overlapped.
+
+        Addresses are probed by blocks; as soon as a probe finds a server that
+        is new, back online or due for indexing, it is handed to a pool of
+        INDEX_WORKERS indexing threads while the next blocks are being
+        scanned. Nothing new is started once CYCLE_DEADLINE seconds have
+        passed.
+        """
+        if self.cycle_deadline is not None:
+            deadline = time.time() + self.cycle_deadline
+        else:
+            deadline = None
 
-        # Remove the old FTPs (that haven't been online in a long time)
-        # Uses: PRUNE_FTP_TIME
-        delete_if_older = timezone.now() - datetime.timedelta(seconds=self.prune_ftp_time)
-        FtpServer.objects.filter(last_online__lte=delete_if_older).delete()
+        def expired():
+            return deadline is not None and time.time() >= deadline
 
-        # Index the FTPs that have been indexed last
-        # Uses: INDEX_DELAY, INDEX_COUNT
+        self._load_timeouts()
         index_if_older = timezone.now() - datetime.timedelta(seconds=self.index_delay)
-        for ftp in (FtpServer.objects.filter(last_indexed__lte=index_if_older)
-                .order_by('last_indexed')[:self.index_count]):
+        # Known servers: address -> (online, needs indexing)
+        known = dict(
+                (address, (online, last_indexed is None or
+                                   last_indexed <= index_if_older))
+                for address, online, last_indexed in
+                FtpServer.objects.values_list('address', 'online',
+                                              'last_indexed'))
+
+        queued = set()
+        # Indexings started: future -> address
+        indexings = {}
+
+        def wait_indexings():
+            """Waits for the indexings started so far, logging what
+            _index_logged() let through"""
+            for future in as_completed(indexings):
+                try:
+                    future.result()
+                except Exception:
+                    logger.exception("error indexing %s", indexings[future])
+            indexings.clear()
+
+        def index_task(address):
+            if expired():
+                logger.info(ugettext(u"cycle deadline reached, not "
+                                     "indexing %s"), address)
+                return
+            self._index_logged(address)
+
+        with ThreadPoolExecutor(max_workers=self.index_workers) as indexers:
+            def queue_index(address):
+                if address not in queued and len(queued) < self.index_count:
+                    queued.add(address)
+                    indexings[indexers.submit(index_task, address)] = address
+
+            def scan_block(block):
+                with ThreadPoolExecutor(max_workers=64) as scanners:
+                    futures = dict((scanners.submit(self._scan_address, ip),
+                                    ip)
+                                   for ip in block)
+                    for future in as_completed(futures):
+                        address = str(futures[future])
+                        try:
+                            online = future.result()
+                        except Exception:
+                            logger.exception("error scanning %s", address)
+                            continue
+                        was_online, stale = known.get(address, (False, True))
+                        if online and (stale or not was_online):
+                            queue_index(address)
+
+            # Scan the addresses of the discovery sources, then the ranges,
+            # then the known servers that weren't in there
+            scanned = set()
+            discovered = self._discovered_addresses()
+            for i in xrange(0, len(discovered), 64):
+                if expired():
+                    break
+                scan_block(discovered[i:i + 64])
+                scanned.update(discovered[i:i + 64])
+            block = []
+            addresses = self._addresses_to_scan()
             try:
-                self.index(ftp.address)
-            except socket.error:
-                logger.info(ugettext(u"%s is offline, not indexing."),
-                            ftp.address)
-            except UnicodeDecodeError, e:
-                logger.error('got %s indexing %s', e.__class__.__name__,
-                             ftp.address)
+                for ip in addresses:
+                    if str(ip) in scanned:
+                        continue
+                    scanned.add(str(ip))
+                    block.append(ip)
+                    if len(block) == 64:
+                        if expired():
+                            break
+                        scan_block(block)
+                        block = []
+            finally:
+                addresses.close()
+            if block and not expired():
+                scan_block(block)
+            remaining = [str(a) for a in known if str(a) not in scanned]
+            for i in xrange(0, len(remaining), 64):
+                if expired():
+                    break
+                scan_block(remaining[i:i + 64])
+
+            # Don't purge servers while they are being indexed
+            wait_indexings()
+            self.prune()
+
+            # Fill the remaining slots with the servers indexed the longest
+            # time ago
+            for address in self._servers_due():
+                queue_index(str(address))
+            wait_indexings()
+
+        self.update_name_index()
+        self.log_budget()
+
+    def log_budget(self):
+        logger.info(ugettext(u"network use: %s"),
+                    json.dumps(self.budget.stats(), sort_keys=True))
+
+    def update_name_index(self):
+        """Rebuilds the word list used for autocompletion and spelling
+        suggestions"""
+        nb_words = build_name_index()
+        if nb_words is not None:
+            logger.info(ugettext(u"name index rebuilt, %d words"), nb_words)
 
 
 def get_project_indexer():
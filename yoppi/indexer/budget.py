@@ -0,0 +1,183 @@
+"""Limits on the network use of the indexer.
+
+Scanning probes many addresses from 64 threads while indexings hold their
+own connections; without a common limit, bursts saturate the uplink and hit
+the connection limits of the servers, which then time out. A NetworkBudget
+is shared by both: connections are opened at a limited rate, a limited
+number at a time per host and per /24 network, and the listings are
+downloaded at a limited number of bytes per second.
+"""
+import collections
+import contextlib
+import threading
+import time
+
+from yoppi.indexer.timeouts import subnet
+
+
+class TokenBucket(object):
+    """Allows 'rate' units per second, with bursts of up to 'burst' units.
+
+    take() doesn't refuse amounts larger than what is available: it goes
+    into debt and waits until the bucket is back to zero, so that a large
+    transfer delays the next ones instead of being impossible.
+    """
+    def __init__(self, rate, burst=None, clock=time.time, sleep=time.sleep):
+        self.rate = float(rate)
+        if burst is None:
+            burst = rate
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.clock = clock
+        self.sleep = sleep
+        self.updated = clock()
+        self._lock = threading.Lock()
+
+    def take(self, amount=1):
+        """Takes some tokens, waiting if needed; returns the time waited"""
+        with self._lock:
+            now = self.clock()
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= amount
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait > 0:
+            self.sleep(wait)
+        return wait
+
+    def utilization(self):
+        """How much of the burst is in use right now: 0 when the bucket is
+        full, 1 when it is empty, more when takers are waiting"""
+        with self._lock:
+            tokens = min(self.burst, self.tokens +
+                         (self.clock() - self.updated) * self.rate)
+        return (self.burst - tokens) / self.burst
+
+
+class _Slots(object):
+    """Counts the connections in use per key, waiting when 'limit' is
+    reached, or giving up if not 'blocking'"""
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = collections.defaultdict(int)
+        self._condition = threading.Condition()
+
+    def acquire(self, key, blocking=True):
+        """Takes a slot; returns the time waited, or None if the slots were
+        all in use and not 'blocking'"""
+        start = time.time()
+        with self._condition:
+            while self.limit is not None and self.used[key] >= self.limit:
+                if not blocking:
+                    return None
+                self._condition.wait()
+            self.used[key] += 1
+        return time.time() - start
+
+    def release(self, key):
+        with self._condition:
+            self.used[key] -= 1
+            if not self.used[key]:
+                del self.used[key]
+            self._condition.notify_all()
+
+    def in_use(self):
+        """The number of connections in use and of keys using some"""
+        with self._condition:
+            return sum(self.used.itervalues()), len(self.used)
+
+
+class NetworkBudget(object):
+    """Connection and bandwidth limits shared by scanning and indexing.
+
+    Each limit is disabled by None:
+      connections_per_second  rate of new connections
+      per_host                connections open at the same time to a host
+      per_subnet              connections open at the same time to a /24
+      bytes_per_second        rate of the listings downloaded
+    """
+    def __init__(self, connections_per_second=None, per_host=None,
+                 per_subnet=None, bytes_per_second=None):
+        self.connection_bucket = None
+        if connections_per_second is not None:
+            self.connection_bucket = TokenBucket(connections_per_second)
+        self.byte_bucket = None
+        if bytes_per_second is not None:
+            self.byte_bucket = TokenBucket(bytes_per_second)
+        self.limits = dict(connections_per_second=connections_per_second,
+                           per_host=per_host, per_subnet=per_subnet,
+                           bytes_per_second=bytes_per_second)
+        self.hosts = _Slots(per_host)
+        self.subnets = _Slots(per_subnet)
+        self._lock = threading.Lock()
+        self.connections = 0
+        self.connection_wait = 0.0
+        self.bytes = 0
+        self.transfer_wait = 0.0
+
+    def new_connection(self):
+        """Waits until a new connection can be opened"""
+        wait = 0.0
+        if self.connection_bucket is not None:
+            wait = self.connection_bucket.take()
+        with self._lock:
+            self.connections += 1
+            self.connection_wait += wait
+
+    @contextlib.contextmanager
+    def connection(self, address, blocking=True):
+        """Holds one of the connections allowed to a host while a session,
+        which may reconnect with new_connection(), is open
+
+        Yields True, or if not 'blocking' and the host or its network has no
+        connection left, False right away without holding anything.
+        """
+        address = str(address)
+        network = subnet(address)
+        wait = self.subnets.acquire(network, blocking)
+        if wait is None:
+            yield False
+            return
+        try:
+            host_wait = self.hosts.acquire(address, blocking)
+            if host_wait is None:
+                yield False
+                return
+            try:
+                with self._lock:
+                    self.connection_wait += wait + host_wait
+                self.new_connection()
+                yield True
+            finally:
+                self.hosts.release(address)
+        finally:
+            self.subnets.release(network)
+
+    def transfer(self, nbytes):
+        """Accounts for downloaded data, waiting if it was too much"""
+        wait = 0.0
+        if self.byte_bucket is not None:
+            wait = self.byte_bucket.take(nbytes)
+        with self._lock:
+            self.bytes += nbytes
+            self.transfer_wait += wait
+
+    def stats(self):
+        """Counters since the budget was created, and the current use of the
+        rate limits (see TokenBucket.utilization())"""
+        open_connections, busy_hosts = self.hosts.in_use()
+        with self._lock:
+            stats = dict(
+                    connections=self.connections,
+                    connection_wait=round(self.connection_wait, 3),
+                    bytes=self.bytes,
+                    transfer_wait=round(self.transfer_wait, 3),
+                    open_connections=open_connections,
+                    busy_hosts=busy_hosts,
+                    limits=self.limits)
+        for name, bucket in (('connection', self.connection_bucket),
+                             ('transfer', self.byte_bucket)):
+            stats['%s_utilization' % name] = (
+                    round(bucket.utilization(), 3) if bucket else None)
+        return stats
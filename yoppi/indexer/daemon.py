@@ -0,0 +1,216 @@
+"""Long-running indexer process.
+
+Instead of booting Django and building a new Indexer for every cron cycle,
+the daemon keeps one Indexer around (parsed IP ranges, DNS cache, database
+connections) and runs each step of the cycle on its own schedule. It can be
+queried and controlled through a Unix socket.
+"""
+import json
+import logging
+import os
+import Queue
+import socket
+import SocketServer
+import threading
+import time
+
+from django.db import DatabaseError, close_connection
+from django.utils.translation import ugettext
+
+
+logger = logging.getLogger(__name__)
+
+
+class ScheduledTask(object):
+    def __init__(self, name, function, interval):
+        self.name = name
+        self.function = function
+        self.interval = interval
+        self.next_run = 0
+        self.last_run = None
+        self.last_duration = None
+        self.last_error = None
+        self.runs = 0
+
+    def status(self):
+        return dict(interval=self.interval, next_run=self.next_run,
+                    last_run=self.last_run, last_duration=self.last_duration,
+                    last_error=self.last_error, runs=self.runs)
+
+
+class _ControlHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            line = line.strip()
+            if not line:
+                continue
+            response = self.server.indexer_daemon.handle_command(line)
+            self.wfile.write(json.dumps(response) + '\n')
+
+
+class _ControlServer(SocketServer.ThreadingMixIn,
+                     SocketServer.UnixStreamServer):
+    daemon_threads = True
+    # Permissions of the socket
+    mode = 0600
+
+    def server_bind(self):
+        SocketServer.UnixStreamServer.server_bind(self)
+        # Connecting needs write access: only the users allowed to control
+        # the daemon may
+        os.chmod(self.server_address, self.mode)
+
+
+class IndexerDaemon(object):
+    """Runs the scan, status check, prune and index steps on a schedule
+
+    Commands accepted on the control socket, one per line, each answered by a
+    line of JSON:
+      status            the state of each task and the use of the network
+      run <task>        run a task as soon as possible
+      index <address>   index a server as soon as possible
+      stop              finish the current task and exit
+    """
+    def __init__(self, indexer, SOCKET=None, SOCKET_MODE=0600,
+                 SCAN_INTERVAL=5*60, CHECK_INTERVAL=15*60,
+                 PRUNE_INTERVAL=60*60, INDEX_INTERVAL=5*60):
+        self.indexer = indexer
+        self.socket_path = SOCKET
+        self.socket_mode = SOCKET_MODE
+        self.tasks = [
+            ScheduledTask('scan', indexer.scan_next, SCAN_INTERVAL),
+            ScheduledTask('check', indexer.check_all_statuses,
+                          CHECK_INTERVAL),
+            ScheduledTask('prune', indexer.prune, PRUNE_INTERVAL),
+            ScheduledTask('index', self._index_due, INDEX_INTERVAL),
+        ]
+        self.index_requests = Queue.Queue()
+        self.current = None
+        self.started = None
+        self._stopping = threading.Event()
+        self._wakeup = threading.Event()
+        self._control = None
+
+    def _index_due(self):
+        self.indexer.index_due()
+        self.indexer.update_name_index()
+
+    def get_task(self, name):
+        for task in self.tasks:
+            if task.name == name:
+                return task
+        return None
+
+    def handle_command(self, line):
+        words = line.split()
+        command, args = words[0].lower(), words[1:]
+        if command == 'status':
+            return dict(
+                    started=self.started, current=self.current,
+                    pending_index=self.index_requests.qsize(),
+                    network=self.indexer.budget.stats(),
+                    tasks=dict((t.name, t.status()) for t in self.tasks))
+        elif command == 'run' and len(args) == 1:
+            task = self.get_task(args[0])
+            if task is None:
+                return dict(error=u"unknown task %s" % args[0])
+            task.next_run = 0
+        elif command == 'index' and len(args) == 1:
+            self.index_requests.put(args[0])
+        elif command == 'stop':
+            self.stop()
+        else:
+            return dict(error=u"invalid command %s" % line)
+        self._wakeup.set()
+        return dict(ok=True)
+
+    def stop(self):
+        self._stopping.set()
+        self._wakeup.set()
+
+    def _call(self, name, function, *args):
+        self.current = name
+        try:
+            function(*args)
+        except DatabaseError:
+            logger.exception(ugettext(u"database error in %s"), name)
+            # Get a new connection next time
+            close_connection()
+            raise
+        finally:
+            self.current = None
+
+    def run_once(self):
+        """Runs whatever is due; returns the delay until something else is"""
+        while not self.index_requests.empty():
+            address = self.index_requests.get()
+            try:
+                self._call('index %s' % address,
+                           self.indexer._index_logged, address)
+            except Exception:
+                logger.exception(ugettext(u"error indexing %s"), address)
+            if self._stopping.is_set():
+                return 0
+
+        task = min(self.tasks, key=lambda t: t.next_run)
+        now = time.time()
+        if task.next_run > now:
+            return task.next_run - now
+
+        task.last_run = now
+        try:
+            self._call(task.name, task.function)
+        except Exception, e:
+            logger.exception(ugettext(u"error running %s"), task.name)
+            task.last_error = u"%s: %s" % (e.__class__.__name__, e)
+        else:
+            task.last_error = None
+        task.runs += 1
+        task.last_duration = time.time() - now
+        task.next_run = now + task.interval
+        return 0
+
+    def serve(self):
+        """Runs until stop() is called"""
+        self.started = time.time()
+        if self.socket_path:
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+            self._control = _ControlServer(self.socket_path, _ControlHandler,
+                                           bind_and_activate=False)
+            self._control.mode = self.socket_mode
+            try:
+                self._control.server_bind()
+                self._control.server_activate()
+            except Exception:
+                self._control.server_close()
+                self._control = None
+                raise
+            self._control.indexer_daemon = self
+            thread = threading.Thread(target=self._control.serve_forever)
+            thread.daemon = True
+            thread.start()
+        try:
+            while not self._stopping.is_set():
+                delay = self.run_once()
+                if delay > 0:
+                    self._wakeup.wait(delay)
+                    self._wakeup.clear()
+        finally:
+            if self._control is not None:
+                self._control.shutdown()
+                self._control.server_close()
+                os.unlink(self.socket_path)
+            logger.warn(ugettext(u"indexer daemon stopped"))
+
+
+def send_command(socket_path, command):
+    """Sends a command to a running daemon and returns its response"""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+        sock.sendall(command + '\n')
+        response = sock.makefile().readline()
+    finally:
+        sock.close()
+    return json.loads(response)
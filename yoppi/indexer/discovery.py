@@ -0,0 +1,165 @@
+"""Addresses worth probing, read from data the machine already has.
+
+Sweeping IP_RANGES mostly probes addresses where nothing answers. The
+sources here list the hosts known to be up: a file of addresses, the leases
+of a DHCP server, the neighbor table of the kernel. The indexer probes these
+first, and goes on with the sweep to find the servers they don't know of.
+
+A source is an object with an addresses() method returning the addresses as
+strings. DISCOVERY_SOURCES lists them as (kind, arguments...) tuples, where
+kind is one of SOURCES or the dotted path of a class.
+"""
+import abc
+import logging
+import re
+import time
+
+from django.utils.importlib import import_module
+from django.utils.translation import ugettext
+
+from yoppi.indexer.iptools import IP, InvalidAddress
+
+
+logger = logging.getLogger(__name__)
+
+
+def _valid(address):
+    try:
+        IP(address)
+    except InvalidAddress:
+        return False
+    return True
+
+
+class FileSource(object):
+    """Reads the addresses from a file, which is read again every time.
+
+    Subclasses implement parse().
+    """
+    __metaclass__ = abc.ABCMeta
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    def addresses(self):
+        try:
+            with open(self.filename) as fp:
+                return [a for a in self.parse(fp) if _valid(a)]
+        except IOError, e:
+            logger.warn(ugettext(u"can't read discovery source %(file)s: "
+                                 "%(error)s"),
+                        dict(file=self.filename, error=e))
+            return []
+
+    @abc.abstractmethod
+    def parse(self, fp):
+        """Returns or yields the addresses listed in the file object 'fp'"""
+
+
+class HostListSource(FileSource):
+    """One address per line, followed by anything; '#' starts a comment.
+
+    This also reads /etc/hosts files.
+    """
+    def parse(self, fp):
+        for line in fp:
+            fields = line.split('#', 1)[0].split()
+            if fields:
+                yield fields[0]
+
+
+class DhcpLeasesSource(FileSource):
+    """Active leases of ISC dhcpd (dhcpd.leases) or dnsmasq (dnsmasq.leases)
+    """
+    _isc_lease = re.compile(r'^lease\s+(\S+)\s*\{(.*?)^\}',
+                            re.MULTILINE | re.DOTALL)
+    _isc_state = re.compile(r'^\s*binding state\s+(\w+);', re.MULTILINE)
+
+    def parse(self, fp):
+        content = fp.read()
+        if self._isc_lease.search(content):
+            return self._parse_isc(content)
+        else:
+            return self._parse_dnsmasq(content)
+
+    def _parse_isc(self, content):
+        # A lease can be written several times, the last one is current
+        states = {}
+        for m in self._isc_lease.finditer(content):
+            state = self._isc_state.search(m.group(2))
+            states[m.group(1)] = state.group(1) if state else 'active'
+        return [address for address, state in sorted(states.iteritems())
+                if state == 'active']
+
+    def _parse_dnsmasq(self, content):
+        # expiry time, MAC address, IP address, hostname, client id
+        now = time.time()
+        addresses = []
+        for line in content.splitlines():
+            fields = line.split()
+            if len(fields) < 3 or not fields[0].isdigit():
+                continue
+            expiry = int(fields[0])
+            if expiry == 0 or expiry > now:
+                addresses.append(fields[2])
+        return addresses
+
+
+class NeighborTableSource(FileSource):
+    """Hosts the machine has talked to lately: /proc/net/arp, or the output
+    of 'ip neigh show' saved to a file"""
+    _failed_states = ('FAILED', 'INCOMPLETE')
+
+    def __init__(self, filename='/proc/net/arp'):
+        FileSource.__init__(self, filename)
+
+    def parse(self, fp):
+        for line in fp:
+            fields = line.split()
+            if not fields or fields[0] == 'IP':
+                continue
+            if 'dev' in fields:
+                # ip neigh: address dev eth0 lladdr 00:11:22:33:44:55 STALE
+                if fields[-1] not in self._failed_states:
+                    yield fields[0]
+            elif len(fields) >= 4:
+                # /proc/net/arp: address, type, flags, MAC address, mask,
+                # device; the flags are 0 while the address isn't resolved
+                if int(fields[2], 16) != 0:
+                    yield fields[0]
+
+
+SOURCES = {
+    'hosts': HostListSource,
+    'dhcp': DhcpLeasesSource,
+    'neighbors': NeighborTableSource,
+}
+
+
+def make_source(spec):
+    """Creates a source from a (kind, arguments...) tuple"""
+    if isinstance(spec, basestring):
+        kind, args = spec, ()
+    else:
+        kind, args = spec[0], tuple(spec[1:])
+    cls = SOURCES.get(kind)
+    if cls is None:
+        module, sep, name = kind.rpartition('.')
+        if not module:
+            raise ValueError("unknown discovery source %s" % kind)
+        cls = getattr(import_module(module), name)
+    return cls(*args)
+
+
+def discover(sources):
+    """The addresses listed by the sources, without duplicates, in the
+    order they were found"""
+    seen = set()
+    addresses = []
+    for source in sources:
+        for address in source.addresses():
+            address = str(IP(address))
+            if address not in seen:
+                seen.add(address)
+                addresses.append(address)
+    return addresses
@@ -1,3 +1,5 @@
+from optparse import make_option
+
 from django.conf import settings as django_settings
 from django.core.management.base import NoArgsCommand
 from django.utils.translation import pgettext_lazy
@@ -13,6 +15,15 @@ except KeyError:
 
 
 class Command(NoArgsCommand):
+    option_list = NoArgsCommand.option_list + (
+        make_option('--pipelined',
+            action='store_true',
+            dest='pipelined',
+            default=False,
+            help=pgettext_lazy(u"'cron' command",
+                               u"Index servers while the scan is still "
+                               "running")),
+        )
     help = pgettext_lazy(u"help for 'cron' command",
                          u"called regularly to perform the actions configured "
                          "in settings.py")
@@ -22,4 +33,7 @@ class Command(NoArgsCommand):
 
         indexer = Indexer(**settings)
 
-        indexer.run(args)
+        if options['pipelined']:
+            indexer.run_pipelined(args)
+        else:
+            indexer.run(args)
@@ -0,0 +1,29 @@
+import signal
+
+from django.conf import settings as django_settings
+from django.core.management.base import NoArgsCommand
+from django.utils.translation import pgettext_lazy
+
+from yoppi.indexer.app import get_project_indexer
+from yoppi.indexer.daemon import IndexerDaemon
+from yoppi.indexer.management.commands import setup_logging
+
+
+class Command(NoArgsCommand):
+    help = pgettext_lazy(u"help for 'daemon' command",
+                         u"keep running, performing the actions configured "
+                         "in settings.py on a schedule")
+
+    def handle(self, *args, **options):
+        setup_logging(options['verbosity'])
+
+        daemon = IndexerDaemon(
+                get_project_indexer(),
+                **getattr(django_settings, 'INDEXER_DAEMON_SETTINGS', {}))
+
+        def stop(signum, frame):
+            daemon.stop()
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+
+        daemon.serve()
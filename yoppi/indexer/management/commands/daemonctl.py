@@ -0,0 +1,30 @@
+import json
+import socket
+
+from django.conf import settings as django_settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.translation import pgettext_lazy, ugettext
+
+from yoppi.indexer.daemon import send_command
+
+
+class Command(BaseCommand):
+    args = pgettext_lazy(u"args for 'daemonctl' command",
+                         u"status | run <task> | index <address> | stop")
+    help = pgettext_lazy(u"help for 'daemonctl' command",
+                         u"send a command to the running indexer daemon")
+
+    def handle(self, *args, **options):
+        if not args:
+            raise CommandError(ugettext(u"Expected a command"))
+        settings = getattr(django_settings, 'INDEXER_DAEMON_SETTINGS', {})
+        socket_path = settings.get('SOCKET')
+        if not socket_path:
+            raise CommandError(ugettext(u"No control socket is configured"))
+        try:
+            response = send_command(socket_path, ' '.join(args))
+        except socket.error as e:
+            raise CommandError(ugettext(u"Can't reach the daemon: %s") % e)
+        if 'error' in response:
+            raise CommandError(response['error'])
+        self.stdout.write(json.dumps(response, indent=2, sort_keys=True) + '\n')
@@ -41,6 +41,8 @@ class Command(BaseCommand):
             for address in args:
                 self.index(address)
 
+        self.indexer.update_name_index()
+
     def index(self, address):
         try:
             self.indexer.index(address)
@@ -0,0 +1,39 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.translation import pgettext_lazy, ugettext
+
+from yoppi.ftp.models import FtpServer
+from yoppi.indexer.app import get_project_indexer
+from yoppi.indexer.management.commands import setup_logging
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--pruned',
+            action='store_true',
+            dest='pruned',
+            default=False,
+            help=pgettext_lazy(u"'purge' command",
+                               u"Purge the servers that have been offline "
+                               "for more than PRUNE_FTP_TIME")),
+        )
+    args = pgettext_lazy(u"args for 'purge' command",
+                         u"<server_address> [server_address [...]]")
+    help = pgettext_lazy(u"help for 'purge' command",
+                         u"forget the specified FTP servers and their files")
+
+    def handle(self, *args, **options):
+        setup_logging(options['verbosity'])
+        indexer = get_project_indexer()
+
+        if options['pruned']:
+            indexer.prune()
+        else:
+            for address in args:
+                if not FtpServer.objects.filter(address=address).exists():
+                    raise CommandError(
+                            ugettext(u"Nothing matches '%s'") % address)
+                if indexer.purge(address) is None:
+                    raise CommandError(
+                            ugettext(u"%s is already being indexed") % address)
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+
+class Migration(SchemaMigration):
+
+    depends_on = (
+        ('ftp', '0001_initial'),
+    )
+
+    def forwards(self, orm):
+        # Adding model 'ServerProfile'
+        db.create_table('indexer_serverprofile', (
+            ('server', self.gf('django.db.models.fields.related.OneToOneField')(related_name='profile', unique=True, primary_key=True, to=orm['ftp.FtpServer'])),
+            ('features', self.gf('django.db.models.fields.TextField')(default='', blank=True)),
+            ('mlsd', self.gf('django.db.models.fields.BooleanField')(default=False)),
+            ('utf8', self.gf('django.db.models.fields.BooleanField')(default=False)),
+            ('mode_z', self.gf('django.db.models.fields.BooleanField')(default=False)),
+            ('size_command', self.gf('django.db.models.fields.BooleanField')(default=False)),
+            ('mdtm', self.gf('django.db.models.fields.BooleanField')(default=False)),
+            ('listing', self.gf('django.db.models.fields.CharField')(default='', max_length=10, blank=True)),
+            ('encoding', self.gf('django.db.models.fields.CharField')(default='', max_length=20, blank=True)),
+            ('rtt', self.gf('django.db.models.fields.FloatField')(default=None, null=True)),
+            ('updated', self.gf('django.db.models.fields.DateTimeField')(default=None, null=True)),
+        ))
+        db.send_create_signal('indexer', ['ServerProfile'])
+
+
+    def backwards(self, orm):
+        # Deleting model 'ServerProfile'
+        db.delete_table('indexer_serverprofile')
+
+
+    models = {
+        'ftp.ftpserver': {
+            'Meta': {'object_name': 'FtpServer'},
+            'address': ('django.db.models.fields.CharField', [], {'max_length': '15', 'primary_key': 'True'}),
+            'indexing': ('django.db.models.fields.DateTimeField', [], {'default': 'None', 'null': 'True'}),
+            'last_indexed': ('django.db.models.fields.DateTimeField', [], {'default': 'None', 'null': 'True'}),
+            'last_online': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime(2026, 10, 19, 0, 0)'}),
+            'name': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '200', 'blank': 'True'}),
+            'online': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'size': ('django.db.models.fields.IntegerField', [], {'default': '0'})
+        },
+        'indexer.indexerparameter': {
+            'Meta': {'object_name': 'IndexerParameter'},
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '20', 'primary_key': 'True'}),
+            'value': ('django.db.models.fields.CharField', [], {'max_length': '100', 'blank': 'True'})
+        },
+        'indexer.serverprofile': {
+            'Meta': {'object_name': 'ServerProfile'},
+            'encoding': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '20', 'blank': 'True'}),
+            'features': ('django.db.models.fields.TextField', [], {'default': "''", 'blank': 'True'}),
+            'listing': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '10', 'blank': 'True'}),
+            'mdtm': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'mlsd': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'mode_z': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'rtt': ('django.db.models.fields.FloatField', [], {'default': 'None', 'null': 'True'}),
+            'server': ('django.db.models.fields.related.OneToOneField', [], {'related_name': "'profile'", 'unique': 'True', 'primary_key': 'True', 'to': "orm['ftp.FtpServer']"}),
+            'size_command': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'updated': ('django.db.models.fields.DateTimeField', [], {'default': 'None', 'null': 'True'}),
+            'utf8': ('django.db.models.fields.BooleanField', [], {'default': 'False'})
+        }
+    }
+
+    complete_apps = ['indexer']
\ No newline at end of file
@@ -1,5 +1,9 @@
+import json
+
 from django.db import models
 
+from yoppi.ftp.models import FtpServer
+
 
 class IndexerParameter(models.Model):
     name = models.CharField(
@@ -10,3 +14,63 @@ class IndexerParameter(models.Model):
             "parameter value",
             max_length=100,
             blank=True)
+
+
+class ServerProfile(models.Model):
+    """What an FTP server supports, as found out while indexing it"""
+    server = models.OneToOneField(
+            FtpServer, primary_key=True, related_name='profile')
+    # Raw list of features, as returned by FEAT
+    features = models.TextField(blank=True, default='')
+    mlsd = models.BooleanField(default=False)
+    utf8 = models.BooleanField(default=False)
+    mode_z = models.BooleanField(default=False)
+    size_command = models.BooleanField(default=False)
+    mdtm = models.BooleanField(default=False)
+    # Format of the LIST output and encoding of the file names
+    listing = models.CharField(max_length=10, blank=True, default='')
+    encoding = models.CharField(max_length=20, blank=True, default='')
+    # Smoothed connection time and its variation, in seconds
+    rtt = models.FloatField(null=True, default=None)
+    rtt_variance = models.FloatField(null=True, default=None)
+    updated = models.DateTimeField(
+            "last FEAT date", null=True, default=None)
+
+    def set_features(self, response):
+        """Updates the profile from the response to FEAT"""
+        features = [line.strip() for line in response.splitlines()
+                    if line.startswith(' ')]
+        commands = set(f.split(' ', 1)[0].upper() for f in features)
+        self.features = '\n'.join(features)
+        self.mlsd = 'MLST' in commands
+        self.utf8 = 'UTF8' in commands
+        self.mode_z = any(f.upper() == 'MODE Z' for f in features)
+        self.size_command = 'SIZE' in commands
+        self.mdtm = 'MDTM' in commands
+
+
+class IndexCheckpoint(models.Model):
+    """Progress of an indexing that didn't complete
+
+    The changes in the directories of 'completed' were written as part of
+    the generation 'generation' of the server, which isn't shown yet. The
+    next indexing only walks the other directories and then switches to it.
+    """
+    server = models.OneToOneField(
+            FtpServer, primary_key=True, related_name='checkpoint')
+    generation = models.PositiveIntegerField()
+    # JSON object mapping the raw paths of the directories to their size,
+    # number of files and raw size
+    completed = models.TextField(default='{}')
+    created = models.DateTimeField()
+    updated = models.DateTimeField()
+
+    def get_completed(self):
+        # Raw paths are bytes, which latin-1 maps one to one
+        return dict((path.encode('latin-1'), tuple(values))
+                    for path, values in json.loads(self.completed).iteritems())
+
+    def set_completed(self, completed):
+        self.completed = json.dumps(dict(
+                (path.decode('latin-1'), values)
+                for path, values in completed.iteritems()))
@@ -1,10 +1,22 @@
 # -*- coding: utf-8 -*-
 import warnings
+import datetime
 import itertools
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
 from django.test import TestCase
-from django.utils import unittest
+from django.utils import timezone, unittest
 import mock
 from iptools import IP, IPRange, IPSet, InvalidAddress, parse_ip_ranges
+from yoppi.ftp.models import FtpServer
+from yoppi.ftp.tests import TempDirTestCase
+from yoppi.indexer.app import Indexer
+from yoppi.indexer.discovery import FileSource, discover, make_source
 
 
 class TestIPTools(unittest.TestCase):
@@ -216,6 +228,17 @@ class IndexerTestCase(TestCase):
         files = ftp.files.all()
         self.assertEqual(len(files), 3)
 
+    def test_file_types(self):
+        indexer = self._get_indexer()
+        indexer.index('10.9.8.7')
+
+        from yoppi.ftp.models import File, CATEGORY_OTHER
+        files = File.objects.order_by('name')
+        self.assertEqual([(f.name, f.category, f.extension) for f in files],
+                         [(u' smthg.zip', CATEGORY_OTHER, u'zip'),
+                          (u'mysterio\xfcs.zip', CATEGORY_OTHER, u'zip'),
+                          (u'stuff', CATEGORY_OTHER, u'')])
+
     def test_indexing_twice_doesnt_change_the_db(self):
         indexer = self._get_indexer()
         indexer.index('10.9.8.7')
@@ -227,6 +250,253 @@ class IndexerTestCase(TestCase):
 
         self.assertEqual(ids, new_ids)
 
+    def test_first_copies(self):
+        from yoppi.ftp.models import File
+        from yoppi.indexer.app import purge_server
+        indexer = self._get_indexer()
+        indexer.index('10.9.8.7')
+        indexer.index('10.9.8.8')
+
+        def first_copies():
+            return sorted(File.objects.filter(first_copy=True)
+                          .values_list('server', 'name'))
+        self.assertEqual(first_copies(),
+                         [(u'10.9.8.7', u' smthg.zip'),
+                          (u'10.9.8.7', u'mysterio\xfcs.zip'),
+                          (u'10.9.8.7', u'stuff')])
+
+        # Indexing again keeps them
+        indexer.index('10.9.8.7')
+        self.assertEqual(first_copies()[0][0], u'10.9.8.7')
+
+        indexer._probe = lambda address: False
+        indexer._scan_address('10.9.8.7')
+        self.assertEqual(set(first_copies()), set([
+                (u'10.9.8.8', u' smthg.zip'),
+                (u'10.9.8.8', u'mysterio\xfcs.zip'),
+                (u'10.9.8.8', u'stuff')]))
+
+        purge_server('10.9.8.8')
+        self.assertEqual(first_copies(), [])
+        indexer._probe = lambda address: True
+        indexer._scan_address('10.9.8.7')
+        self.assertEqual(len(first_copies()), 3)
+
+    def test_statistics(self):
+        from yoppi.ftp.models import FtpServer
+        indexer = self._get_indexer()
+        indexer.index('10.9.8.7')
+        indexer.index('10.9.8.7')
+
+        def fake_dir(path, callback):
+            if path == '/':
+                callback('-r--r--r-- 1 ftp ftp 20 Feb 20  2012 new.mp3')
+                callback('drwxr-xr-x 1 ftp ftp  0 Mar 11 13:49 stuff')
+            elif path == '/stuff':
+                callback('-r--r--r-- 1 ftp ftp 1000 Feb 20  2012 mysterioüs.zip')
+        self.FTP().dir = fake_dir
+        indexer.index('10.9.8.7')
+
+        server = FtpServer.objects.get()
+        self.assertEqual(
+                sorted(server.statistics.values_list('extension', 'nb_files',
+                                                     'size')),
+                [(u'mp3', 1, 20), (u'zip', 1, 1000)])
+
+    def test_generations(self):
+        indexer = self._get_indexer()
+        indexer.index('10.9.8.7')
+
+        def fake_dir(path, callback):
+            if path == '/':
+                callback('-r--r--r-- 1 ftp ftp 57 Feb 20  2012 new.zip')
+                callback('drwxr-xr-x 1 ftp ftp  0 Mar 11 13:49 stuff')
+            elif path == '/stuff':
+                callback('-r--r--r-- 1 ftp ftp 1000 Feb 20  2012 mysterioüs.zip')
+        self.FTP().dir = fake_dir
+        indexer.index('10.9.8.7')
+
+        from yoppi.ftp.models import FtpServer, File
+        server = FtpServer.objects.get()
+        self.assertEqual(server.generation, 2)
+        # The removed file is still there, but hidden
+        self.assertEqual(File.objects.count(), 4)
+        self.assertEqual(
+                sorted(File.objects.visible().values_list('name', flat=True)),
+                [u'mysterio\xfcs.zip', u'new.zip', u'stuff'])
+
+        # An indexing that didn't complete leaves files nobody sees
+        File(server=server, path='', name='partial', is_directory=False,
+             size=1, added_in=3, current=False).save()
+        File.objects.filter(name='stuff').update(removed_in=3)
+        self.assertEqual(File.objects.visible().count(), 3)
+        # Decided from the files alone
+        self.assertNotIn('ftp_ftpserver', str(File.objects.visible().query))
+
+        # The prune step only deletes the old generations, in case the
+        # indexing gets resumed
+        indexer.collect_all_garbage()
+        self.assertEqual(File.objects.count(), 4)
+
+        from yoppi.indexer.app import collect_garbage
+        collect_garbage(server)
+        self.assertEqual(
+                sorted(File.objects.values_list('name', 'removed_in')),
+                [(u'mysterio\xfcs.zip', None), (u'new.zip', None),
+                 (u'stuff', None)])
+
+    def test_resume(self):
+        import socket
+        from yoppi.ftp.models import FtpServer, File
+        from yoppi.indexer.app import Indexer
+        from yoppi.indexer.models import IndexCheckpoint
+        listed = []
+
+        def fake_dir(path, callback):
+            listed.append(path)
+            if path == '/':
+                callback('-r--r--r-- 1 ftp ftp 10 Feb 20  2012 a.zip')
+                callback('drwxr-xr-x 1 ftp ftp  0 Mar 11 13:49 d1')
+                callback('drwxr-xr-x 1 ftp ftp  0 Mar 11 13:49 d2')
+            elif path == '/d1':
+                callback('-r--r--r-- 1 ftp ftp 100 Feb 20  2012 f1')
+            elif path == '/d2':
+                if fail:
+                    raise socket.error("connection reset")
+                callback('-r--r--r-- 1 ftp ftp 1000 Feb 20  2012 f2')
+        self.FTP().dir = fake_dir
+        indexer = Indexer(WALK_RETRIES=0)
+
+        fail = True
+        indexer.index('10.9.8.7')
+        server = FtpServer.objects.get()
+        self.assertEqual(server.generation, 0)
+        self.assertEqual(File.objects.visible().count(), 0)
+        # /d1 was written, but isn't shown yet
+        self.assertEqual(
+                sorted(File.objects.values_list('name', 'added_in')),
+                [(u'd1', 1), (u'f1', 1)])
+        self.assertEqual(IndexCheckpoint.objects.get().get_completed(),
+                         {'/d1': (100, 1, 100)})
+
+        fail = False
+        del listed[:]
+        indexer.index('10.9.8.7')
+        self.assertEqual(listed, ['/', '/d2'])
+        server = FtpServer.objects.get()
+        self.assertEqual(server.generation, 1)
+        self.assertEqual(server.size, 1110)
+        self.assertEqual(
+                sorted(File.objects.visible().values_list('name', 'size')),
+                [(u'a.zip', 10), (u'd1', 100), (u'd2', 1000), (u'f1', 100),
+                 (u'f2', 1000)])
+        self.assertEqual(File.objects.count(), 5)
+        self.assertEqual(IndexCheckpoint.objects.count(), 0)
+
+    def test_resume_change_log(self):
+        import socket
+        from yoppi.ftp.models import FileChange
+        from yoppi.indexer.app import Indexer
+
+        def fake_dir(path, callback):
+            if path == '/':
+                callback('drwxr-xr-x 1 ftp ftp  0 Mar 11 13:49 d1')
+                callback('drwxr-xr-x 1 ftp ftp  0 Mar 11 13:49 d2')
+            elif path == '/d1':
+                callback('-r--r--r-- 1 ftp ftp %d Feb 20  2012 f1' % size)
+            elif path == '/d2':
+                if fail:
+                    raise socket.error("connection reset")
+                callback('-r--r--r-- 1 ftp ftp 1000 Feb 20  2012 f2')
+        self.FTP().dir = fake_dir
+        indexer = Indexer(WALK_RETRIES=0)
+        fail = False
+        size = 100
+        indexer.index('10.9.8.7')
+
+        # What a checkpoint wrote isn't logged while it is hidden
+        fail = True
+        size = 200
+        indexer.index('10.9.8.7')
+        self.assertEqual(FileChange.objects.count(), 0)
+
+        fail = False
+        indexer.index('10.9.8.7')
+        self.assertEqual(
+                sorted((c.kind, c.fullpath(), c.size)
+                       for c in FileChange.objects.all()),
+                [(FileChange.CHANGED, u'/d1', 200),
+                 (FileChange.CHANGED, u'/d1/f1', 200)])
+
+    def test_sharded(self):
+        from django.test.utils import override_settings
+        from yoppi.ftp.models import FtpServer, File
+        from yoppi.ftp.shards import ShardQuery
+        from yoppi.indexer.app import purge_server
+
+        shard_dir = tempfile.mkdtemp()
+        try:
+            with override_settings(YOPPI_SHARD_DIR=shard_dir):
+                self._get_indexer().index('10.9.8.7')
+                self.assertEqual(File.objects.count(), 0)
+                self.assertEqual(
+                        ShardQuery().values_list('10.9.8.7', 'path', 'name'),
+                        [(u'', u'stuff'), (u'', u' smthg.zip'),
+                         (u'/stuff', u'mysterio\xfcs.zip')])
+                self.assertEqual(FtpServer.objects.get().size, 1057)
+
+                purge_server('10.9.8.7')
+                self.assertEqual(os.listdir(shard_dir), [])
+        finally:
+            shutil.rmtree(shard_dir)
+
+    def test_change_log(self):
+        from yoppi.ftp.models import FileChange
+        indexer = self._get_indexer()
+        indexer.index('10.9.8.7')
+        # The first indexing isn't logged
+        self.assertEqual(FileChange.objects.count(), 0)
+
+        def fake_dir(path, callback):
+            if path == '/':
+                callback('-r--r--r-- 1 ftp ftp 57 Feb 20  2012 new.zip')
+                callback('drwxr-xr-x 1 ftp ftp  0 Mar 11 13:49 stuff')
+            elif path == '/stuff':
+                callback('-r--r--r-- 1 ftp ftp 1200 Feb 20  2012 mysterioüs.zip')
+        self.FTP().dir = fake_dir
+        indexer.index('10.9.8.7')
+        self.assertEqual(
+                sorted((c.kind, c.fullpath(), c.size)
+                       for c in FileChange.objects.all()),
+                [(FileChange.ADDED, u'/new.zip', 57),
+                 (FileChange.REMOVED, u'/ smthg.zip', 57),
+                 # The size of a directory includes its files
+                 (FileChange.CHANGED, u'/stuff', 1200),
+                 (FileChange.CHANGED, u'/stuff/mysterio\xfcs.zip', 1200)])
+
+        response = self.client.get('/new/')
+        self.assertEqual([f.name for f in response.context['files']],
+                         [u'new.zip'])
+
+        response = self.client.get('/api/changes/?since=0&limit=2')
+        feed = json.loads(response.content)
+        self.assertEqual(len(feed['changes']), 2)
+        response = self.client.get('/api/changes/?since=%d' % feed['next'])
+        feed = json.loads(response.content)
+        self.assertEqual(len(feed['changes']), 2)
+        self.assertEqual(
+                self.client.get('/api/changes/?since=%d' % feed['next'])
+                .content, '{"changes": [], "next": %d}' % feed['next'])
+        self.assertEqual(
+                self.client.get('/api/changes/?since=0&limit=-1').content,
+                '{"changes": [], "next": 0}')
+
+        # Old changes are forgotten
+        FileChange.objects.update(
+                date=timezone.now() - datetime.timedelta(days=31))
+        indexer.prune()
+        self.assertEqual(FileChange.objects.count(), 0)
+
     def test_leading_whitespace(self):
         indexer = self._get_indexer()
         indexer.index('10.9.8.7')
@@ -292,6 +562,729 @@ class IndexerTestCase(TestCase):
         file = File.objects.get()
         self.assertEqual(file.name, u'élève.zip')
 
+    def test_profile(self):
+        import ftplib
+
+        def fake_sendcmd(cmd):
+            if cmd == 'FEAT':
+                return ('211-Features:\n MDTM\n MLST type*;size*;\n'
+                        ' UTF8\n MODE Z\n211 End')
+            elif cmd == 'MODE Z':
+                # Advertised but refused, the listings aren't compressed
+                raise ftplib.error_perm('504 Not now')
+            return '200 OK'
+        self.FTP().sendcmd = fake_sendcmd
+
+        def fake_retrlines(cmd, callback):
+            self.assertTrue(cmd.startswith('MLSD '))
+            if cmd == 'MLSD /':
+                callback('type=cdir;size=0; .')
+                callback('type=file;size=57; smthg.zip')
+                callback('type=dir;size=0; stuff')
+                callback('type=OS.unix=symlink;size=3; link')
+            elif cmd == 'MLSD /stuff':
+                callback('type=file;size=1000;modify=20120220000000; a b.zip')
+        self.FTP().retrlines = fake_retrlines
+
+        indexer = self._get_indexer()
+        indexer.index('10.9.8.7')
+
+        from yoppi.ftp.models import File
+        self.assertEqual(
+                sorted(File.objects.values_list('path', 'name', 'size')),
+                [(u'', u'smthg.zip', 57), (u'', u'stuff', 1000),
+                 (u'/stuff', u'a b.zip', 1000)])
+        from yoppi.indexer.models import ServerProfile
+        profile = ServerProfile.objects.get()
+        self.assertTrue(profile.mlsd and profile.utf8 and profile.mode_z and
+                        profile.mdtm)
+        self.assertFalse(profile.size_command)
+        self.assertEqual((profile.listing, profile.encoding),
+                         ('mlsd', 'utf-8'))
+        self.assertNotEqual(profile.rtt, None)
+
+    def test_dos_listing(self):
+        def fake_dir(path, callback):
+            if path == '/':
+                callback('03-11-12  01:49PM       <DIR>          stuff')
+                callback('02-20-12  12:00AM                   57 smthg.zip')
+            elif path == '/stuff':
+                callback('-r--r--r-- 1 ftp ftp 1000 Feb 20  2012 other.zip')
+
+        self.FTP().dir = fake_dir
+
+        indexer = self._get_indexer()
+        indexer.index('10.9.8.7')
+
+        from yoppi.ftp.models import FtpServer
+        ftp = FtpServer.objects.get()
+        self.assertEqual(ftp.size, 1057)
+        self.assertEqual(ftp.profile.listing, 'unix')
+
+
+class FakeFtp(object):
+    def __init__(self, listings):
+        self.listings = listings
+        self.listed = []
+
+    def dir(self, path, callback):
+        self.listed.append(path)
+        for line in self.listings.get(path, []):
+            callback(line)
+
+
+class LocalFtpServer(object):
+    """A small FTP server on localhost, listing 'listings' with LIST, and
+    compressing the listings after MODE Z if 'mode_z' is True -- except for
+    the paths in 'corrupt', for which it sends garbage"""
+    def __init__(self, listings, mode_z=True, corrupt=()):
+        import socket
+        self.listings = listings
+        self.mode_z = mode_z
+        self.corrupt = corrupt
+        self.commands = []
+        self.sent = 0
+        self.sock = socket.socket()
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(1)
+        self.port = self.sock.getsockname()[1]
+        self.thread = threading.Thread(target=self._serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _serve(self):
+        import socket
+        import zlib
+        conn, addr = self.sock.accept()
+        fp = conn.makefile('rb')
+        reply = lambda line: conn.sendall(line + '\r\n')
+        reply('220 Welcome')
+        compress = False
+        data_sock = None
+        for line in fp:
+            command, sep, arg = line.strip().partition(' ')
+            command = command.upper()
+            self.commands.append(line.strip())
+            if command == 'QUIT':
+                reply('221 Bye')
+                break
+            elif command == 'MODE':
+                if arg.upper() == 'Z' and self.mode_z:
+                    compress = True
+                    reply('200 MODE Z ok')
+                elif arg.upper() == 'S':
+                    compress = False
+                    reply('200 MODE S ok')
+                else:
+                    reply('504 Unsupported mode')
+            elif command == 'PASV':
+                data_sock = socket.socket()
+                data_sock.bind(('127.0.0.1', 0))
+                data_sock.listen(1)
+                port = data_sock.getsockname()[1]
+                reply('227 Entering Passive Mode (127,0,0,1,%d,%d)' % (
+                        port >> 8, port & 255))
+            elif command == 'LIST':
+                data, addr = data_sock.accept()
+                reply('150 Listing')
+                content = ''.join('%s\r\n' % l
+                                  for l in self.listings.get(arg, []))
+                if compress:
+                    content = zlib.compress(content)
+                    if arg in self.corrupt:
+                        content = 'x' * len(content)
+                self.sent += len(content)
+                data.sendall(content)
+                data.close()
+                data_sock.close()
+                reply('226 Done')
+            elif command in ('USER', 'PASS', 'TYPE'):
+                reply('200 OK')
+            else:
+                reply('502 Not implemented')
+        conn.close()
+        self.sock.close()
+
+    def connect(self):
+        import ftplib
+        ftp = ftplib.FTP()
+        ftp.connect('127.0.0.1', self.port, timeout=5)
+        ftp.login()
+        return ftp
+
+
+class WalkerTestCase(unittest.TestCase):
+    listings = {
+        '/': ['drwxr-xr-x 1 ftp ftp 4 Mar 11 13:49 a',
+              '-r--r--r-- 1 ftp ftp 1 Feb 20  2012 f1',
+              'drwxr-xr-x 1 ftp ftp 4 Mar 11 13:49 b'],
+        '/a': ['drwxr-xr-x 1 ftp ftp 4 Mar 11 13:49 c',
+               '-r--r--r-- 1 ftp ftp 10 Feb 20  2012 f2'],
+        '/a/c': ['-r--r--r-- 1 ftp ftp 100 Feb 20  2012 f3'],
+        '/b': [],
+    }
+
+    def _walk(self, **kwargs):
+        from yoppi.indexer.walk_ftp import FtpWalker
+        ftp = FakeFtp(self.listings)
+        walker = FtpWalker(mock.Mock(), ftp, str.decode, **kwargs)
+        entries = [(u'%s/%s' % (path, f.name), f.size) for path, f in walker]
+        return ftp, walker, entries
+
+    def test_recursive_sizes(self):
+        ftp, walker, entries = self._walk()
+        self.assertEqual(sorted(entries), [
+                (u'/a', 118), (u'/a/c', 104), (u'/a/c/f3', 100),
+                (u'/a/f2', 10), (u'/b', 4), (u'/f1', 1)])
+        # Directories come after their content
+        self.assertTrue(entries.index((u'/a/c/f3', 100)) <
+                        entries.index((u'/a/c', 104)) <
+                        entries.index((u'/a', 118)))
+
+    def test_order(self):
+        from yoppi.indexer.walk_ftp import BREADTH_FIRST
+        ftp, walker, entries = self._walk()
+        self.assertEqual(ftp.listed, ['/', '/a', '/a/c', '/b'])
+        ftp, walker, entries = self._walk(order=BREADTH_FIRST)
+        self.assertEqual(ftp.listed, ['/', '/a', '/b', '/a/c'])
+        self.assertEqual(len(entries), 6)
+
+    def test_resume(self):
+        ftp, walker, entries = self._walk()
+        self.assertEqual(walker.completed['/a'], (118, 3, 114))
+
+        ftp, walker, entries = self._walk(
+                completed={'/a': walker.completed['/a']})
+        self.assertEqual(ftp.listed, ['/', '/b'])
+        self.assertEqual(sorted(entries), [(u'/b', 4), (u'/f1', 1)])
+        self.assertEqual((walker.skipped_files, walker.skipped_size),
+                         (4, 118))
+
+    def test_checkpoints(self):
+        from yoppi.ftp.models import FtpServer, File, content_key
+        from yoppi.indexer.walk_ftp import walk_ftp
+        db_files = {}
+        for i, (path, name, is_directory, size) in enumerate([
+                (u'/a', u'old', True, 2), (u'/a/old', u'x', False, 2),
+                (u'/a', u'f2', False, 5), (u'', u'z', False, 3)]):
+            db_files[u'%s/%s' % (path, name)] = File(
+                    id=i, path=path, name=name, is_directory=is_directory,
+                    size=size, content_key=content_key(name, size,
+                                                       is_directory))
+        checkpoints = []
+
+        def checkpoint(completed, to_insert, to_delete, removed):
+            checkpoints.append((sorted(completed),
+                                sorted(f.fullpath() for f in to_insert),
+                                sorted(to_delete)))
+
+        to_insert, to_delete, nb_files, total_size = walk_ftp(
+                FtpServer(address='10.9.8.7'), FakeFtp(self.listings),
+                db_files, checkpoint=checkpoint, checkpoint_every=1)
+        # Each checkpoint only has the directories completed since the last
+        # one, along with what was removed under them
+        self.assertEqual([c for c in checkpoints if c[1]], [
+                (['/a/c'], [u'/a/c', u'/a/c/f3'], []),
+                (['/a', '/a/c'], [u'/a', u'/a/f2'], [0, 1, 2]),
+                (['/a', '/a/c', '/b'], [u'/b'], [])])
+        self.assertEqual([f.fullpath() for f in to_insert], [u'/f1'])
+        self.assertEqual(to_delete, [])
+        self.assertEqual(db_files.keys(), [u'/z'])
+
+    def test_retries(self):
+        import ftplib
+        import socket
+        from yoppi.indexer.walk_ftp import FtpWalker
+
+        class FlakyFtp(FakeFtp):
+            def __init__(self, listings, errors):
+                FakeFtp.__init__(self, listings)
+                self.errors = errors
+
+            def dir(self, path, callback):
+                if self.errors:
+                    callback(self.listings[path][0])
+                    raise self.errors.pop(0)
+                FakeFtp.dir(self, path, callback)
+
+        ftp = FlakyFtp(self.listings, [ftplib.error_temp('421 busy'),
+                                        socket.timeout()])
+        new_ftp = FakeFtp(self.listings)
+        with mock.patch('time.sleep') as sleep:
+            walker = FtpWalker(mock.Mock(), ftp, str.decode,
+                               reconnect=lambda: new_ftp, retries=2)
+            self.assertEqual(len(list(walker)), 6)
+        self.assertEqual([c[0][0] for c in sleep.call_args_list], [1, 2])
+        self.assertEqual(ftp.listed, [])
+        self.assertEqual(new_ftp.listed, ['/', '/a', '/a/c', '/b'])
+
+        ftp = FlakyFtp(self.listings, [socket.timeout(), socket.timeout()])
+        with mock.patch('time.sleep'):
+            walker = FtpWalker(mock.Mock(), ftp, str.decode, retries=1)
+            self.assertRaises(socket.timeout, list, walker)
+
+    def test_mlsd_fallback(self):
+        import ftplib
+        from yoppi.indexer.walk_ftp import FtpWalker
+
+        class MlsdFtp(FakeFtp):
+            def retrlines(self, command, callback):
+                path = command.split(' ', 1)[1]
+                self.listed.append(command)
+                if path == '/a/c':
+                    raise ftplib.error_perm('550 Permission denied')
+                if path == '/b':
+                    raise ftplib.error_perm('500 Unknown command')
+                for line in self.listings.get(path, []):
+                    f = line.split()
+                    callback('type=%s;size=%s; %s' % (
+                            'dir' if f[0][0] == 'd' else 'file', f[4], f[8]))
+
+        ftp = MlsdFtp(self.listings)
+        walker = FtpWalker(mock.Mock(), ftp, str.decode, use_mlsd=True)
+        self.assertEqual(len(list(walker)), 6)
+        # A directory that can't be read is tried with LIST, then the
+        # walk goes on with MLSD until the server doesn't know it
+        self.assertEqual(ftp.listed, ['MLSD /', 'MLSD /a', 'MLSD /a/c',
+                                      '/a/c', 'MLSD /b', '/b'])
+        self.assertFalse(walker.use_mlsd)
+
+    def test_mode_z(self):
+        from yoppi.indexer.budget import NetworkBudget
+        from yoppi.indexer.walk_ftp import FtpWalker
+        # Big enough to be worth compressing
+        listings = dict(self.listings)
+        listings['/b'] = ['-r--r--r-- 1 ftp ftp %d Feb 20  2012 file%d' % (
+                i, i) for i in xrange(200)]
+
+        results = []
+        for mode_z in (True, False):
+            server = LocalFtpServer(listings, mode_z=mode_z)
+            ftp = server.connect()
+            budget = NetworkBudget()
+            walker = FtpWalker(mock.Mock(), ftp, str.decode, mode_z=True,
+                               budget=budget)
+            results.append(sorted((u'%s/%s' % (path, f.name), f.size)
+                                  for path, f in walker))
+            ftp.quit()
+            server.thread.join(5)
+            # What went through the network is what was accounted for
+            self.assertEqual(budget.stats()['bytes'], server.sent)
+            self.assertTrue('MODE Z' in server.commands)
+            self.assertEqual(walker.mode_z, mode_z)
+            if mode_z:
+                ratio, saved = walker.compression_stats()
+                self.assertTrue(ratio > 3)
+                self.assertTrue(server.sent * 3 < walker.listing_bytes)
+            else:
+                self.assertEqual(walker.compression_stats(), None)
+                self.assertEqual(server.sent, walker.listing_bytes)
+        self.assertEqual(len(results[0]), 206)
+        self.assertEqual(results[0], results[1])
+
+    def test_mode_z_corrupt(self):
+        from yoppi.indexer.walk_ftp import FtpWalker
+        server = LocalFtpServer(self.listings, corrupt=('/a',))
+        ftp = server.connect()
+        walker = FtpWalker(mock.Mock(), ftp, str.decode, mode_z=True)
+        entries = sorted(u'%s/%s' % (path, f.name) for path, f in walker)
+        ftp.quit()
+        server.thread.join(5)
+        # The directory is listed again uncompressed, and so is the rest
+        self.assertEqual(len(entries), 6)
+        self.assertFalse(walker.mode_z)
+        self.assertEqual([c for c in server.commands
+                          if c.startswith(('MODE', 'LIST'))],
+                         ['MODE Z', 'LIST /', 'LIST /a', 'MODE S', 'LIST /a',
+                          'LIST /a/c', 'LIST /b'])
+
+
+class TimeoutPolicyTestCase(unittest.TestCase):
+    def test_timeouts(self):
+        from yoppi.indexer.timeouts import TimeoutPolicy
+        policy = TimeoutPolicy(2, unknown_timeout=0.5, min_timeout=0.1,
+                               max_timeout=10)
+        self.assertEqual(policy.connect_timeout('10.0.0.1'), 0.5)
+        self.assertEqual(policy.session_timeout('10.0.0.1'), 2)
+
+        policy.observe('10.0.0.1', 0.02)
+        # The first sample gives a variance of half the value
+        self.assertAlmostEqual(policy.connect_timeout('10.0.0.1'), 0.1)
+        # Other addresses in the same /24 get the same estimate
+        self.assertAlmostEqual(policy.connect_timeout('10.0.0.200'), 0.1)
+        self.assertEqual(policy.connect_timeout('10.0.1.1'), 0.5)
+
+        for i in xrange(20):
+            policy.observe('10.0.0.1', 0.02)
+        self.assertAlmostEqual(policy.connect_timeout('10.0.0.1'), 0.1)
+
+        # Slow servers get more time for their sessions
+        policy.load('10.0.2.1', 1.0, 0.5)
+        self.assertAlmostEqual(policy.connect_timeout('10.0.2.1'), 3.0)
+        self.assertAlmostEqual(policy.session_timeout('10.0.2.1'), 10)
+        self.assertAlmostEqual(policy.session_timeout('10.0.0.1'), 2)
+
+
+class NetworkBudgetTestCase(unittest.TestCase):
+    def test_token_bucket(self):
+        from yoppi.indexer.budget import TokenBucket
+        now = [100.0]
+        sleeps = []
+
+        def sleep(delay):
+            sleeps.append(delay)
+            now[0] += delay
+        bucket = TokenBucket(10, clock=lambda: now[0], sleep=sleep)
+
+        # The burst is free, then it's 10 per second
+        for i in xrange(10):
+            self.assertEqual(bucket.take(), 0)
+        self.assertAlmostEqual(bucket.utilization(), 1.0)
+        self.assertAlmostEqual(bucket.take(), 0.1)
+        now[0] += 1
+        self.assertAlmostEqual(bucket.utilization(), 0.0)
+
+        # More than the burst goes into debt
+        self.assertAlmostEqual(bucket.take(25), 1.5)
+        self.assertAlmostEqual(sum(sleeps), 1.6)
+
+    def test_connection_limits(self):
+        from yoppi.indexer.budget import NetworkBudget
+        budget = NetworkBudget(per_host=1, per_subnet=2)
+        opened = threading.Event()
+
+        def connect():
+            with budget.connection('10.0.0.1'):
+                opened.set()
+
+        with budget.connection('10.0.0.1'):
+            thread = threading.Thread(target=connect)
+            thread.start()
+            # Waits for the first connection to be closed
+            self.assertFalse(opened.wait(0.1))
+            stats = budget.stats()
+            self.assertEqual((stats['open_connections'],
+                              stats['busy_hosts']), (1, 1))
+        thread.join(5)
+        self.assertTrue(opened.is_set())
+
+        stats = budget.stats()
+        self.assertEqual(stats['connections'], 2)
+        self.assertEqual(stats['open_connections'], 0)
+
+        # Without blocking, a busy host or subnet is given up right away
+        with budget.connection('10.0.0.1'):
+            with budget.connection('10.0.0.1', blocking=False) as acquired:
+                self.assertFalse(acquired)
+            with budget.connection('10.0.0.2', blocking=False) as acquired:
+                self.assertTrue(acquired)
+                with budget.connection('10.0.0.3',
+                                       blocking=False) as acquired:
+                    self.assertFalse(acquired)
+        self.assertEqual(budget.stats()['open_connections'], 0)
+        self.assertEqual(budget.stats()['connections'], 4)
+        self.assertTrue(stats['connection_wait'] > 0)
+        self.assertEqual(stats['connection_utilization'], None)
+
+    def test_listing_bytes(self):
+        from yoppi.indexer.budget import NetworkBudget
+        from yoppi.indexer.walk_ftp import FtpWalker
+        budget = NetworkBudget(bytes_per_second=1000)
+        listings = WalkerTestCase.listings
+        walker = FtpWalker(mock.Mock(), FakeFtp(listings), str.decode,
+                           budget=budget)
+        list(walker)
+        self.assertEqual(budget.stats()['bytes'],
+                         sum(len(line) + 2 for lines in listings.values()
+                             for line in lines))
+        self.assertTrue(budget.stats()['transfer_utilization'] > 0)
+
+
+class PurgeTestCase(TestCase):
+    def setUp(self):
+        from yoppi.ftp.models import FtpServer, File
+        for address in ('10.0.0.2', '10.0.0.3'):
+            server = FtpServer(address=address)
+            server.save()
+            File.objects.bulk_create([
+                    File(server=server, path='', name='file%d' % i,
+                         is_directory=False, size=i)
+                    for i in xrange(25)])
+
+    def test_purge(self):
+        from yoppi.ftp.models import FtpServer, File
+        from yoppi.indexer.app import purge_server
+        self.assertEqual(purge_server('10.0.0.2', chunk_size=10), 25)
+        self.assertEqual(
+                list(FtpServer.objects.values_list('address', flat=True)),
+                [u'10.0.0.3'])
+        self.assertEqual(File.objects.count(), 25)
+
+    def test_purge_indexing(self):
+        from yoppi.ftp.models import FtpServer, File
+        from yoppi.indexer.app import purge_server
+        from django.utils import timezone
+        FtpServer.objects.filter(address='10.0.0.2').update(
+                indexing=timezone.now())
+        self.assertEqual(purge_server('10.0.0.2'), None)
+        self.assertEqual(File.objects.count(), 50)
+
+    def test_purge_error(self):
+        from django.db import DatabaseError
+        from yoppi.ftp.models import FtpServer, File
+        from yoppi.indexer.app import purge_server
+        with mock.patch.object(File.objects, 'update_first_copies',
+                               side_effect=DatabaseError('oops')):
+            self.assertRaises(DatabaseError, purge_server, '10.0.0.2')
+        # It can still be indexed, or purged again
+        self.assertEqual(
+                FtpServer.objects.get(address='10.0.0.2').indexing, None)
+        self.assertEqual(purge_server('10.0.0.2'), 0)
+
+    def test_prune(self):
+        import datetime
+        from yoppi.ftp.models import FtpServer, File
+        from yoppi.indexer.app import Indexer
+        from django.utils import timezone
+        FtpServer.objects.filter(address='10.0.0.3').update(
+                last_online=timezone.now() - datetime.timedelta(days=10))
+        Indexer().prune()
+        self.assertEqual(
+                list(FtpServer.objects.values_list('address', flat=True)),
+                [u'10.0.0.2'])
+        self.assertEqual(File.objects.count(), 25)
+
+
+class ServerStateTestCase(TestCase):
+    def test_files_follow_the_server(self):
+        from yoppi.ftp.models import FtpServer, File
+        from yoppi.indexer.app import Indexer
+        server = FtpServer(address='10.0.0.2', online=True)
+        server.save()
+        File.objects.bulk_create([
+                File(server=server, path='', name='file%d' % i,
+                     is_directory=False, size=i)
+                for i in xrange(5)])
+        indexer = Indexer()
+
+        indexer._probe = lambda address: False
+        indexer._scan_address('10.0.0.2')
+        self.assertEqual(
+                File.objects.filter(server_online=False).count(), 5)
+
+        indexer._probe = lambda address: True
+        indexer._scan_address('10.0.0.2')
+        self.assertEqual(
+                File.objects.filter(server_online=True).count(), 5)
+
+
+class PipelinedRunTestCase(TestCase):
+    def setUp(self):
+        from yoppi.ftp.models import FtpServer
+        from django.utils import timezone
+        FtpServer(address='10.0.0.2', online=True,
+                  last_indexed=timezone.now()).save()
+        FtpServer(address='10.0.0.3', online=False,
+                  last_indexed=timezone.now()).save()
+
+        from yoppi.indexer.app import Indexer
+        self.indexer = Indexer(IP_RANGES=[('10.0.0.1', '10.0.0.8')],
+                               SCAN_COUNT=8, INDEX_COUNT=10)
+        self.scanned = []
+        self.indexed = []
+
+        # These run in other threads and shouldn't touch the database
+        def fake_scan(address, ftp_object=None):
+            self.scanned.append(str(address))
+            return str(address) in ('10.0.0.2', '10.0.0.3', '10.0.0.5')
+        self.indexer._scan_address = fake_scan
+        self.indexer.index = self.indexed.append
+        self.indexer.prune = lambda: None
+        self.indexer.update_name_index = lambda: None
+
+    def test_new_and_back_online_are_indexed(self):
+        self.indexer.run_pipelined(())
+        self.assertEqual(len(self.scanned), 8)
+        self.assertEqual(sorted(self.indexed), ['10.0.0.3', '10.0.0.5'])
+
+    def test_deadline(self):
+        self.indexer.cycle_deadline = 0
+        self.indexer.run_pipelined(())
+        self.assertEqual(self.indexed, [])
+
+    def test_errors(self):
+        def index(address):
+            self.indexed.append(address)
+            if address == '10.0.0.5':
+                raise ValueError('oops')
+        self.indexer.index = index
+        pruned = []
+        self.indexer.prune = lambda: pruned.append(sorted(self.indexed))
+        with mock.patch('yoppi.indexer.app.logger') as logger:
+            self.indexer.run_pipelined(())
+        # The indexings are over before pruning, and their errors logged
+        self.assertEqual(pruned, [['10.0.0.3', '10.0.0.5']])
+        logger.exception.assert_called_once_with("error indexing %s",
+                                                 '10.0.0.5')
+
+
+class DiscoveryTestCase(TempDirTestCase):
+    def _file(self, name, content):
+        filename = os.path.join(self.directory, name)
+        with open(filename, 'w') as fp:
+            fp.write(content)
+        return filename
+
+    def test_sources(self):
+        hosts = self._file('hosts', (
+                "# servers\n"
+                "10.0.0.4 ftp.example.com\n"
+                "\n"
+                "10.0.0.9  # old one\n"
+                "not-an-address\n"))
+        isc = self._file('dhcpd.leases', (
+                "lease 10.0.0.5 {\n"
+                "  starts 4 2026/10/15 10:00:00;\n"
+                "  binding state active;\n"
+                "}\n"
+                "lease 10.0.0.6 {\n"
+                "  binding state free;\n"
+                "}\n"
+                "lease 10.0.0.9 {\n"
+                "  binding state free;\n"
+                "}\n"
+                "lease 10.0.0.9 {\n"
+                "  binding state active;\n"
+                "}\n"))
+        dnsmasq = self._file('dnsmasq.leases', (
+                "%d 00:11:22:33:44:55 10.0.0.7 laptop *\n"
+                "%d 00:11:22:33:44:56 10.0.0.8 gone *\n"
+                "0 00:11:22:33:44:57 10.0.0.10 static *\n") % (
+                        time.time() + 3600, time.time() - 3600))
+        arp = self._file('arp', (
+                "IP address       HW type     Flags       HW address            Mask     Device\n"
+                "10.0.0.2         0x1         0x2         00:11:22:33:44:55     *        eth0\n"
+                "10.0.0.3         0x1         0x0         00:00:00:00:00:00     *        eth0\n"))
+        neigh = self._file('neigh', (
+                "10.0.0.11 dev eth0 lladdr 00:11:22:33:44:55 STALE\n"
+                "10.0.0.12 dev eth0  FAILED\n"))
+
+        self.assertEqual(make_source(('hosts', hosts)).addresses(),
+                         ['10.0.0.4', '10.0.0.9'])
+        self.assertEqual(make_source(('dhcp', isc)).addresses(),
+                         ['10.0.0.5', '10.0.0.9'])
+        self.assertEqual(make_source(('dhcp', dnsmasq)).addresses(),
+                         ['10.0.0.7', '10.0.0.10'])
+        self.assertEqual(make_source(('neighbors', arp)).addresses(),
+                         ['10.0.0.2'])
+        self.assertEqual(make_source(('neighbors', neigh)).addresses(),
+                         ['10.0.0.11'])
+        self.assertEqual(
+                discover([make_source(('hosts', hosts)),
+                          make_source(('dhcp', isc))]),
+                ['10.0.0.4', '10.0.0.9', '10.0.0.5'])
+
+        # Missing files are ignored
+        self.assertEqual(
+                make_source(('hosts', os.path.join(self.directory, 'nope')))
+                .addresses(), [])
+        self.assertRaises(ValueError, make_source, ('nope', hosts))
+        # Sources reading files have to parse them
+        self.assertRaises(TypeError, FileSource, hosts)
+
+    def test_scan_discovered_first(self):
+        FtpServer(address='10.0.0.2').save()
+        hosts = self._file('hosts', "10.0.0.2\n10.0.0.6\n10.1.0.1\n")
+        indexer = Indexer(IP_RANGES=[('10.0.0.1', '10.0.0.4'),
+                                     ('10.0.0.6', '10.0.0.6')],
+                          SCAN_COUNT=3, DISCOVERY_SOURCES=[('hosts', hosts)])
+        scanned = []
+
+        def fake_scan(address, ftp_object=None):
+            scanned.append(str(address))
+            return False
+        indexer._scan_address = fake_scan
+
+        # Known servers and addresses out of the ranges aren't probed, and
+        # the sweep doesn't probe the same address again
+        indexer.scan_next()
+        self.assertEqual(scanned[0], '10.0.0.6')
+        self.assertEqual(sorted(scanned[1:]),
+                         ['10.0.0.1', '10.0.0.2', '10.0.0.3'])
+        del scanned[:]
+        indexer.scan_next()
+        self.assertEqual(scanned[0], '10.0.0.6')
+        self.assertEqual(sorted(scanned[1:]), ['10.0.0.3', '10.0.0.4'])
+
+
+class DaemonTestCase(unittest.TestCase):
+    def setUp(self):
+        from yoppi.indexer.daemon import IndexerDaemon
+        self.indexer = mock.Mock()
+        self.indexer.budget.stats.return_value = dict(connections=0)
+        self.daemon = IndexerDaemon(self.indexer, SCAN_INTERVAL=60,
+                                    CHECK_INTERVAL=120, PRUNE_INTERVAL=3600,
+                                    INDEX_INTERVAL=60)
+
+    def test_schedule(self):
+        # Everything runs once, then waits
+        for i in xrange(4):
+            self.assertEqual(self.daemon.run_once(), 0)
+        self.assertTrue(0 < self.daemon.run_once() <= 60)
+        self.assertEqual(self.indexer.scan_next.call_count, 1)
+        self.assertEqual(self.indexer.check_all_statuses.call_count, 1)
+        self.assertEqual(self.indexer.prune.call_count, 1)
+        self.assertEqual(self.indexer.index_due.call_count, 1)
+
+        self.assertEqual(self.daemon.handle_command('run prune'), dict(ok=True))
+        self.assertEqual(self.daemon.run_once(), 0)
+        self.assertEqual(self.indexer.prune.call_count, 2)
+
+    def test_errors(self):
+        self.indexer.scan_next.side_effect = ValueError('oops')
+        logging.disable(logging.ERROR)
+        try:
+            for i in xrange(4):
+                self.daemon.run_once()
+        finally:
+            logging.disable(logging.NOTSET)
+        status = self.daemon.handle_command('status')
+        self.assertEqual(status['tasks']['scan']['last_error'],
+                         u"ValueError: oops")
+        self.assertEqual(status['tasks']['prune']['runs'], 1)
+
+    def test_control_socket(self):
+        from yoppi.indexer.daemon import send_command
+        directory = tempfile.mkdtemp()
+        try:
+            self.daemon.socket_path = os.path.join(directory, 'control')
+            thread = threading.Thread(target=self.daemon.serve)
+            thread.start()
+            for i in xrange(100):
+                if os.path.exists(self.daemon.socket_path):
+                    break
+                time.sleep(0.01)
+            # Only its owner can control it
+            self.assertEqual(
+                    os.stat(self.daemon.socket_path).st_mode & 0777, 0600)
+            send = lambda cmd: send_command(self.daemon.socket_path, cmd)
+            self.assertEqual(send('index 10.0.0.1'), dict(ok=True))
+            for i in xrange(100):
+                if self.indexer._index_logged.called:
+                    break
+                time.sleep(0.01)
+            self.assertTrue('error' in send('frobnicate'))
+            status = send('status')
+            self.assertEqual(set(status['tasks']),
+                             set(['scan', 'check', 'prune', 'index']))
+            self.assertEqual(status['network'], dict(connections=0))
+            self.assertEqual(send('stop'), dict(ok=True))
+            thread.join(5)
+            self.assertFalse(thread.is_alive())
+            self.indexer._index_logged.assert_called_with('10.0.0.1')
+        finally:
+            shutil.rmtree(directory)
+
 
 if __name__ == '__main__':
     unittest.main()
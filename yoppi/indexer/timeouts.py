@@ -0,0 +1,93 @@
+import threading
+
+from yoppi.indexer.iptools import IP
+
+
+class RttEstimator(object):
+    """Smoothed round-trip time and its variation, as computed by TCP
+
+    See RFC 6298.
+    """
+    def __init__(self, rtt=None, variance=None):
+        self.rtt = rtt
+        if rtt is not None and variance is None:
+            variance = rtt / 2.0
+        self.variance = variance
+
+    def add(self, rtt):
+        if self.rtt is None:
+            self.rtt = rtt
+            self.variance = rtt / 2.0
+        else:
+            self.variance = 0.75 * self.variance + 0.25 * abs(self.rtt - rtt)
+            self.rtt = 0.875 * self.rtt + 0.125 * rtt
+
+    def timeout(self):
+        return self.rtt + 4 * self.variance
+
+
+def subnet(address):
+    """The /24 network an address is in"""
+    return IP(address).num >> 8
+
+
+class TimeoutPolicy(object):
+    """Picks connection timeouts from the response times seen so far
+
+    Known servers get a timeout derived from their own response times, new
+    addresses one derived from the servers of the same /24 network, and
+    addresses in networks where nothing was ever found 'unknown_timeout'.
+    Timeouts are kept between 'min_timeout' and 'max_timeout'.
+    """
+    def __init__(self, default_timeout, unknown_timeout=None,
+                 min_timeout=0.2, max_timeout=30):
+        self.default_timeout = default_timeout
+        if unknown_timeout is None:
+            unknown_timeout = default_timeout
+        self.unknown_timeout = unknown_timeout
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.hosts = {}
+        self.subnets = {}
+        self._lock = threading.Lock()
+
+    def _clamp(self, timeout):
+        return max(self.min_timeout, min(self.max_timeout, timeout))
+
+    def load(self, address, rtt, variance=None):
+        """Sets the estimate of a host, eg from a previous run"""
+        with self._lock:
+            self.hosts[address] = RttEstimator(rtt, variance)
+            self.subnets.setdefault(subnet(address), RttEstimator()).add(rtt)
+
+    def observe(self, address, rtt):
+        with self._lock:
+            self.hosts.setdefault(address, RttEstimator()).add(rtt)
+            self.subnets.setdefault(subnet(address), RttEstimator()).add(rtt)
+
+    def get(self, address):
+        """The RttEstimator of a host, or None"""
+        return self.hosts.get(address)
+
+    def is_known(self, address):
+        return address in self.hosts
+
+    def connect_timeout(self, address):
+        """Timeout for probing an address"""
+        estimator = self.hosts.get(address)
+        if estimator is None:
+            estimator = self.subnets.get(subnet(address))
+            if estimator is None:
+                return self.unknown_timeout
+        return self._clamp(estimator.timeout())
+
+    def session_timeout(self, address):
+        """Timeout for the commands of a whole session, such as indexing
+
+        Slow servers get more time than the default, never less.
+        """
+        estimator = self.hosts.get(address)
+        if estimator is None:
+            return self.default_timeout
+        return min(self.max_timeout,
+                   max(self.default_timeout, 8 * estimator.timeout()))
@@ -1,7 +1,13 @@
+import collections
+import ftplib
 import logging
 import re
+import socket
+import time
+import zlib
 
-from yoppi.ftp.models import File
+from yoppi.ftp.models import CATEGORY_OTHER, File, content_key, \
+        file_extension, guess_file_category
 from django.utils.translation import ugettext
 
 
@@ -10,10 +16,25 @@ logger = logging.getLogger(__name__)
 
 MAX_DEPTH = 500
 MAX_FILES = 1000000
+MAX_RETRY_DELAY = 30
+
+# Errors after which a listing is worth trying again
+TRANSIENT_ERRORS = (ftplib.error_temp, socket.error, EOFError)
+# Replies to a command the server doesn't handle at all, unlike the ones
+# refusing it for some argument (550 for a directory it can't read, ...)
+UNSUPPORTED_REPLIES = ('500', '502')
 
 class SuspiciousFtp(Exception):
     pass
 
+DIALECT_UNIX = 'unix'
+DIALECT_DOS = 'dos'
+DIALECT_MLSD = 'mlsd'
+
+# Formats of the LIST command, tried in that order
+LIST_DIALECTS = (DIALECT_UNIX, DIALECT_DOS)
+
+
 class RemoteFile:
     # drwxr-xr-x 1 ftp ftp  0 Mar 11 13:49 stuff
     # -r--r--r-- 1 ftp ftp 57 Feb 20  2012 smthg.zip
@@ -28,41 +49,114 @@ class RemoteFile:
     #   5: date
     #   6: filename
 
-    def __init__(self, line, decode=str.decode):
-        m = self._line_regex.match(line)
-        if not m:
+    # 03-11-12  01:49PM       <DIR>          stuff
+    # 02-20-12  12:00AM                   57 smthg.zip
+    _dos_line_regex = re.compile(r"^([0-9]{2}-[0-9]{2}-[0-9]{2,4})\s+([0-9]{2}:[0-9]{2}[AP]M)\s+(<DIR>|[0-9]+)\s+(.+)$")
+    # Groups:
+    #   1: date
+    #   2: time
+    #   3: '<DIR>' or filesize (bytes)
+    #   4: filename
+
+    # type=file;size=57;modify=20120220000000; smthg.zip
+    _mlsd_types = {'file': '-', 'dir': 'd', 'OS.unix=symlink': 'l'}
+
+    def __init__(self, line, decode=str.decode, dialects=LIST_DIALECTS):
+        for dialect in dialects:
+            parsed = getattr(self, '_parse_%s' % dialect)(line)
+            if parsed is not None:
+                break
+        else:
             raise IOError("invalid LIST format : '%s'"%line)
-        self.is_directory = m.group(1)[0] == "d"
-        self.is_link = m.group(1)[0] == 'l'
-        self.raw_size = int(m.group(4))
+        self.dialect = dialect
+        kind, self.raw_size, self.raw_name = parsed
+        self.is_directory = kind == 'd'
+        self.is_link = kind == 'l'
         self.size = self.raw_size
-        self.raw_name = m.group(6)
         self.name = decode(self.raw_name)
+        if self.is_directory or self.is_link:
+            self.category = CATEGORY_OTHER
+            self.extension = u''
+        else:
+            self.category = guess_file_category(self.name)
+            self.extension = file_extension(self.name)
+
+    @classmethod
+    def _parse_unix(cls, line):
+        m = cls._line_regex.match(line)
+        if m:
+            return m.group(1)[0], int(m.group(4)), m.group(6)
+
+    @classmethod
+    def _parse_dos(cls, line):
+        m = cls._dos_line_regex.match(line)
+        if m:
+            if m.group(3) == '<DIR>':
+                return 'd', 0, m.group(4)
+            else:
+                return '-', int(m.group(3)), m.group(4)
+
+    @classmethod
+    def _parse_mlsd(cls, line):
+        try:
+            facts, name = line.split(' ', 1)
+        except ValueError:
+            return None
+        facts = dict(fact.split('=', 1)
+                     for fact in facts.split(';') if '=' in fact)
+        type = facts.get('type', '').lower()
+        if type in ('cdir', 'pdir'):
+            # '.' and '..'; marked as links so that they are skipped
+            return 'l', 0, name
+        kind = cls._mlsd_types.get(type) or cls._mlsd_types.get(
+                facts.get('type'))
+        if kind is None:
+            return None
+        try:
+            size = int(facts.get('size', 0))
+        except ValueError:
+            size = 0
+        return kind, size, name
 
     def __eq__(self, other):
-        if not isinstance(other, RemoteFile) and not isinstance(other, File):
+        if isinstance(other, File):
+            if other.content_key != self.content_key():
+                return False
+        elif not isinstance(other, RemoteFile):
             return False
         return (self.is_directory == other.is_directory and
                 self.size == other.size and
-                self.name == other.name)
+                self.name == other.name and
+                self.category == other.category and
+                self.extension == other.extension)
         # We don't actually need to compare server and path
 
     def __ne__(self, other):
         return not self.__eq__(other)
 
+    def content_key(self):
+        return content_key(self.name, self.size, self.is_directory)
+
     def toFile(self, server, path):
         return File(
                 server=server, path=path,
                 name=self.name, is_directory=self.is_directory,
-                size=self.size)
+                size=self.size,
+                category=self.category, extension=self.extension,
+                content_key=self.content_key(),
+                server_online=server.online)
 
     def __str__(self):
         return self.name
 
 
 class FallbackDecoder(object):
-    def __init__(self):
+    def __init__(self, first=None):
         self.encodings = ['utf-8', 'latin9']
+        # Start with the encoding that worked last time
+        if first in self.encodings:
+            self.encodings.remove(first)
+            self.encodings.insert(0, first)
         self.next_enc()
 
     def next_enc(self):
@@ -81,65 +175,492 @@ class FallbackDecoder(object):
             return self.decode(str)
 
 
-def _yield_files(server, connection, decode, path, depth):
-    if depth > MAX_DEPTH:
-        raise SuspiciousFtp(ugettext(
-            u"%(server)s's directory depth is more than %(max_depth)d. "
-            "It doesn't seem legit.") %
-            dict(server=server.display_name(), max_depth=MAX_DEPTH))
+DEPTH_FIRST = 'depth'
+BREADTH_FIRST = 'breadth'
 
-    files = []
-    connection.dir(path, lambda line: files.append(RemoteFile(line, decode)))
 
-    # For ftp, root is '/', but for us, it's ''
-    if path == '/':
-        path = ''
+class _Directory(object):
+    """A directory queued or being walked by FtpWalker"""
+    __slots__ = ('raw_path', 'path', 'entry', 'parent', 'depth',
+                 'pending', 'nb_files', 'raw_size')
 
-    for f in files:
-        if f.is_link:
-            continue
-        if f.is_directory:
-            for child in _yield_files(server, connection, decode,
-                                      '%s/%s' % (path, f.raw_name),
-                                      depth + 1):
-                f.size += child[1].size
-                yield child
-        yield decode(path), f
+    def __init__(self, raw_path, path, entry, parent, depth):
+        self.raw_path = raw_path  # Full path on the FTP, not decoded
+        self.path = path          # Decoded path of the parent directory
+        self.entry = entry        # RemoteFile for this directory
+        self.parent = parent
+        self.depth = depth
+        self.pending = 0          # Subdirectories not yet completed
+        self.nb_files = 0         # Entries found under this directory
+        self.raw_size = 0         # Sum of their raw sizes
 
 
-def yield_files(server, connection):
+class FtpWalker(object):
+    """Iterates over the ftp and yield all the files as tuples
+    (path, RemoteFile)
+
+    The directories to list are kept in an explicit queue, used as a stack
+    for DEPTH_FIRST order or a FIFO for BREADTH_FIRST. Files are yielded once
+    their directory has been listed; a directory is yielded once all of its
+    descendants have been, so that its size is the recursive size.
+
+    The directories are listed with MLSD if 'use_mlsd' is True, or with LIST,
+    the output of which is parsed according to 'dialects'. The dialect of the
+    last recognized line is moved first.
+
+    A listing that fails with a transient error is retried up to 'retries'
+    times, waiting 'retry_delay' seconds and doubling that each time. On
+    connection errors, 'reconnect' is called (if given) to get a new
+    connection.
+
+    When a directory has been yielded along with all of its descendants, its
+    raw path is recorded in 'completed' as (size, nb_files, raw_size). A
+    dictionary of such directories can be passed back to resume a walk: they
+    are not listed again, and neither they nor their descendants are yielded.
+
+    If 'mode_z' is True, the listings are asked compressed (MODE Z), unless
+    the server refuses it. The size of the listings is accounted for in
+    'budget', a NetworkBudget, which slows the walk down if it downloads too
+    much.
+    """
+    def __init__(self, server, connection, decode, order=DEPTH_FIRST,
+                 completed=None, use_mlsd=False, dialects=LIST_DIALECTS,
+                 reconnect=None, retries=0, retry_delay=1, budget=None,
+                 mode_z=False):
+        self.server = server
+        self.budget = budget
+        self.mode_z = mode_z
+        # The connection on which MODE Z was set
+        self._mode_z_connection = None
+        # Size of the listings; for the compressed ones, their size, what was
+        # actually received and how long that took
+        self.listing_bytes = 0
+        self.compressed_bytes = 0
+        self.compressed_wire_bytes = 0
+        self.compressed_time = 0.0
+        self.connection = connection
+        self.reconnect = reconnect
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.decode = decode
+        self.order = order
+        self.use_mlsd = use_mlsd
+        self.dialects = list(dialects)
+        self.completed = dict(completed or {})
+        # Entries and sizes under the completed directories that were skipped
+        self.skipped_files = 0
+        self.skipped_size = 0
+        self.queue = collections.deque([_Directory('/', u'', None, None, 0)])
+
+    def __iter__(self):
+        queue = self.queue
+        if self.order == BREADTH_FIRST:
+            pop = queue.popleft
+        else:
+            pop = queue.pop
+        while queue:
+            directory = pop()
+            for item in self._list(directory):
+                yield item
+
+    def _list(self, directory):
+        if directory.depth > MAX_DEPTH:
+            raise SuspiciousFtp(ugettext(
+                u"%(server)s's directory depth is more than %(max_depth)d. "
+                "It doesn't seem legit.") %
+                dict(server=self.server.display_name(), max_depth=MAX_DEPTH))
+
+        files = self._read_listing_with_retries(directory.raw_path)
+
+        # For ftp, root is '/', but for us, it's ''
+        raw_path = directory.raw_path
+        if raw_path == '/':
+            raw_path = ''
+        path = self.decode(raw_path)
+
+        subdirs = []
+        for f in files:
+            if f.is_link:
+                continue
+            if f.is_directory:
+                sub_path = '%s/%s' % (raw_path, f.raw_name)
+                try:
+                    size, nb_files, raw_size = self.completed[sub_path]
+                except KeyError:
+                    subdirs.append(_Directory(sub_path, path, f, directory,
+                                              directory.depth + 1))
+                else:
+                    # Already walked: account for it without yielding
+                    f.size = size
+                    self._add(directory, size, nb_files + 1,
+                              raw_size + f.raw_size)
+                    self.skipped_files += nb_files + 1
+                    self.skipped_size += raw_size + f.raw_size
+            else:
+                self._add(directory, f.size, 1, f.raw_size)
+                yield path, f
+
+        directory.pending = len(subdirs)
+        if self.order == BREADTH_FIRST:
+            self.queue.extend(subdirs)
+        else:
+            # Reversed so that they are listed in order
+            self.queue.extend(reversed(subdirs))
+
+        if not subdirs:
+            for item in self._complete(directory):
+                yield item
+
+    def _read_listing_with_retries(self, raw_path):
+        attempt = 0
+        while True:
+            try:
+                return self._read_listing(raw_path)
+            except zlib.error, e:
+                # Not worth retrying: list it again without compression
+                logger.warn(ugettext(u"MODE Z listing of %(path)r on "
+                                     "%(server)s is corrupt (%(error)s), "
+                                     "listing uncompressed"),
+                            dict(path=raw_path, error=e,
+                                 server=self.server.display_name()))
+                self.mode_z = False
+                self._mode_z_connection = None
+                try:
+                    self.connection.sendcmd('MODE S')
+                except ftplib.error_perm:
+                    pass
+            except TRANSIENT_ERRORS, e:
+                attempt += 1
+                if attempt > self.retries:
+                    raise
+                delay = min(self.retry_delay * 2 ** (attempt - 1),
+                            MAX_RETRY_DELAY)
+                logger.info(ugettext(u"listing %(path)r on %(server)s failed "
+                                     "(%(error)s), retrying in %(delay)ds"),
+                            dict(path=raw_path, error=e, delay=delay,
+                                 server=self.server.display_name()))
+                time.sleep(delay)
+                if (self.reconnect is not None and
+                        not isinstance(e, ftplib.error_temp)):
+                    self.connection = self.reconnect()
+
+    def _read_listing(self, raw_path):
+        files = []
+        # Size of the listing, with the line endings
+        received = [0]
+
+        def read(parse):
+            def callback(line):
+                received[0] += len(line) + 2
+                files.append(parse(line))
+            return callback
+
+        if self.use_mlsd:
+            try:
+                wire = self._retrlines(
+                        'MLSD', raw_path,
+                        read(lambda line: RemoteFile(
+                                line, self.decode, (DIALECT_MLSD,))))
+                self._transferred(received[0], wire)
+                return files
+            except ftplib.error_perm, e:
+                if str(e)[:3] in UNSUPPORTED_REPLIES:
+                    logger.warn(ugettext(u"MLSD failed on %(server)s "
+                                         "(%(error)s), using LIST instead"),
+                                dict(server=self.server.display_name(),
+                                     error=e))
+                    self.use_mlsd = False
+                else:
+                    # Only this directory is listed with LIST
+                    logger.info(ugettext(u"MLSD %(path)r failed on "
+                                         "%(server)s (%(error)s), trying "
+                                         "LIST"),
+                                dict(path=raw_path, error=e,
+                                     server=self.server.display_name()))
+                files = []
+                received[0] = 0
+
+        def parse(line):
+            f = RemoteFile(line, self.decode, self.dialects)
+            if f.dialect != self.dialects[0]:
+                self.dialects.remove(f.dialect)
+                self.dialects.insert(0, f.dialect)
+            return f
+        wire = self._retrlines('LIST', raw_path, read(parse))
+        self._transferred(received[0], wire)
+        return files
+
+    def _retrlines(self, command, raw_path, callback):
+        """Runs a listing command; returns the number of bytes received if
+        it was compressed, else None"""
+        if self.mode_z and self._mode_z_connection is not self.connection:
+            try:
+                self.connection.sendcmd('MODE Z')
+                self._mode_z_connection = self.connection
+            except ftplib.error_perm, e:
+                logger.warn(ugettext(u"MODE Z failed on %(server)s "
+                                     "(%(error)s), listing uncompressed"),
+                            dict(server=self.server.display_name(), error=e))
+                self.mode_z = False
+        if self.mode_z:
+            start = time.time()
+            wire = retrlines_compressed(
+                    self.connection, '%s %s' % (command, raw_path), callback)
+            self.compressed_time += time.time() - start
+            return wire
+        if command == 'LIST':
+            self.connection.dir(raw_path, callback)
+        else:
+            self.connection.retrlines('%s %s' % (command, raw_path), callback)
+        return None
+
+    def _transferred(self, size, wire=None):
+        self.listing_bytes += size
+        if wire is None:
+            wire = size
+        else:
+            self.compressed_bytes += size
+            self.compressed_wire_bytes += wire
+        if self.budget is not None:
+            self.budget.transfer(wire)
+
+    def compression_stats(self):
+        """The ratio of the size of the compressed listings to what was
+        received for them, and an estimate of the seconds it saved (if they
+        were limited by the bandwidth); None if nothing was compressed"""
+        if not self.compressed_wire_bytes:
+            return None
+        ratio = float(self.compressed_bytes) / self.compressed_wire_bytes
+        return ratio, self.compressed_time * (ratio - 1)
+
+    @property
+    def dialect(self):
+        """The listing format in use"""
+        if self.use_mlsd:
+            return DIALECT_MLSD
+        return self.dialects[0]
+
+    @staticmethod
+    def _add(directory, size, nb_files, raw_size):
+        if directory.entry is not None:
+            directory.entry.size += size
+        directory.nb_files += nb_files
+        directory.raw_size += raw_size
+
+    def _complete(self, directory):
+        """Yields a directory whose subdirectories have all been walked
+
+        Its parent gets its size, and is completed in turn if it was the last
+        one it was waiting for.
+        """
+        while directory.parent is not None:
+            f = directory.entry
+            self.completed[directory.raw_path] = (
+                    f.size, directory.nb_files, directory.raw_size)
+            yield directory.path, f
+            parent = directory.parent
+            self._add(parent, f.size, directory.nb_files + 1,
+                      directory.raw_size + f.raw_size)
+            parent.pending -= 1
+            if parent.pending > 0:
+                break
+            directory = parent
+
+
+def retrlines_compressed(ftp, command, callback):
+    """Like FTP.retrlines(), for a transfer compressed by MODE Z.
+
+    The data is decompressed as it arrives. Returns the number of bytes
+    received. Raises zlib.error if the data can't be decompressed, once the
+    connection is ready for the next command.
+    """
+    ftp.sendcmd('TYPE A')
+    conn = ftp.transfercmd(command)
+    decompressor = zlib.decompressobj()
+    received = 0
+    pending = ''
+    try:
+        while True:
+            data = conn.recv(8192)
+            if not data:
+                break
+            received += len(data)
+            lines = (pending + decompressor.decompress(data)).split('\n')
+            pending = lines.pop()
+            for line in lines:
+                if line.endswith('\r'):
+                    line = line[:-1]
+                callback(line)
+        pending += decompressor.flush()
+        if pending:
+            callback(pending.rstrip('\r'))
+    except zlib.error:
+        conn.close()
+        # The transfer may end with an error as it was cut short
+        try:
+            ftp.voidresp()
+        except (ftplib.error_temp, ftplib.error_perm):
+            pass
+        raise
+    finally:
+        conn.close()
+    ftp.voidresp()
+    return received
+
+
+def yield_files(server, connection, order=DEPTH_FIRST):
     """Iterates over the ftp and yield all the files as tuples
     (path, RemoteFile)"""
     decode = FallbackDecoder().decode
-    return _yield_files(server, connection, decode, '/', 0)
+    return FtpWalker(server, connection, decode, order)
 
 
-def walk_ftp(server, connection, db_files):
+def _is_under(directories, fullpath):
+    """Whether a path is one of the directories or inside one of them"""
+    while fullpath:
+        if fullpath in directories:
+            return True
+        fullpath = fullpath[:fullpath.rfind(u'/')]
+    return False
+
+
+def walk_ftp(server, connection, db_files, profile=None, checkpoint=None,
+             checkpoint_every=10000, **options):
+    """Lists the FTP and compares it with the files in the database
+
+    Returns the files to insert, the ids of the files to delete, the number
+    of files and the total size.
+
+    If a ServerProfile is given, it is used to pick the listing command, the
+    LIST dialect and the encoding, and updated with what was found. Other
+    options are passed to FtpWalker.
+
+    If 'checkpoint' is given, the changes in the directories that have been
+    walked entirely are handed to it every 'checkpoint_every' files, and
+    before giving up on an error, as
+    checkpoint(completed, to_insert, to_delete, removed_files); they are not
+    returned at the end then. 'completed' can be passed back to resume the
+    walk later: these directories are not listed again, and the files under
+    them are left alone.
+    """
     nb_files = 0
     total_size = 0
 
-    to_insert = []
-    to_delete = []
+    # The files to insert, and the previous version of the files that
+    # changed, by the path of their directory -- or their own path for
+    # directories, which are saved along with their content
+    to_insert = collections.OrderedDict()
+    changed = collections.OrderedDict()
+    # Directories yielded since the last checkpoint
+    completed = []
 
-    for path, file in yield_files(server, connection):
-        nb_files += 1
-        if nb_files > MAX_FILES:
-            raise SuspiciousFtp(ugettext(
-                    u"%(server)s has more than %(max_files)d files. "
-                    "It doesn't seem legit.") %
-                    dict(server=server.display_name(), max_files=MAX_FILES))
-        total_size += file.raw_size
+    if profile is not None:
+        decoder = FallbackDecoder(profile.encoding)
+        dialects = list(LIST_DIALECTS)
+        if profile.listing in dialects:
+            dialects.remove(profile.listing)
+            dialects.insert(0, profile.listing)
+        walker = FtpWalker(server, connection, decoder.decode,
+                           use_mlsd=profile.mlsd, mode_z=profile.mode_z,
+                           dialects=dialects, **options)
+    else:
+        decoder = FallbackDecoder()
+        walker = FtpWalker(server, connection, decoder.decode, **options)
 
-        try:
-            ftp_file = db_files.pop(u'%s/%s' % (path, file.name))
-        except KeyError:
-            # New file -- we have to insert it
-            to_insert.append(file.toFile(server, path))
-        else:
-            # Existing file -- it is more efficient to delete and recreate it
-            # as we can do both operations in bulk mode
-            if file != ftp_file:
-                to_delete.append(ftp_file.id)
-                to_insert.append(file.toFile(server, path))
+    if walker.completed:
+        # Handled by a previous walk
+        done = set(walker.decode(raw_path) for raw_path in walker.completed)
+        for fullpath in db_files.keys():
+            if _is_under(done, fullpath):
+                del db_files[fullpath]
+
+    # Paths of the files in the database, by the path of their directory
+    db_paths = collections.defaultdict(list)
+    if checkpoint is not None:
+        for fullpath in db_files:
+            db_paths[fullpath[:fullpath.rfind(u'/')]].append(fullpath)
+
+    def save_progress():
+        # Subdirectories are completed before their parent, so these
+        # directories and the files directly in them are all that is left of
+        # their trees
+        saved = []
+        saved_changed = []
+        removed = []
+        for path in completed:
+            saved.extend(to_insert.pop(path, ()))
+            previous = changed.pop(path, [])
+            saved_changed.extend(previous)
+            # What is still in db_files there is gone, and so is the content
+            # of the directories that disappeared or became files
+            gone = [path] + [f.fullpath() for f in previous
+                             if f.is_directory]
+            while gone:
+                for fullpath in db_paths.pop(gone.pop(), ()):
+                    ftp_file = db_files.pop(fullpath, None)
+                    if ftp_file is not None:
+                        removed.append(ftp_file)
+                        if ftp_file.is_directory:
+                            gone.append(fullpath)
+        del completed[:]
+        checkpoint(dict(walker.completed), saved,
+                   [f.id for f in saved_changed + removed], removed)
+
+    try:
+        for path, file in walker:
+            nb_files += 1
+            if nb_files + walker.skipped_files > MAX_FILES:
+                raise SuspiciousFtp(ugettext(
+                        u"%(server)s has more than %(max_files)d files. "
+                        "It doesn't seem legit.") %
+                        dict(server=server.display_name(),
+                             max_files=MAX_FILES))
+            total_size += file.raw_size
+            fullpath = u'%s/%s' % (path, file.name)
+            key = fullpath if file.is_directory else path
+
+            try:
+                ftp_file = db_files.pop(fullpath)
+            except KeyError:
+                # New file -- we have to insert it
+                to_insert.setdefault(key, []).append(
+                        file.toFile(server, path))
+            else:
+                # Existing file -- it is more efficient to delete and recreate
+                # it as we can do both operations in bulk mode
+                if file != ftp_file:
+                    changed.setdefault(key, []).append(ftp_file)
+                    to_insert.setdefault(key, []).append(
+                            file.toFile(server, path))
+            if checkpoint is not None and file.is_directory:
+                # Directories are yielded once everything under them was
+                completed.append(fullpath)
+
+            if checkpoint is not None and nb_files % checkpoint_every == 0:
+                save_progress()
+    except ftplib.all_errors:
+        if checkpoint is not None:
+            save_progress()
+        raise
+
+    nb_files += walker.skipped_files
+    total_size += walker.skipped_size
+    to_insert = [f for files in to_insert.itervalues() for f in files]
+    to_delete = [f.id for files in changed.itervalues() for f in files]
+
+    compression = walker.compression_stats()
+    if compression is not None:
+        logger.info(ugettext(u"listings of %(server)s: %(size)d bytes, "
+                             "compressed %(ratio).1f times, about "
+                             "%(saved).1fs saved"),
+                    dict(server=server.display_name(),
+                         size=walker.listing_bytes, ratio=compression[0],
+                         saved=compression[1]))
+
+    if profile is not None:
+        profile.encoding = decoder.enc
+        profile.listing = walker.dialect
+        if not walker.use_mlsd:
+            profile.mlsd = False
 
     return to_insert, to_delete, nb_files, total_size
@@ -8,6 +8,11 @@ urlpatterns = patterns('yoppi',
     url(r"^$", "ftp.views.index", name="index"),
     url(r"^server/(?P<address>[a-z0-9_.-]+)(?P<path>(/.*)?)$", "ftp.views.server"),
     url(r"^search/$", "ftp.views.search", name="search"),
+    url(r"^autocomplete/$", "ftp.views.autocomplete", name="autocomplete"),
+    url(r"^new/$", "ftp.views.recent", name="recent"),
+    url(r"^api/changes/$", "ftp.views.changes", name="changes"),
+    url(r"^stats/$", "ftp.views.statistics", name="statistics"),
+    url(r"^api/stats/$", "ftp.views.statistics_json", name="statistics_json"),
     url(r"^go/(?P<address>[a-z0-9_.-]+)(?P<path>(/.*)?)$", "ftp.views.download"),
 
     # Uncomment the admin/doc line below to enable admin documentation: